@@ -0,0 +1,247 @@
+import argparse
+import json
+import logging
+import os
+import subprocess
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+'''
+Micro-benchmarks for the code paths that run constantly, against mock
+hardware. Each benchmark reports ops/sec and latency percentiles, results
+can be saved as JSON and compared with an earlier run:
+
+    python3 benchmark.py --mock --output before.json
+    python3 benchmark.py --mock --compare before.json
+
+With --startup it times cold starts of server.py and regulator.py
+instead, and prints the modules slowest to import from python -X importtime.
+
+Run it from a directory with brew.yaml using only mock sensors, it reads
+from and writes to the configured database.
+'''
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--mock', action='store_true', help="Mock peripheral sensors, required")
+parser.add_argument('--duration', type=float, default=1, help="Seconds to run each benchmark")
+parser.add_argument('--only', nargs='*', help="Only run benchmarks with these names")
+parser.add_argument('--output', help="Save results as JSON to this file")
+parser.add_argument('--compare', help="Compare against results saved with --output")
+parser.add_argument('--threshold', type=float, default=0.1, help="Ops/sec drop reported as regression")
+parser.add_argument('--startup', action='store_true', help="Time cold starts and print an import time profile")
+parser.add_argument('--runs', type=int, default=5, help="Cold starts to time with --startup")
+args, _ = parser.parse_known_args()
+
+# local packages
+import source
+import loader as loader
+from logger import ESHandler, ElasticOptionalFormatter
+from database import BrewDatabase
+
+
+class ElasticStub(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers['Content-Length']))
+        body = b'{"errors": false, "items": []}'
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        return
+
+
+def measure(func, duration):
+    # warm up caches and lazy setup before timing
+    for _ in range(10):
+        func()
+
+    latencies = []
+    started = time.perf_counter()
+    deadline = started + duration
+    while True:
+        callStart = time.perf_counter_ns()
+        func()
+        latencies.append(time.perf_counter_ns() - callStart)
+        if time.perf_counter() >= deadline:
+            break
+
+    return summarize(latencies, time.perf_counter() - started)
+
+
+def summarize(latencies, elapsed):
+    latencies = sorted(latencies)
+
+    def percentile(p):
+        return round(latencies[min(int(len(latencies) * p), len(latencies) - 1)] / 1000, 2)
+
+    return {
+        'ops': len(latencies),
+        'opsPerSecond': round(len(latencies) / elapsed, 1),
+        'p50us': percentile(0.5),
+        'p90us': percentile(0.9),
+        'p99us': percentile(0.99),
+        'maxus': round(latencies[-1] / 1000, 2)
+    }
+
+
+def makeRecord(es=True):
+    record = logging.LogRecord('brewlogger', logging.INFO, __file__, 0, 'Sensor readings', None, None)
+    if es:
+        record.es = {'temperature': 5.12, 'humidity': 88.2, 'location': 'inside'}
+    return record
+
+
+def benchmarks():
+    db = BrewDatabase()
+    peripherals = loader.load('brew.yaml')
+    relay = peripherals['relays'][0]
+    sensor = peripherals['sensors'][0]
+    formatter = ElasticOptionalFormatter('%(asctime)s | %(levelname)2s | %(message)s')
+
+    stub = ThreadingHTTPServer(('127.0.0.1', 0), ElasticStub)
+    threading.Thread(target=stub.serve_forever, daemon=True).start()
+    esHandler = ESHandler(host='127.0.0.1', port=stub.server_port, ssl=False, queueSize=100000)
+
+    import server
+    client = server.app.test_client()
+
+    # the goal of the first chamber, read and written back as the server and regulator do
+    chamber = server.chambers[0].name if server.chambers else 'default'
+    goal = db.getChamberGoal(chamber)
+    if goal is None:
+        goal = 18
+        db.setChamberGoal(chamber, goal)
+
+    yield 'database.get', lambda: db.getChamberGoal(chamber)
+    yield 'database.write', lambda: db.setChamberGoal(chamber, goal)
+    yield 'relay.state', lambda: relay.state
+    yield 'sensor.info', lambda: sensor.info
+    yield 'formatter.format', lambda: formatter.format(makeRecord())
+    yield 'eshandler.emit', lambda: esHandler.emit(makeRecord())
+    yield 'loader.load', lambda: loader.load('brew.yaml')
+    yield 'api.sensors', lambda: client.get('/api/sensors')
+    yield 'api.relays', lambda: client.get('/api/relays')
+    if server.chambers:
+        yield 'api.regulator', lambda: client.get('/api/regulator')
+
+    esHandler.close()
+    stub.shutdown()
+
+
+# imports and brew.yaml loading each executable does before it starts working
+STARTUP = {
+    'startup.server': ['-c', 'import server', '--mock'],
+    'startup.regulator': ['-c', 'import regulator; regulator.loader.load("brew.yaml")', '5', '0.5', '30', '--mock']
+}
+
+
+def importProfile(stderr):
+    modules = []
+    for line in stderr.decode('utf8').splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+
+        selfTime, cumulative, name = line[len('import time:'):].split('|')
+        modules.append((int(selfTime), int(cumulative), name.strip()))
+
+    return sorted(modules, reverse=True)
+
+
+def startup(command, runs):
+    env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.abspath(__file__)))
+    latencies = []
+    started = time.perf_counter()
+    for _ in range(runs):
+        callStart = time.perf_counter_ns()
+        subprocess.run([sys.executable] + command, env=env, check=True,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        latencies.append(time.perf_counter_ns() - callStart)
+
+    elapsed = time.perf_counter() - started
+    # importtime slows imports down, profile in a run of its own
+    profiled = subprocess.run([sys.executable, '-X', 'importtime'] + command, env=env, check=True,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    return summarize(latencies, elapsed), importProfile(profiled.stderr)
+
+
+def startupBenchmarks():
+    for name, command in STARTUP.items():
+        yield name, lambda command=command: startup(command, args.runs)
+
+
+def gitCommit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       stderr=subprocess.DEVNULL).decode('utf8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, previousPath, threshold):
+    with open(previousPath) as file:
+        previous = json.load(file)['results']
+
+    regressions = []
+    print('\n{:<20} {:>14} {:>14} {:>8}'.format('benchmark', 'before ops/s', 'after ops/s', 'change'))
+    for name, result in results.items():
+        if name not in previous:
+            continue
+
+        before = previous[name]['opsPerSecond']
+        change = (result['opsPerSecond'] - before) / before
+        print('{:<20} {:>14} {:>14} {:>7.1f}%'.format(name, before, result['opsPerSecond'], change * 100))
+        if change < -threshold:
+            regressions.append(name)
+
+    return regressions
+
+
+def main():
+    if not args.mock:
+        print('Benchmarks run against mock hardware, add --mock.')
+        sys.exit(1)
+
+    results = {}
+    profiles = {}
+    print('{:<20} {:>12} {:>10} {:>10} {:>10}'.format('benchmark', 'ops/s', 'p50 us', 'p90 us', 'p99 us'))
+    for name, func in startupBenchmarks() if args.startup else benchmarks():
+        if args.only and name not in args.only:
+            continue
+
+        if args.startup:
+            result, profiles[name] = func()
+        else:
+            result = measure(func, args.duration)
+        results[name] = result
+        print('{:<20} {:>12} {:>10} {:>10} {:>10}'.format(
+            name, result['opsPerSecond'], result['p50us'], result['p90us'], result['p99us']))
+
+    for name, modules in profiles.items():
+        print('\n{:<40} {:>10} {:>14}'.format(name, 'self us', 'cumulative us'))
+        for selfTime, cumulative, module in modules[:15]:
+            print('{:<40} {:>10} {:>14}'.format(module, selfTime, cumulative))
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump({
+                'commit': gitCommit(),
+                'timestamp': time.time(),
+                'python': sys.version.split()[0],
+                'results': results
+            }, file, indent=2)
+
+    if args.compare:
+        regressions = compare(results, args.compare, args.threshold)
+        if regressions:
+            print('\nRegressed by more than {:.0f}%: {}'.format(args.threshold * 100, ', '.join(regressions)))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+import argparse
+from flask import Flask
+
+'''
+Overview api for several brewLogger nodes, each running server.py. Nodes
+are polled in the background and /api/fleet answers from the last state
+every node returned, so it never waits on a node. Nodes are listed under
+hub in config.yaml, or given on the command line:
+
+    python3 hub.py --node http://192.168.1.21:5000 --node http://192.168.1.22:5000
+'''
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--port', type=int, default=5000, help="API port")
+parser.add_argument('--node', action='append', help="Node url, overrides nodes in config.yaml")
+args, _ = parser.parse_known_args()
+
+# local packages
+import source  # take a look in source/__init__.py
+from fleet import BrewHub
+from utils import getConfig
+
+app = Flask(__name__)
+
+hubConfig = dict(getConfig().get('hub', {}))
+if args.node:
+    hubConfig['nodes'] = [{'url': url} for url in args.node]
+
+hub = BrewHub.fromConfig(hubConfig)
+
+
+@app.route('/_health')
+def health():
+    return 'ok'
+
+
+@app.errorhandler(404)
+def pageNotFound(e):
+    return {
+        'success': False,
+        'message': str(e)
+    }, 404
+
+
+@app.route('/api/fleet')
+def fleet():
+    return hub.fleet
+
+
+@app.route('/api/fleet/<name>')
+def fleetNode(name):
+    node = hub.getNodeByName(name)
+    if node is None:
+        return {
+            'success': False,
+            'message': 'node {} not found, check /api/fleet'.format(name)
+        }, 404
+
+    return node.info(hub.ttl)
+
+
+if __name__ == '__main__':
+    hub.poll()
+    hub.spawnBackgroundPolling()
+    app.run(host='0.0.0.0', port=args.port)
@@ -8,9 +8,14 @@ import commandlineArguments
 args = commandlineArguments.parse()
 import loader as loader
 from logger import logger
-from brewRelay import BrewRelay
-from brewSensor import BrewSensor
+from chamber import BrewChamber
+from reloader import BrewReloader
 from database import BrewDatabase
+from compactor import BrewCompactor
+from notifier import BrewNotifier
+from scheduler import scheduler
+from controllers import BrewController, BangBangController
+from utils import getConfig
 
 
 db = BrewDatabase()
@@ -24,11 +29,21 @@ NOTES
 This is not realtime critical so to limit interaction with sensor
 we pool it on a interval and save it as `currentTemp`.
 
+What to do next is decided by a pluggable controller, see
+controllers.py. Waiting is done on `wakeup` instead of sleeping, the server notifies
+us of new setpoints and relay toggles so we react to them right away.
+
+Every chamber in brew.yaml gets its own regulator, all stepped from one
+thread by regulateChambers. They share the sensors, the scheduler and the
+database writers, and wait on one wakeup event.
+
 '''
 
 
 class BrewRegulator():
-    def __init__(self, temperatureSensor, coolingRelay, heatRelay, degreesAllowedToDrift, poolingInterval=60):
+    def __init__(self, temperatureSensor, coolingRelay, heatRelay, degreesAllowedToDrift, poolingInterval=60,
+                 controller=None, clock=time, name='default', wakeup=None):
+        self.name = name
         self.currentTemp = 0
         self.poolingInterval = poolingInterval
         self.cooling = coolingRelay
@@ -36,27 +51,89 @@ class BrewRegulator():
         self.temperatureSensor = temperatureSensor
         self.degreesAllowedToDrift = degreesAllowedToDrift
 
-        self.secondsToDriftSingleDegree = 300
+        self.controller = controller or BangBangController()
+        self.clock = clock
+        self.target = None
+        self.wakeup = wakeup or threading.Event()
+        self.woken = False
+        self.poolJob = None
+        self.notifier = None
 
-        self.poolTemperatureSensorThread = threading.Thread(
-            target=self.poolTemperatureSensorOnInterval, args=())
-        self.poolTemperatureSensorThread.daemon = True
+    def spawnBackgroundPooling(self):
+        self.poolJob = scheduler.every(
+            self.poolingInterval, self.poolTemperatureSensor, name='regulator {} sensor pooling'.format(self.name))
 
-    def poolTemperatureSensorOnInterval(self):
-        logger.info('Starting thread pooling temperature sensor',
-                    es={'timeout': self.poolingInterval})
-        while True:
-            self.currentTemp = self.temperatureSensor.temp
-            time.sleep(self.poolingInterval)
+    def poolTemperatureSensor(self):
+        self.currentTemp = self.temperatureSensor.latest(filtered=True).temperature
 
     def waitForTempReading(self):
         while self.currentTemp == 0:
             time.sleep(0.5)
 
+    def listenForChanges(self, notifier):
+        self.notifier = notifier
+        notifier.on('setpoint', self.onSetpointChange)
+        notifier.on('relay', self.onRelayChange)
+
+    def stop(self):
+        if self.poolJob is not None:
+            scheduler.cancel(self.poolJob)
+            self.poolJob = None
+
+        if self.notifier is not None:
+            self.notifier.off('setpoint', self.onSetpointChange)
+            self.notifier.off('relay', self.onRelayChange)
+            self.notifier = None
+
+    def useController(self, controller):
+        '''
+        Switches to a controller seeded from the readings recorded for this
+        chamber, so learned behaviour survives restarts and reloads.
+        '''
+        controller.seed(self, db)
+        self.controller = controller
+        self.woken = True
+
+    def useChamber(self, chamber, limit=None):
+        '''
+        Switches to the devices of a reloaded chamber, keeping controller
+        and goal. Returns True if any device changed.
+        '''
+        limit = chamber.limit or limit or self.degreesAllowedToDrift
+        devices = (chamber.sensor, chamber.cooling, chamber.heating)
+        if devices == (self.temperatureSensor, self.cooling, self.heating) and limit == self.degreesAllowedToDrift:
+            return False
+
+        self.temperatureSensor, self.cooling, self.heating = devices
+        self.degreesAllowedToDrift = limit
+        self.poolTemperatureSensor()
+        self.woken = True
+        return True
+
+    def onSetpointChange(self, message):
+        if message.get('chamber', 'default') != self.name:
+            return
+
+        self.target = float(message['goal'])
+        logger.info('Received new temperature goal', es={'chamber': self.name, 'goal': self.target})
+        self.wake()
+
+    def onRelayChange(self, message):
+        if message.get('controls') in (None, self.heating.controls, self.cooling.controls):
+            self.wake()
+
+    def wake(self):
+        self.woken = True
+        self.wakeup.set()
+
+    def refreshTargetTemperature(self):
+        self.target = db.getChamberGoal(self.name)
+
     @property
     def targetTemperature(self):
-        query = 'select target_temperature from regulator'
-        return db.get(query)
+        if self.target is None:
+            self.refreshTargetTemperature()
+        return self.target
 
     @property
     def withinDeviationLimit(self):
@@ -107,14 +184,6 @@ class BrewRegulator():
         if self.heating.state is True:
             self.heating.set(False)
 
-    def turnOnTemperatureControl(self):
-        if self.shouldCool:
-            self.setCooling(True)
-        elif self.shouldHeat:
-            self.setHeating(True)
-
-        logger.info('Updated fridge state', es={'state': self.state})
-
     def turnOffTemperatureControl(self):
         if self.heating.state is True:
             self.heating.set(False)
@@ -122,55 +191,64 @@ class BrewRegulator():
         if self.cooling.state is True:
             self.cooling.set(False)
 
-        logger.info('Updated fridge state', es={'state': self.state})
-
-    def temperatureLossFunction(self):
-        # return 6
-        return self.degreesAllowedToDrift * self.secondsToDriftSingleDegree
-
-    def sustainTemperature(self):
-        timeout = self.temperatureLossFunction()
-
-        logger.info('Sustaining temperature', es={
-            'state': self.state,
-            'temperature': self.currentTemp,
-            'goal': self.targetTemperature,
-            'timeout': timeout
-        })
+    def applyState(self, state):
+        if state == self.state:
+            return
 
-        time.sleep(timeout)
-
-    def chaseTemperature(self):
-        isGoalMet = False
-
-        # turns on either heating or cooling relay
-        self.turnOnTemperatureControl()
-
-        while not isGoalMet:
-            if self.hasMetTemperatureGoal:
-                logger.info("Temperature met, idling", es={
-                    'temperature': self.currentTemp,
-                    'goal': self.targetTemperature
-                })
-                isGoalMet = True
-
-            else:
-                logger.info("Chasing temperature goal", es={
-                    'state': self.state,
-                    'temperature': self.currentTemp,
-                    'goal': self.targetTemperature
-                })
-                time.sleep(self.poolingInterval)
-
-        # turns of any heating or cooling relay
-        self.turnOffTemperatureControl()
-
-    def regulateTemperatureTowardsGoal(self):
-        while True:
-            if self.withinDeviationLimit:
-                self.sustainTemperature()
-            else:
-                self.chaseTemperature()
+        if state == 'heating':
+            self.setHeating(True)
+        elif state == 'cooling':
+            self.setCooling(True)
+        else:
+            self.turnOffTemperatureControl()
+
+        logger.info('Updated fridge state', es={'chamber': self.name, 'state': self.state})
+
+    def step(self):
+        '''
+        Lets the controller decide on relay state and applies it, returns
+        seconds to wait before stepping again.
+        '''
+        # a notification could have been missed while nobody was
+        # listening, resync the goal every step
+        self.refreshTargetTemperature()
+        return self.control()
+
+    def control(self):
+        now = self.clock.time()
+        state, timeout = self.controller.decide(self, now)
+        self.applyState(state)
+        self.controller.observe(self.state, now)
+        return timeout
+
+    @staticmethod
+    def fromChamber(chamber, limit, interval, controller, wakeup=None):
+        regulator = BrewRegulator(chamber.sensor, chamber.cooling, chamber.heating, chamber.limit or limit,
+                                  interval, name=chamber.name, wakeup=wakeup)
+        regulator.useController(controller)
+        return regulator
+
+
+def regulateChambers(regulators, wakeup, reloader=None):
+    '''
+    Steps every regulator when its timeout runs out or it is woken by a
+    notification, sleeping on the shared wakeup event in between. Reloaded
+    brew.yaml and config.yaml changes are applied between steps.
+    '''
+    due = {}
+
+    while True:
+        if reloader is not None:
+            reloader.apply()
+
+        for regulator in regulators:
+            if regulator.woken or due.get(regulator.name, 0) <= time.monotonic():
+                regulator.woken = False
+                due[regulator.name] = time.monotonic() + regulator.step()
+
+        nextDue = min((due[regulator.name] for regulator in regulators), default=time.monotonic() + 60)
+        wakeup.wait(max(nextDue - time.monotonic(), 0))
+        wakeup.clear()
 
 
 RELAYS = []
@@ -182,51 +260,80 @@ def gracefullyTurnOffRelays():
             relay.set(False)
 
 
-def checkRequiredSensors(insideSensor, outsideSensor):
-    if insideSensor is None:
-        raise Exception('Error! Missing inside temperature sensor!')
+def logSchedulerStats():
+    for job in scheduler.stats:
+        logger.info('Scheduled job stats', es=job)
 
-    if outsideSensor is None:
-        raise Exception('Error! Missing outside temperature sensor!')
 
-
-def commitTargetTemperatureToDatabase(temperature):
-    query = 'update regulator set target_temperature = {}'
-    query = query.format(temperature)
-    success = db.write(query)
+def commitTargetTemperatureToDatabase(temperature, chamber='default'):
+    success = db.setChamberGoal(chamber, temperature)
     if success is False:
         raise Exception(
             'unable to write to database, make sure setup script is run.')
 
 
+def regulatorController():
+    # a copy, the command line controller must not end up in the shared config
+    regulatorConfig = dict(getConfig().get('regulator', {}))
+    if args.controller:
+        regulatorConfig['controller'] = args.controller
+    return BrewController.fromConfig(regulatorConfig)
+
+
 def main():
     targetTemperature = args.temp
     limit = args.limit
     interval = args.interval
 
-    commitTargetTemperatureToDatabase(targetTemperature)
-    externalPeripherals = loader.load('brew.yaml')
-    sensors = externalPeripherals['sensors']
-    relays = externalPeripherals['relays']
-
-    # Sensor import and background logging
-    insideSensor = BrewSensor.getSensorByItsLocation(sensors, 'inside')
-    outsideSensor = BrewSensor.getSensorByItsLocation(sensors, 'outside')
-    checkRequiredSensors(insideSensor, outsideSensor)
-    for sensor in [insideSensor, outsideSensor]:
+    specs = loader.loadSpecs('brew.yaml')
+    externalPeripherals = loader.build(specs)
+    chambers = BrewChamber.fromPeripherals(externalPeripherals)
+    if not chambers:
+        logger.warning('No chambers to regulate, add them to brew.yaml')
+
+    # Sensor background logging, once per sensor however many chambers use it
+    sensors = []
+    for chamber in chambers:
+        sensors.extend(sensor for sensor in chamber.sensors if sensor not in sensors)
+    for sensor in sensors:
         sensor.spawnBackgroundSensorLog()
 
-    # Relay import and append to list for gracefull shutdown
-    coolingRelay = BrewRelay.getRelayByName(relays, 'cooling')
-    heatRelay = BrewRelay.getRelayByName(relays, 'heating')
-    RELAYS.extend([coolingRelay, heatRelay])
+    # Rolls up and expires the readings logged by sensors
+    compactor = BrewCompactor()
+    compactor.spawnBackgroundCompaction()
+    scheduler.every(300, logSchedulerStats, delay=300)
+
+    # Regulator per chamber, taking its sensor, relays, temp and regulating values
+    wakeup = threading.Event()
+    notifier = BrewNotifier()
+
+    def makeRegulator(chamber):
+        commitTargetTemperatureToDatabase(chamber.goal or targetTemperature, chamber.name)
+        regulator = BrewRegulator.fromChamber(chamber, limit, interval, regulatorController(), wakeup)
+        regulator.listenForChanges(notifier)
+        return regulator
+
+    regulators = []
+    for chamber in chambers:
+        RELAYS.extend(relay for relay in chamber.relays if relay not in RELAYS)
+        regulators.append(makeRegulator(chamber))
+
+    for regulator in regulators:
+        regulator.spawnBackgroundPooling()
+    notifier.spawnBackgroundListener()
+
+    # Applies edits to brew.yaml and config.yaml without a restart
+    reloader = None
+    reloadConfig = getConfig().get('reload', {})
+    if reloadConfig.get('enabled', True):
+        reloader = BrewReloader('brew.yaml', specs, externalPeripherals, chambers, regulators, RELAYS,
+                                makeRegulator, regulatorController, commitTargetTemperatureToDatabase,
+                                reloadConfig.get('interval', 2))
+        reloader.spawnBackgroundWatch(wakeup)
 
-    # Regulator takes a inside temp, relays, temp and regulating values
-    regulator = BrewRegulator(
-        insideSensor, coolingRelay, heatRelay, limit, interval)
-    regulator.poolTemperatureSensorThread.start()
-    regulator.waitForTempReading()
-    regulator.regulateTemperatureTowardsGoal()
+    for regulator in regulators:
+        regulator.waitForTempReading()
+    regulateChambers(regulators, wakeup, reloader)
 
 
 if __name__ == '__main__':
@@ -238,10 +345,12 @@ if __name__ == '__main__':
             'exception': error.__class__.__name__
         })
 
+        scheduler.shutdown()
         gracefullyTurnOffRelays()
         raise error
     except KeyboardInterrupt as error:
         logger.info("Keyboard interrupt! Turning Off all relays.")
 
+        scheduler.shutdown()
         gracefullyTurnOffRelays()
         raise error
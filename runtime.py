@@ -0,0 +1,314 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+# local packages
+import source
+import loader as loader
+from logger import logger
+from brewRelay import BrewRelay
+from brewSensor import BrewSensor
+from chamber import BrewChamber
+from compactor import BrewCompactor
+from asyncServer import AsyncHTTPServer
+from utils import getConfig
+from regulator import (args, BrewRegulator, RELAYS, commitTargetTemperatureToDatabase,
+                       gracefullyTurnOffRelays, regulatorController)
+
+'''
+Single process runtime running the regulator, sensor logging, camera
+and API on one asyncio event loop, instead of regulator.py and
+server.py as separate processes each loading their own peripherals.
+
+Sensor, GPIO and database calls that can block are run on a small
+thread pool, the API reads live state from the sensor buffers, relays
+and regulators directly, with one regulator task per chamber. Takes the
+same arguments as regulator.py:
+
+    python3 runtime.py 5 0.5 30 --port 5000
+'''
+
+
+class AsyncRuntime():
+    def __init__(self, sensors, relays, chambers, regulators, camera=None):
+        self.sensors = sensors
+        self.relays = relays
+        self.chambers = chambers
+        self.regulators = regulators
+        # the regulator routes act on the first chamber, as before chambers
+        self.regulator = regulators[0] if regulators else None
+        self.camera = camera
+        self.compactor = BrewCompactor()
+        self.wakeups = {}
+        self.api = AsyncHTTPServer()
+        self.addRoutes()
+
+    async def run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(None, func, *args)
+
+    async def wait(self, regulator, timeout):
+        wakeup = self.wakeups[regulator.name]
+        try:
+            await asyncio.wait_for(wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        wakeup.clear()
+
+    def wake(self, name):
+        if name in self.wakeups:
+            self.wakeups[name].set()
+
+    async def every(self, interval, func, name):
+        # fixed-rate deadlines on the loop clock, a slow run skips missed ones
+        loop = asyncio.get_running_loop()
+        deadline = loop.time()
+        logger.info('Scheduled task {} at interval: {}'.format(name, interval))
+
+        while True:
+            try:
+                await self.run(func)
+            except Exception as error:
+                logger.error('Scheduled task failed, retrying next interval', es={
+                    'task': name,
+                    'error': str(error),
+                    'exception': error.__class__.__name__
+                })
+
+            deadline += interval
+            while deadline < loop.time():
+                deadline += interval
+            await asyncio.sleep(deadline - loop.time())
+
+    async def regulate(self, regulator):
+        while regulator.currentTemp == 0:
+            await asyncio.sleep(0.5)
+
+        while True:
+            timeout = await self.run(regulator.step)
+            await self.wait(regulator, timeout)
+
+    def regulatorInfo(self, regulator):
+        heating, cooling = regulator.heating, regulator.cooling
+        return {
+            'state': 'heating' if heating.cachedState else 'cooling' if cooling.cachedState else 'idle',
+            'goal': regulator.target
+        }
+
+    async def setGoal(self, regulator, goal):
+        try:
+            goal = float(goal)
+        except ValueError:
+            return {
+                'success': False,
+                'message': 'target temperature {} is not a number'.format(goal)
+            }, 400
+
+        await self.run(commitTargetTemperatureToDatabase, goal, regulator.name)
+        regulator.target = goal
+        self.wake(regulator.name)
+
+        return {
+            'success': True,
+            'message': 'set target temperature of {} to {}'.format(regulator.name, goal)
+        }
+
+    def regulatorByName(self, name):
+        return next((regulator for regulator in self.regulators if regulator.name == name), None)
+
+    def chamberInfo(self, regulator):
+        chamber = BrewChamber.getChamberByName(self.chambers, regulator.name)
+        return {
+            'name': chamber.name,
+            **self.regulatorInfo(regulator),
+            'sensor': chamber.sensor.location,
+            'ambient': chamber.ambient.location if chamber.ambient else None,
+            'relays': [relay.controls for relay in chamber.relays]
+        }
+
+    def noChambers(self):
+        return {
+            'success': False,
+            'message': 'no chambers regulated, check chambers in brew.yaml'
+        }, 404
+
+    def relayInfo(self, relay):
+        # this process is the only one switching relays, so the cached state is current
+        return {
+            'controls': relay.controls,
+            'pin': relay.pin,
+            'state': relay.cachedState
+        }
+
+
+    def addRoutes(self):
+        api = self.api
+
+        @api.route('/_health')
+        async def health():
+            return 'ok'
+
+        @api.route('/api/sensors')
+        async def allSensors():
+            # the sensor log tasks sample, requests only read the last snapshot
+            return {
+                'sensors': [sensor.describe(sensor.snapshot) for sensor in self.sensors
+                            if sensor.snapshot is not None]
+            }
+
+        @api.route('/api/sensor/<location>')
+        async def getSensor(location):
+            sensor = BrewSensor.getSensorByItsLocation(self.sensors, location)
+            if not sensor:
+                return {
+                    'success': False,
+                    'message': 'sensor {} not found, check /sensors'.format(location)
+                }, 404
+
+            if sensor.snapshot is None:
+                return {
+                    'success': False,
+                    'message': 'sensor {} has not been sampled yet'.format(location)
+                }, 503
+
+            return sensor.describe(sensor.snapshot)
+
+        @api.route('/api/relays')
+        async def allRelays():
+            return {
+                'relays': [self.relayInfo(relay) for relay in self.relays]
+            }
+
+        @api.route('/api/relay/<name>')
+        async def relay(name):
+            relay = BrewRelay.getRelayByName(self.relays, name)
+            if not relay:
+                return {
+                    'success': False,
+                    'message': 'relay {} not found, check /relays'.format(name)
+                }
+
+            return self.relayInfo(relay)
+
+        @api.route('/api/relay/<name>', methods=['POST'])
+        async def toggleRelay(name):
+            relay = BrewRelay.getRelayByName(self.relays, name)
+            if not relay:
+                return {
+                    'success': False,
+                    'message': 'relay {} not found, check /relays'.format(name)
+                }
+
+            await self.run(relay.set, not relay.cachedState)
+
+            # never run heating and cooling at the same time
+            chamber = BrewChamber.getChamberOfRelay(self.chambers, relay)
+            if chamber:
+                opposingRelay = chamber.oppositeRelay(relay)
+            else:
+                opposingRelay = BrewRelay.getOppositeRelayByName(self.relays, name)
+            if opposingRelay and opposingRelay.cachedState is True:
+                await self.run(opposingRelay.set, False)
+
+            if chamber:
+                self.wake(chamber.name)
+            return self.relayInfo(relay)
+
+        @api.route('/api/chambers')
+        async def allChambers():
+            return {
+                'chambers': [self.chamberInfo(regulator) for regulator in self.regulators]
+            }
+
+        @api.route('/api/chamber/<name>')
+        async def chamber(name):
+            regulator = self.regulatorByName(name)
+            if not regulator:
+                return {
+                    'success': False,
+                    'message': 'chamber {} not found, check /chambers'.format(name)
+                }, 404
+
+            return self.chamberInfo(regulator)
+
+        @api.route('/api/chamber/<name>/regulator/<goal>', methods=['POST'])
+        async def chamberGoal(name, goal):
+            regulator = self.regulatorByName(name)
+            if not regulator:
+                return {
+                    'success': False,
+                    'message': 'chamber {} not found, check /chambers'.format(name)
+                }, 404
+
+            return await self.setGoal(regulator, goal)
+
+        @api.route('/api/regulator')
+        async def regulatorState():
+            if self.regulator is None:
+                return self.noChambers()
+
+            return self.regulatorInfo(self.regulator)
+
+        @api.route('/api/regulator/<goal>', methods=['POST'])
+        async def regulatorGoal(goal):
+            if self.regulator is None:
+                return self.noChambers()
+
+            return await self.setGoal(self.regulator, goal)
+
+    async def main(self, port):
+        loop = asyncio.get_running_loop()
+        loop.set_default_executor(ThreadPoolExecutor(max_workers=4, thread_name_prefix='runtime'))
+        self.wakeups = {regulator.name: asyncio.Event() for regulator in self.regulators}
+
+        tasks = [
+            self.every(sensor.interval, sensor.logReadings, 'sensor {} log'.format(sensor.location))
+            for sensor in self.sensors
+        ]
+        for regulator in self.regulators:
+            tasks.append(self.every(regulator.poolingInterval, regulator.poolTemperatureSensor,
+                                    'regulator {} sensor pooling'.format(regulator.name)))
+        tasks.append(self.every(self.compactor.interval, self.compactor.compact, 'telemetry compaction'))
+        if self.camera is not None:
+            tasks.append(self.every(self.camera.interval, self.camera.capture, 'camera capture'))
+
+        tasks.extend(self.regulate(regulator) for regulator in self.regulators)
+        tasks.append(self.api.serve(port=port))
+        await asyncio.gather(*tasks)
+
+
+def main():
+    externalPeripherals = loader.load('brew.yaml')
+    sensors = externalPeripherals.get('sensors') or []
+    relays = externalPeripherals.get('relays') or []
+    chambers = BrewChamber.fromPeripherals(externalPeripherals)
+
+    regulators = []
+    for chamber in chambers:
+        commitTargetTemperatureToDatabase(chamber.goal or args.temp, chamber.name)
+        RELAYS.extend(chamber.relays)
+        regulators.append(BrewRegulator.fromChamber(chamber, args.limit, args.interval, regulatorController()))
+
+    camera = None
+    if args.camera:
+        from brewCamera import BrewCamera
+        camera = BrewCamera.fromConfig(getConfig().get('camera', {}))
+
+    runtime = AsyncRuntime(sensors, relays, chambers, regulators, camera)
+    asyncio.run(runtime.main(args.port))
+
+
+if __name__ == '__main__':
+    try:
+        main()
+    except Exception as error:
+        logger.error("Runtime crashed! Turning Off all relays.", es={
+            'error': str(error),
+            'exception': error.__class__.__name__
+        })
+
+        gracefullyTurnOffRelays()
+        raise error
+    except KeyboardInterrupt as error:
+        logger.info("Keyboard interrupt! Turning Off all relays.")
+
+        gracefullyTurnOffRelays()
+        raise error
@@ -1,18 +1,41 @@
-from flask import Flask, request
+import os
+import threading
+import time
+from flask import Flask, Response, jsonify, request, send_file, stream_with_context
 
 import source  # take a look in source/__init__.py
 import loader as loader
 from brewSensor import BrewSensor
 from brewRelay import BrewRelay
+from chamber import BrewChamber
 from database import BrewDatabase
+from publisher import publisher
+from scheduler import scheduler
+from utils import getConfig
+import history
+import notifier
 
 app = Flask(__name__)
 
 externalPeripherals = loader.load('brew.yaml')
-sensors = externalPeripherals['sensors']
-relays = externalPeripherals['relays']
+sensors = externalPeripherals.get('sensors') or []
+relays = externalPeripherals.get('relays') or []
+chambers = BrewChamber.fromPeripherals(externalPeripherals)
 db = BrewDatabase()
-getTargetTemperatureQuery = 'select target_temperature from regulator'
+streamJobs = []
+streamLock = threading.Lock()
+streamVersion = None
+
+# sample in the background, requests only ever read the buffered snapshot
+for sensor in sensors:
+    sensor.spawnBackgroundSampling()
+
+cameraConfig = getConfig().get('camera', {})
+camera = None
+if cameraConfig.get('enabled'):
+    from brewCamera import BrewCamera
+    camera = BrewCamera.fromConfig(cameraConfig)
+    camera.spawnBackgroundCapture()
 
 
 # Health and error handling
@@ -37,13 +60,45 @@ def methodNotFound(e):
     }, 405
 
 
+# Conditional responses
+def conditionalResponse(body, etag, lastModified=None, maxAge=0):
+    '''
+    Responds 304 Not Modified when the client already has this etag or
+    nothing changed since its If-Modified-Since. maxAge 0 lets clients
+    keep the response but revalidate it on every request.
+    '''
+    response = jsonify(body)
+    response.set_etag(etag)
+    if lastModified is not None:
+        response.last_modified = lastModified
+
+    if maxAge > 0:
+        response.cache_control.max_age = maxAge
+    else:
+        response.cache_control.no_cache = True
+
+    return response.make_conditional(request)
+
+
+def sensorMaxAge(sensor, snapshot):
+    # a reading is fresh until the background sampler takes the next one
+    return max(int(sensor.interval - snapshot.age()), 0)
+
+
 # API routes
 @app.route('/api/sensors')
 def allSensors():
-    return {
-        'sensors': [sensor.info for sensor in sensors]
+    # sensors without a first sample yet are left out
+    snapshots = [(sensor, sensor.snapshot) for sensor in sensors if sensor.snapshot is not None]
+    body = {
+        'sensors': [sensor.describe(snapshot) for sensor, snapshot in snapshots]
     }
 
+    etag = '-'.join('{}:{}'.format(sensor.location, snapshot.timestamp) for sensor, snapshot in snapshots)
+    lastModified = max((snapshot.timestamp for _, snapshot in snapshots), default=None)
+    maxAge = min((sensorMaxAge(sensor, snapshot) for sensor, snapshot in snapshots), default=0)
+    return conditionalResponse(body, etag, lastModified, maxAge)
+
 
 @app.route('/api/sensor/<location>')
 def getSensor(location):
@@ -54,14 +109,95 @@ def getSensor(location):
             'message': 'sensor {} not found, check /sensors'.format(location)
         }, 404
 
-    return sensor.info
+    snapshot = sensor.snapshot
+    if snapshot is None:
+        return {
+            'success': False,
+            'message': 'sensor {} has not been sampled yet'.format(location)
+        }, 503
+
+    etag = '{}:{}'.format(sensor.location, snapshot.timestamp)
+    return conditionalResponse(sensor.describe(snapshot), etag, snapshot.timestamp, sensorMaxAge(sensor, snapshot))
+
+
+@app.route('/api/sensor/<location>/recent')
+def getSensorRecent(location):
+    sensor = BrewSensor.getSensorByItsLocation(sensors, location)
+    if not sensor:
+        return {
+            'success': False,
+            'message': 'sensor {} not found, check /sensors'.format(location)
+        }, 404
+
+    try:
+        seconds = float(request.args.get('seconds', 60))
+    except ValueError as error:
+        return {
+            'success': False,
+            'message': 'seconds must be a number: {}'.format(error)
+        }, 400
+
+    readings = []
+    for timestamp, values in sensor.window(seconds):
+        # metrics missing from a sample are buffered as nan
+        values = {metric: value for metric, value in values.items() if value == value}
+        readings.append({'timestamp': timestamp, **values})
+
+    return {
+        'location': sensor.location,
+        'readings': readings
+    }
+
+
+@app.route('/api/sensor/<location>/history')
+def getSensorHistory(location):
+    sensor = BrewSensor.getSensorByItsLocation(sensors, location)
+    if not sensor:
+        return {
+            'success': False,
+            'message': 'sensor {} not found, check /sensors'.format(location)
+        }, 404
+
+    try:
+        end = float(request.args.get('to', time.time()))
+        start = float(request.args.get('from', end - 86400))
+        points = int(request.args.get('points', 1000))
+    except ValueError as error:
+        return {
+            'success': False,
+            'message': 'from, to and points must be numbers: {}'.format(error)
+        }, 400
+
+    resolution = request.args.get('resolution', 'auto')
+    if resolution == 'auto':
+        resolution = history.selectResolution(start, end, points, sensor.interval)
+    elif resolution not in history.RESOLUTIONS:
+        return {
+            'success': False,
+            'message': 'resolution must be auto or one of {}'.format(', '.join(history.RESOLUTIONS))
+        }, 400
+
+    rows = history.queryReadings(db, location, start, end, resolution, request.args.get('metric'))
+    headers = {'X-Resolution': resolution}
+
+    if request.args.get('format') == 'json':
+        body = history.streamJSON(rows, location=location, resolution=resolution)
+        return Response(stream_with_context(body), mimetype='application/json', headers=headers)
+
+    body = history.streamNDJSON(rows)
+    return Response(stream_with_context(body), mimetype='application/x-ndjson', headers=headers)
+
+
+def relayEtag(relays):
+    return '-'.join('{}:{}'.format(relay.controls, int(relay.state)) for relay in relays)
 
 
 @app.route('/api/relays')
 def allRelays():
-    return {
+    body = {
         'relays': [relay.info for relay in relays]
     }
+    return conditionalResponse(body, relayEtag(relays))
 
 
 @app.route('/api/relay/<name>', methods=['GET', 'POST'])
@@ -79,52 +215,261 @@ def relay(name):
         # toggle the other opposing heating/cooling relay if
         # the other changes. This prevents cooling and
         # heating running at same time by api request
-        opposingRelay = BrewRelay.getOppositeRelayByName(relays, name)
+        chamber = BrewChamber.getChamberOfRelay(chambers, relay)
+        if chamber:
+            opposingRelay = chamber.oppositeRelay(relay)
+        else:
+            opposingRelay = BrewRelay.getOppositeRelayByName(relays, name)
         if opposingRelay and opposingRelay.state is True:
             opposingRelay.set(False)
 
-    return relay.info
+        notifier.notify('relay', controls=relay.controls, state=relay.state)
+        return relay.info
 
+    return conditionalResponse(relay.info, relayEtag([relay]))
 
-def relayState():
-    tempRelays = [BrewRelay.getRelayByName(
-        relays, 'heating'), BrewRelay.getRelayByName(relays, 'cooling')]
 
-    for relay in tempRelays:
-        if relay.state is False:
-            continue
-        return relay.controls
-    return 'idle'
+def chamberInfo(chamber):
+    return {
+        'name': chamber.name,
+        'state': chamber.state,
+        'goal': db.getChamberGoal(chamber.name),
+        'sensor': chamber.sensor.location,
+        'ambient': chamber.ambient.location if chamber.ambient else None,
+        'relays': [relay.controls for relay in chamber.relays]
+    }
+
 
+def chamberNotFound(name):
+    return {
+        'success': False,
+        'message': 'chamber {} not found, check /chambers'.format(name)
+    }, 404
 
+
+def setChamberGoal(chamber, goal):
+    try:
+        goal = float(goal)
+    except ValueError:
+        return {
+            'success': False,
+            'message': 'target temperature {} is not a number'.format(goal)
+        }, 400
+
+    success = db.setChamberGoal(chamber.name, goal)
+
+    if not success:
+        return {
+            'success': False,
+            'message': 'unable to set target temperature'
+        }, 500
+
+    notifier.notify('setpoint', chamber=chamber.name, goal=goal)
+    publisher.publish('setpoint', {'chamber': chamber.name, 'goal': goal}, key=chamber.name)
+
+    return {
+        'success': True,
+        'message': 'set target temperature of {} to {}'.format(chamber.name, goal)
+    }
+
+
+@app.route('/api/chambers')
+def allChambers():
+    body = {
+        'chambers': [chamberInfo(chamber) for chamber in chambers]
+    }
+    etag = '-'.join('{}:{}:{}'.format(info['name'], info['state'], info['goal']) for info in body['chambers'])
+    return conditionalResponse(body, etag)
+
+
+@app.route('/api/chamber/<name>')
+def getChamber(name):
+    chamber = BrewChamber.getChamberByName(chambers, name)
+    if not chamber:
+        return chamberNotFound(name)
+
+    info = chamberInfo(chamber)
+    return conditionalResponse(info, '{}:{}:{}'.format(info['name'], info['state'], info['goal']))
+
+
+@app.route('/api/chamber/<name>/regulator/<goal>', methods=['POST'])
+def chamberGoalUpdate(name, goal):
+    chamber = BrewChamber.getChamberByName(chambers, name)
+    if not chamber:
+        return chamberNotFound(name)
+
+    return setChamberGoal(chamber, goal)
+
+
+def noChambers():
+    return {
+        'success': False,
+        'message': 'no chambers regulated, check chambers in brew.yaml'
+    }, 404
+
+
+# the regulator routes act on the first chamber, as before chambers
 @app.route('/api/regulator')
 def regulatorState():
-    state = relayState()
-    goalTemp = db.get(getTargetTemperatureQuery)
+    if not chambers:
+        return noChambers()
 
-    return {
+    state = chambers[0].state
+    goalTemp = db.getChamberGoal(chambers[0].name)
+
+    body = {
         'state': state,
         'goal': goalTemp
     }
+    return conditionalResponse(body, '{}:{}'.format(state, goalTemp))
+
+
+@app.route('/assets/capture.jpg')
+def cameraCapture():
+    timestamp, frame = camera.latest if camera else (None, None)
+    if frame is not None:
+        response = Response(frame, mimetype='image/jpeg')
+        response.set_etag('frame:{}'.format(timestamp))
+        response.last_modified = timestamp
+        response.cache_control.max_age = camera.interval
+        return response.make_conditional(request)
+
+    # without a camera in this process, serve the last capture on disk
+    path = os.path.abspath('assets/capture.jpg')
+    if not os.path.exists(path):
+        return {
+            'success': False,
+            'message': 'no camera capture yet'
+        }, 404
 
+    return send_file(path, mimetype='image/jpeg', conditional=True, max_age=cameraConfig.get('interval', 10))
 
-@app.route('/api/regulator/<goal>', methods=['POST'])
-def regulatorGoal(goal):
-    query = 'update regulator set target_temperature = {}'
-    query = query.format(goal)
-    success = db.write(query)
 
-    if not success:
+@app.route('/api/camera/stream')
+def cameraStream():
+    if camera is None:
         return {
             'success': False,
-            'message': 'unable to set target temperature'
-        }, 500
+            'message': 'camera is not enabled, check camera in config.yaml'
+        }, 404
+
+    headers = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    return Response(camera.mjpeg(), mimetype='multipart/x-mixed-replace; boundary=frame', headers=headers)
+
+
+@app.route('/api/camera/frames')
+def cameraFrames():
+    if camera is None or camera.archive is None:
+        return {
+            'success': False,
+            'message': 'timelapse archive is not enabled, check camera in config.yaml'
+        }, 404
+
+    try:
+        end = float(request.args.get('to', time.time()))
+        start = float(request.args.get('from', end - 86400))
+        limit = int(request.args.get('limit', 1000))
+    except ValueError as error:
+        return {
+            'success': False,
+            'message': 'from, to and limit must be numbers: {}'.format(error)
+        }, 400
+
+    frames = camera.archive.frames(start, end, limit)
+    for frame in frames:
+        frame['url'] = '/api/camera/frames/{}'.format(frame['timestamp'])
 
     return {
-        'success': True,
-        'message': 'set target temperature to {}'.format(goal)
+        'frames': frames
     }
 
 
+@app.route('/api/camera/frames/<int:timestamp>')
+def cameraFrame(timestamp):
+    thumbnail = request.args.get('thumbnail', 'false').lower() in ('1', 'true')
+    sizes = None if camera is None or camera.archive is None else camera.archive.sizesOf(timestamp)
+    if sizes is None:
+        return {
+            'success': False,
+            'message': 'frame {} not found, check /api/camera/frames'.format(timestamp)
+        }, 404
+
+    if thumbnail and sizes[1] == 0:
+        return {
+            'success': False,
+            'message': 'frame {} has no thumbnail, request it without thumbnail'.format(timestamp)
+        }, 404
+
+    # archived frames never change
+    path = os.path.abspath(camera.archive.path(timestamp, thumbnail))
+    return send_file(path, mimetype='image/jpeg', conditional=True, max_age=31536000)
+
+
+@app.route('/api/regulator/<goal>', methods=['POST'])
+def regulatorGoal(goal):
+    if not chambers:
+        return noChambers()
+
+    return setChamberGoal(chambers[0], goal)
+
+
+# Live stream
+def publishDatabaseChanges():
+    # relays toggled and goals set by the regulator process only show up
+    # in the database, publish the ones this process has not published
+    global streamVersion
+    version = db.dataVersion
+    if version == streamVersion:
+        return
+    streamVersion = version
+
+    for relay in relays:
+        last = publisher.last('relay', relay.controls)
+        if last is None or last['state'] != relay.state:
+            publisher.publish('relay', {'controls': relay.controls, 'state': relay.state}, key=relay.controls)
+
+    for chamber in chambers:
+        goal = db.getChamberGoal(chamber.name)
+        last = publisher.last('setpoint', chamber.name)
+        if last is None or last['goal'] != goal:
+            publisher.publish('setpoint', {'chamber': chamber.name, 'goal': goal}, key=chamber.name)
+
+
+def openStream():
+    # the samplers publish sensor events, the database is only watched while someone listens
+    with streamLock:
+        if len(streamJobs) == 0:
+            publishDatabaseChanges()
+            streamJobs.append(scheduler.every(1, publishDatabaseChanges, name='stream database changes'))
+
+        return publisher.subscribe(size=100)
+
+
+def closeStream(subscription):
+    with streamLock:
+        publisher.unsubscribe(subscription)
+        if publisher.subscribers == 0:
+            for job in streamJobs:
+                scheduler.cancel(job)
+            streamJobs.clear()
+
+
+@app.route('/api/stream')
+def stream():
+    subscription = openStream()
+
+    def events():
+        try:
+            while True:
+                message = subscription.get(timeout=15)
+                # comment line keeps proxies from closing an idle stream
+                yield message if message is not None else ': keep-alive\n\n'
+        finally:
+            closeStream(subscription)
+
+    headers = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    return Response(events(), mimetype='text/event-stream', headers=headers)
+
+
 if __name__ == '__main__':
     app.run(host='0.0.0.0')
@@ -7,4 +7,51 @@ CREATE TABLE IF NOT EXISTS regulator (
   target_temperature REAL
 );
 
+CREATE TABLE IF NOT EXISTS chamber (
+  name TEXT PRIMARY KEY,
+  target_temperature REAL
+);
+
+CREATE TABLE IF NOT EXISTS readings (
+  id INTEGER PRIMARY KEY AUTOINCREMENT,
+  timestamp REAL,
+  location TEXT,
+  metric TEXT,
+  value REAL
+);
+
+CREATE INDEX IF NOT EXISTS readings_location_timestamp ON readings (location, timestamp);
+
+CREATE TABLE IF NOT EXISTS readings_1m (
+  location TEXT,
+  metric TEXT,
+  bucket INTEGER,
+  min REAL,
+  max REAL,
+  mean REAL,
+  count INTEGER,
+  PRIMARY KEY (location, metric, bucket)
+) WITHOUT ROWID;
+
+CREATE INDEX IF NOT EXISTS readings_1m_bucket ON readings_1m (bucket);
+
+CREATE TABLE IF NOT EXISTS readings_1h (
+  location TEXT,
+  metric TEXT,
+  bucket INTEGER,
+  min REAL,
+  max REAL,
+  mean REAL,
+  count INTEGER,
+  PRIMARY KEY (location, metric, bucket)
+) WITHOUT ROWID;
+
+CREATE INDEX IF NOT EXISTS readings_1h_bucket ON readings_1h (bucket);
+
+CREATE TABLE IF NOT EXISTS rollup_state (
+  name TEXT PRIMARY KEY,
+  last_id INTEGER
+);
+
 INSERT INTO regulator (target_temperature) values (5.2);
+INSERT OR IGNORE INTO chamber (name, target_temperature) values ('default', 5.2);
@@ -0,0 +1,57 @@
+import json
+import logging
+import time
+
+# local packages
+import source
+from logger import logger
+from brewSensor import MockSensor, SimulatedSensor
+from controllers import BrewController
+from simulation import VirtualClock, SimulatedRelay, FermentationSimulation
+from utils import getConfig
+from regulator import args, BrewRegulator
+
+'''
+Runs the regulator against a simulated fermenter on a virtual clock and
+prints how well it held the goal. Takes the same arguments as
+regulator.py, plus --days to simulate and --controller to compare:
+
+    python3 simulate.py 18 0.5 60 --days 14 --controller adaptive
+
+Nothing touches the GPIO pins or relay table, the room temperature is
+a mock outside sensor.
+'''
+
+
+def main():
+    if not args.debug:
+        logger.setLevel(logging.WARNING)
+
+    clock = VirtualClock(time.time())
+    coolingRelay = SimulatedRelay(1000, 'cooling')
+    heatRelay = SimulatedRelay(1001, 'heating')
+
+    outsideSensor = MockSensor(0, 'outside', args.interval)
+    insideSensor = SimulatedSensor('inside', 10, heatRelay.pin, coolingRelay.pin,
+                                   ambient=lambda: outsideSensor.temp, temperature=outsideSensor.temp,
+                                   clock=clock)
+
+    regulatorConfig = dict(getConfig().get('regulator', {}))
+    if args.controller:
+        regulatorConfig['controller'] = args.controller
+    controller = BrewController.fromConfig(regulatorConfig)
+
+    regulator = BrewRegulator(
+        insideSensor, coolingRelay, heatRelay, args.limit, args.interval, controller, clock)
+    regulator.target = args.temp
+
+    simulation = FermentationSimulation(regulator, insideSensor.plant, clock)
+    started = time.time()
+    report = simulation.run(args.days * 86400)
+    report['wallSeconds'] = round(time.time() - started, 2)
+
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,197 @@
+import bisect
+import os
+import struct
+import threading
+import time
+from datetime import datetime, timezone
+
+from logger import logger
+from scheduler import scheduler
+
+'''
+Timelapse archive of camera frames on disk.
+
+Frames and their thumbnails are stored in one directory per day and
+listed in an append-only index file of fixed size records, timestamp in
+milliseconds and the frame and thumbnail sizes. The index is kept in
+memory as sorted arrays, so a time range is looked up by bisection
+without listing directories, and the paths follow from the timestamps.
+
+Thinning keeps every frame for the first thinAfterHours, then one frame
+per thinInterval seconds, deletes frames older than maxDays and finally
+the oldest frames until the archive fits in maxBytes. The index is then
+rewritten to a temporary file and swapped in.
+'''
+
+RECORD = struct.Struct('<QII')
+
+
+class FrameArchive():
+    def __init__(self, directory='timelapse', maxBytes=2000 * 1024 * 1024,
+                 thinAfterHours=24, thinInterval=600, maxDays=30):
+        self.directory = directory
+        self.maxBytes = maxBytes
+        self.thinAfterHours = thinAfterHours
+        self.thinInterval = thinInterval
+        self.maxDays = maxDays
+        self.indexPath = os.path.join(directory, 'index.bin')
+        self.lock = threading.Lock()
+        self.job = None
+
+        self.timestamps = []
+        self.sizes = []
+        os.makedirs(self.directory, exist_ok=True)
+        self.loadIndex()
+
+    def loadIndex(self):
+        if not os.path.exists(self.indexPath):
+            return
+
+        with open(self.indexPath, 'rb') as file:
+            data = file.read()
+
+        # a record torn by a crash while appending is dropped
+        usable = len(data) - len(data) % RECORD.size
+        for timestamp, frameSize, thumbSize in RECORD.iter_unpack(data[:usable]):
+            self.timestamps.append(timestamp)
+            self.sizes.append((frameSize, thumbSize))
+
+        if usable != len(data):
+            self.writeIndex()
+
+    def writeIndex(self):
+        temporary = self.indexPath + '.tmp'
+        with open(temporary, 'wb') as file:
+            for timestamp, (frameSize, thumbSize) in zip(self.timestamps, self.sizes):
+                file.write(RECORD.pack(timestamp, frameSize, thumbSize))
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temporary, self.indexPath)
+
+    def path(self, timestamp, thumbnail=False):
+        day = datetime.fromtimestamp(timestamp / 1000, timezone.utc).strftime('%Y-%m-%d')
+        name = '{}.thumb.jpg'.format(timestamp) if thumbnail else '{}.jpg'.format(timestamp)
+        return os.path.join(self.directory, day, name)
+
+    @property
+    def size(self):
+        return sum(frameSize + thumbSize for frameSize, thumbSize in self.sizes)
+
+    @property
+    def latestTimestamp(self):
+        return self.timestamps[-1] / 1000 if self.timestamps else None
+
+    def add(self, timestamp, frame, thumbnail=b''):
+        timestamp = int(timestamp * 1000)
+
+        with self.lock:
+            if self.timestamps and timestamp <= self.timestamps[-1]:
+                return False
+
+            os.makedirs(os.path.dirname(self.path(timestamp)), exist_ok=True)
+            with open(self.path(timestamp), 'wb') as file:
+                file.write(frame)
+            if thumbnail:
+                with open(self.path(timestamp, True), 'wb') as file:
+                    file.write(thumbnail)
+
+            # the record is only added once the files it points to are written
+            with open(self.indexPath, 'ab') as file:
+                file.write(RECORD.pack(timestamp, len(frame), len(thumbnail)))
+
+            self.timestamps.append(timestamp)
+            self.sizes.append((len(frame), len(thumbnail)))
+            return True
+
+    def frames(self, start, end, limit=1000):
+        with self.lock:
+            first = bisect.bisect_left(self.timestamps, int(start * 1000))
+            last = bisect.bisect_right(self.timestamps, int(end * 1000))
+            records = list(zip(self.timestamps[first:last], self.sizes[first:last]))
+
+        # spread the limit over the whole range instead of cutting it off
+        step = max(len(records) / limit, 1) if limit > 0 else 1
+        selected = [records[int(index * step)] for index in range(int(len(records) / step))]
+
+        return [{
+            'timestamp': timestamp,
+            'size': frameSize,
+            'thumbnail': thumbSize > 0
+        } for timestamp, (frameSize, thumbSize) in selected]
+
+    def sizesOf(self, timestamp):
+        # frame and thumbnail size of an archived frame, None if not archived
+        with self.lock:
+            index = bisect.bisect_left(self.timestamps, timestamp)
+            if index < len(self.timestamps) and self.timestamps[index] == timestamp:
+                return self.sizes[index]
+        return None
+
+    def spawnBackgroundThinning(self, interval=3600):
+        self.job = scheduler.every(interval, self.thin, name='timelapse thinning')
+
+    def keep(self, now):
+        thinCutoff = (now - self.thinAfterHours * 3600) * 1000
+        expireCutoff = (now - self.maxDays * 86400) * 1000 if self.maxDays > 0 else 0
+        keep = []
+        lastBucket = None
+
+        for index, timestamp in enumerate(self.timestamps):
+            if timestamp < expireCutoff:
+                continue
+            if timestamp < thinCutoff and self.thinInterval > 0:
+                bucket = timestamp // (self.thinInterval * 1000)
+                if bucket == lastBucket:
+                    continue
+                lastBucket = bucket
+            keep.append(index)
+
+        total = sum(sum(self.sizes[index]) for index in keep)
+        oldest = 0
+        while oldest < len(keep) and total > self.maxBytes:
+            total -= sum(self.sizes[keep[oldest]])
+            oldest += 1
+
+        return keep[oldest:]
+
+    def thin(self, now=None):
+        now = now or time.time()
+
+        with self.lock:
+            keep = set(self.keep(now))
+            removed = [timestamp for index, timestamp in enumerate(self.timestamps) if index not in keep]
+            if len(removed) == 0:
+                return 0
+
+            self.timestamps = [timestamp for index, timestamp in enumerate(self.timestamps) if index in keep]
+            self.sizes = [size for index, size in enumerate(self.sizes) if index in keep]
+            self.writeIndex()
+
+        # files are deleted after the index stops pointing at them
+        directories = set()
+        for timestamp in removed:
+            for thumbnail in (False, True):
+                path = self.path(timestamp, thumbnail)
+                directories.add(os.path.dirname(path))
+                if os.path.exists(path):
+                    os.remove(path)
+
+        for directory in directories:
+            if os.path.isdir(directory) and len(os.listdir(directory)) == 0:
+                os.rmdir(directory)
+
+        logger.info('Thinned timelapse archive', es={
+            'removed': len(removed),
+            'frames': len(self.timestamps),
+            'bytes': self.size
+        })
+        return len(removed)
+
+    @staticmethod
+    def fromConfig(config):
+        return FrameArchive(
+            directory=config.get('directory', 'timelapse'),
+            maxBytes=config.get('max_mb', 2000) * 1024 * 1024,
+            thinAfterHours=config.get('thin_after_hours', 24),
+            thinInterval=config.get('thin_interval', 600),
+            maxDays=config.get('max_days', 30))
@@ -0,0 +1,98 @@
+import asyncio
+import json
+import re
+from http import HTTPStatus
+
+from logger import logger
+
+'''
+Minimal HTTP/1.1 JSON server on asyncio streams for the single process
+runtime. Routes are registered with a method list and a path pattern
+where <name> segments are passed to the handler as keyword arguments,
+the same path can be registered once per method.
+Handlers are coroutines returning a dict, or a (dict, status) tuple like
+the flask routes in server.py.
+'''
+class AsyncHTTPServer():
+    def __init__(self):
+        self.routes = []
+
+    def route(self, path, methods=['GET']):
+        pattern = re.compile('^' + re.sub(r'<(\w+)>', r'(?P<\1>[^/]+)', path) + '$')
+
+        def register(handler):
+            self.routes.append((pattern, methods, handler))
+            return handler
+        return register
+
+    async def dispatch(self, method, path):
+        pathMatched = False
+
+        for pattern, methods, handler in self.routes:
+            match = pattern.match(path)
+            if match is None:
+                continue
+
+            pathMatched = True
+            if method not in methods:
+                continue
+
+            try:
+                return await handler(**match.groupdict())
+            except Exception as error:
+                logger.error('Async API handler failed', es={
+                    'path': path,
+                    'error': str(error),
+                    'exception': error.__class__.__name__
+                })
+                return ({'success': False, 'message': str(error)}, 500)
+
+        if pathMatched:
+            return ({'success': False, 'message': 'method {} not allowed'.format(method)}, 405)
+        return ({'success': False, 'message': 'path {} not found'.format(path)}, 404)
+
+    async def handleConnection(self, reader, writer):
+        try:
+            while True:
+                requestLine = await reader.readline()
+                if not requestLine:
+                    break
+
+                method, target, version = requestLine.decode('latin-1').split(' ', 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    key, _, value = line.decode('latin-1').partition(':')
+                    headers[key.strip().lower()] = value.strip()
+
+                # request bodies are not used by any route, skip them
+                length = int(headers.get('content-length', 0))
+                if length:
+                    await reader.readexactly(length)
+
+                result = await self.dispatch(method, target.split('?', 1)[0])
+                body, status = result if isinstance(result, tuple) else (result, 200)
+                payload = json.dumps(body).encode('utf8')
+
+                keepAlive = headers.get('connection', '').lower() != 'close' and 'HTTP/1.1' in version
+                writer.write('HTTP/1.1 {} {}\r\n'.format(status, HTTPStatus(status).phrase).encode('latin-1'))
+                writer.write(b'Content-Type: application/json\r\n')
+                writer.write('Content-Length: {}\r\n'.format(len(payload)).encode('latin-1'))
+                writer.write(b'Connection: keep-alive\r\n\r\n' if keepAlive else b'Connection: close\r\n\r\n')
+                writer.write(payload)
+                await writer.drain()
+
+                if not keepAlive:
+                    break
+        except (ConnectionError, ValueError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host='0.0.0.0', port=5000):
+        server = await asyncio.start_server(self.handleConnection, host, port)
+        logger.info('Async API listening on {}:{}'.format(host, port))
+        async with server:
+            await server.serve_forever()
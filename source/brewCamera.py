@@ -1,49 +1,238 @@
-import os
-import time
-import picamera
+import io
 import threading
+import time
 from datetime import datetime
 
+from __init__ import mock
 from logger import logger
+from scheduler import scheduler
+from archive import FrameArchive
+from database import getReadings
+
+try:
+    import picamera
+except ModuleNotFoundError as error:
+    if mock == True:
+        logger.warning('picamera module not found, running with mock camera.\n')
+        import mockCamera as picamera
+    else:
+        logger.error(
+            'picamera module not found, install or run program with flag --mock argument!\n')
+        raise error
+
 
+'''
+Camera kept open between captures. The session is opened and warmed up
+once, every capture goes through the video port into a reused in-memory
+buffer and becomes the latest frame, which the api serves and streams
+as MJPEG without touching the SD card.
+
+While MJPEG clients are watching, captures run every streamInterval
+seconds instead of every interval. Given an archive, a frame and a
+thumbnail scaled by the camera from the same frame are archived at most
+every interval.
+Given a frame difference, every capture is scored for activity, which
+is stored as telemetry like a sensor reading, and frames that did not
+change since the last archived one are not archived.
+'''
 class BrewCamera():
-    def __init__(self, interval=10):
-        self.lastCaptureTimestamp = None
+    def __init__(self, interval=10, streamInterval=1, resolution=(1297, 972), rotation=180,
+                 archive=None, thumbnailSize=(320, 240), difference=None):
         self.interval = interval
-        self.warmupTime = 0.3
+        self.streamInterval = streamInterval
+        self.resolution = resolution
+        self.rotation = rotation
+        self.archive = archive
+        self.thumbnailSize = thumbnailSize
+        self.difference = difference
+        self.activity = None
+        self.warmupTime = 2
+        self.job = None
+
+        self.camera = None
+        self.buffer = io.BytesIO()
+        self.thumbnailBuffer = io.BytesIO()
+        self.yuvBuffer = io.BytesIO()
+        self.frame = None
+        self.frameTimestamp = None
+        self.sequence = 0
+        self.viewers = 0
+        self.condition = threading.Condition()
+        self.cameraLock = threading.Lock()
 
     def spawnBackgroundCapture(self):
-        thread = threading.Thread(target=self.captureOnIntervalForever, args=())
-        thread.daemon = True
-        thread.start()
-        logger.info("spawned camera capture daemon at interval: {}".format(self.interval))
+        self.job = scheduler.every(self.interval, self.capture, name='camera capture')
+        if self.archive is not None:
+            self.archive.spawnBackgroundThinning()
+
+    @property
+    def archiveDue(self):
+        if self.archive is None:
+            return False
+
+        latest = self.archive.latestTimestamp
+        # a little slack so captures at exactly the interval are not skipped
+        return latest is None or time.time() - latest >= self.interval * 0.9
 
-    def captureOnIntervalForever(self):
-        while True:
-            time.sleep(self.interval - self.warmupTime)
-            self.capture()
+    def open(self):
+        camera = picamera.PiCamera()
+        camera.resolution = self.resolution
+        camera.rotation = self.rotation
+        camera.annotate_background = picamera.Color('black')
+        camera.annotate_text_size = 50 # (values 6 to 160, default is 32)
+
+        # Camera warm-up time, only once for the session
+        time.sleep(self.warmupTime)
+        self.camera = camera
+        logger.info('Opened camera session', es={'resolution': list(self.resolution)})
+
+    def close(self):
+        with self.cameraLock:
+            if self.camera is not None:
+                self.camera.close()
+                self.camera = None
 
     def capture(self):
-        try:
-            logger.debug('Capturing image')
-            with picamera.PiCamera() as camera:
-                camera.resolution = (1297, 972)
-                camera.rotation = 180
-                camera.annotate_background = picamera.Color('black')
-                camera.annotate_text_size = 50 # (values 6 to 160, default is 32)
-                camera.annotate_text = datetime.now().strftime('%A %d %b %Y %H:%M:%S')
-
-                # Camera warm-up time
-                time.sleep(self.warmupTime)
-                camera.capture('assets/foo.jpg')
-                self.lastCaptureTime = datetime.now()
-                os.replace('assets/foo.jpg', 'assets/capture.jpg')
-
-        except picamera.exc.PiCameraMMALError as error:
-            logger.error('Picamera MMAL exception. Retrying picture in 1 second', es={
-                'error': str(error),
-                'exception': error.__class__.__name__
+        with self.cameraLock:
+            try:
+                if self.camera is None:
+                    self.open()
+
+                logger.debug('Capturing image')
+                self.camera.annotate_text = datetime.now().strftime('%A %d %b %Y %H:%M:%S')
+
+                # the scaled captures run on their own splitter ports next to
+                # the frame, so all of them come from the same camera frame
+                outputs = [(self.buffer, 'jpeg', None)]
+                if self.difference is not None:
+                    outputs.append((self.yuvBuffer, 'yuv', self.difference.size))
+                archiving = self.archiveDue
+                if archiving:
+                    outputs.append((self.thumbnailBuffer, 'jpeg', self.thumbnailSize))
+
+                self.captureTogether(outputs)
+                frame = self.buffer.getvalue()
+
+                duplicate = False
+                if self.difference is not None:
+                    self.activity, duplicate = self.difference.update(self.yuvBuffer.getvalue())
+
+                thumbnail = None
+                if archiving and not duplicate:
+                    thumbnail = self.thumbnailBuffer.getvalue()
+
+            except picamera.exc.PiCameraMMALError as error:
+                logger.error('Picamera MMAL exception. Reopening camera next capture', es={
+                    'error': str(error),
+                    'exception': error.__class__.__name__
+                })
+                if self.camera is not None:
+                    self.camera.close()
+                self.camera = None
+                return None
+
+        timestamp = time.time()
+        with self.condition:
+            self.frame = frame
+            self.frameTimestamp = timestamp
+            self.sequence += 1
+            self.condition.notify_all()
+
+        if self.difference is not None:
+            logger.info('Camera activity', es={
+                'location': 'camera',
+                'activity': self.activity,
+                'duplicate': duplicate
             })
-            time.sleep(1)
-            self.capture()
+            getReadings().add('camera', {'activity': self.activity}, timestamp)
+
+        if thumbnail is not None and self.archive.add(timestamp, frame, thumbnail):
+            if self.difference is not None:
+                self.difference.keep()
+        return frame
+
+    def captureTogether(self, outputs):
+        errors = []
+
+        def captureOn(port, output, format, resize):
+            output.seek(0)
+            output.truncate()
+            try:
+                self.camera.capture(output, format=format, use_video_port=True,
+                                    resize=resize, splitter_port=port)
+            except Exception as error:
+                errors.append(error)
+
+        threads = [threading.Thread(target=captureOn, args=(port, *output))
+                   for port, output in enumerate(outputs) if port > 0]
+        for thread in threads:
+            thread.start()
+        captureOn(0, *outputs[0])
+        for thread in threads:
+            thread.join()
+
+        if errors:
+            raise errors[0]
+
+    @property
+    def latest(self):
+        with self.condition:
+            return (self.frameTimestamp, self.frame)
+
+    def watch(self):
+        if self.job is not None and self.viewers == 0:
+            scheduler.reschedule(self.job, self.streamInterval)
+        self.viewers += 1
+
+    def unwatch(self):
+        self.viewers -= 1
+        if self.job is not None and self.viewers == 0:
+            scheduler.reschedule(self.job, self.interval)
+
+    def mjpeg(self, timeout=30):
+        '''
+        Generator of multipart/x-mixed-replace parts, one for every new
+        frame. Ends when no frame arrives within timeout seconds.
+        '''
+        with self.condition:
+            self.watch()
+        try:
+            sequence = None
+            while True:
+                with self.condition:
+                    if sequence == self.sequence or self.frame is None:
+                        self.condition.wait(timeout)
+                    if sequence == self.sequence or self.frame is None:
+                        return
+                    frame, sequence = self.frame, self.sequence
+
+                yield (b'--frame\r\nContent-Type: image/jpeg\r\nContent-Length: '
+                       + str(len(frame)).encode('latin-1') + b'\r\n\r\n' + frame + b'\r\n')
+        finally:
+            with self.condition:
+                self.unwatch()
+
+    @staticmethod
+    def fromConfig(config):
+        archive = None
+        archiveConfig = config.get('archive', {})
+        if archiveConfig.get('enabled'):
+            archive = FrameArchive.fromConfig(archiveConfig)
+
+        difference = None
+        activityConfig = config.get('activity', {})
+        if activityConfig.get('enabled'):
+            from frameDifference import FrameDifference
+            difference = FrameDifference(
+                size=tuple(activityConfig.get('size', (64, 48))),
+                threshold=activityConfig.get('threshold', 12),
+                minimumChange=activityConfig.get('minimum_change', 0.01))
 
+        return BrewCamera(
+            interval=config.get('interval', 10),
+            streamInterval=config.get('stream_interval', 1),
+            resolution=tuple(config.get('resolution', (1297, 972))),
+            rotation=config.get('rotation', 180),
+            archive=archive,
+            thumbnailSize=tuple(archiveConfig.get('thumbnail_size', (320, 240))),
+            difference=difference)
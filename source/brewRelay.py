@@ -1,7 +1,8 @@
 from __init__ import mock
 
 from logger import logger
-from database import BrewDatabase
+from database import BrewDatabase, getReadings
+from publisher import publisher
 
 db = BrewDatabase()
 
@@ -23,6 +24,8 @@ class BrewRelay():
         GPIO.setmode(GPIO.BCM)
         self.pin = pin
         self.controls = controls
+        self.cachedState = None
+        self.cachedVersion = None
 
         self.addIfMissingFromDB()
 
@@ -31,9 +34,20 @@ class BrewRelay():
 
     @property
     def state(self):
-        query = 'select state from relay where pin = {}'.format(self.pin)
+        # data_version only changes when another connection, e.g. the
+        # server or regulator process, commits to the database. Until
+        # then the state we last read or wrote ourselves is current.
+        version = db.dataVersion
+        if self.cachedState is None or version != self.cachedVersion:
+            self.cachedState = self.readStateFromDB()
+            self.cachedVersion = version
 
-        value = db.get(query)
+        return self.cachedState
+
+    def readStateFromDB(self):
+        query = 'select state from relay where pin = ?'
+
+        value = db.get(query, (self.pin,))
         if value is None:
             return False
 
@@ -48,9 +62,9 @@ class BrewRelay():
         }
 
     def saveStateToDB(self, state):
-        query = 'update relay set state = {} where pin = {}'
-        query = query.format(state, self.pin)
-        db.write(query)
+        query = 'update relay set state = ? where pin = ?'
+        if db.write(query, (state, self.pin)):
+            self.cachedState = bool(state)
 
     def set(self, state, setup=False):
         GPIO.output(self.pin, not state)  # for some reason this is negated
@@ -62,24 +76,21 @@ class BrewRelay():
                         'relayState': state, 'relayType': self.controls})
 
         self.saveStateToDB(state)
+        # relay history next to the sensor readings, the adaptive controller learns from both
+        getReadings().add('relay', {self.controls: 1 if state else 0})
+        publisher.publish('relay', {'controls': self.controls, 'state': bool(state)}, key=self.controls)
 
     def toggle(self):
-        self.set(not state)
+        self.set(not self.state)
 
     def addIfMissingFromDB(self):
-        query = 'select state from relay where pin = {}'
-        query = query.format(self.pin)
-        value = db.get(query)
+        query = 'select state from relay where pin = ?'
+        value = db.get(query, (self.pin,))
         if value is not None:
             return
 
-        query = 'insert into relay (pin, state, controls) values ({}, {}, "{}")'
-        query = query.format(self.pin, self.state, self.controls)
-        db.write(query)
-
-    @staticmethod
-    def fromYaml(loader, node):
-        return BrewRelay(**loader.construct_mapping(node))
+        query = 'insert into relay (pin, state, controls) values (?, ?, ?)'
+        db.write(query, (self.pin, self.state, self.controls))
 
     @staticmethod
     def getOppositeRelayByName(relays, name):
@@ -1,66 +1,176 @@
-import threading
 import time
 from random import uniform
 
 from logger import logger
+from database import getReadings
+from ringBuffer import RingBuffer
+from snapshot import SensorSnapshot
+from utils import getConfig
+from scheduler import scheduler
+from publisher import publisher
+from simulation import FermenterPlant
+
 
 '''
 Generic sensor class that should always be extended.
+
+Subclasses list the metrics they measure and implement sample, which
+reads all of them from the hardware in one transaction. Every sample
+becomes an immutable SensorSnapshot and is kept in a ring buffer, so the
+latest snapshot and short windows can be read without touching the bus.
+
+Metrics with filters configured also get a filtered snapshot, computed
+over the recent samples in the buffer. Both are exposed, consumers
+reacting to the readings, like the regulator, ask for the filtered one.
 '''
 class BrewSensor():
-    def __init__(self, location, interval=2):
+    metrics = ('temperature',)
+
+    def __init__(self, location, interval=2, bufferSize=300, clock=time):
         self.location = location
         self.interval = interval
-        self.thread = None
+        self.clock = clock
+        self.job = None
+        self.snapshot = None
+        self.filtered = None
+        self.configureFilters(getConfig().get('filters') or {})
+        self.buffer = RingBuffer(self.metrics, bufferSize)
 
     def spawnBackgroundSensorLog(self):
-        self.thread = threading.Thread(target=self.logSensorOnIntervalForever, args=())
-        self.thread.daemon = True
-        self.thread.start()
-        logger.info("spawned background sensor {} log at interval: {}".format(self.location, self.interval))
-
-    def logSensorOnIntervalForever(self):
-        while True:
-            try:
-                self.logReadings()
-            except Exception as error:
-                logger.error('Sensor log daemon failed, sleeping and trying again', es={
-                    'location': self.location,
-                    'error': str(error),
-                    'exception': error.__class__.__name__
-                })
-                time.sleep(2)
-
-            time.sleep(self.interval)
+        name = 'sensor {} log'.format(self.location)
+        self.job = scheduler.every(self.interval, self.logReadings, name=name)
+
+    def spawnBackgroundSampling(self):
+        # keeps the buffer current without logging, for processes serving
+        # readings while the regulator logs them
+        name = 'sensor {} sampling'.format(self.location)
+        self.job = scheduler.every(self.interval, self.update, name=name)
 
     @staticmethod
     def getSensorByItsLocation(sensors, location):
         return next(( sensor for sensor in sensors if sensor.location == location), None)
 
+    def configureFilters(self, config):
+        # pipelines are rebuilt from the new stages on the next sample
+        self.filterWindow = config.get('window', 30)
+        self.filters = {metric: config[metric] for metric in self.metrics if config.get(metric)}
+        self.pipelines = None
+
+    def filterPipelines(self):
+        # built on the first sample, numpy is slow to import at startup
+        if self.pipelines is None:
+            from filters import FilterPipeline
+            self.pipelines = {metric: FilterPipeline.fromConfig(stages) for metric, stages in self.filters.items()}
+        return self.pipelines
+
+    def sample(self):
+        raise NotImplementedError
+
+    def filter(self, snapshot):
+        timestamps, columns = self.buffer.recent(self.filterWindow)
+        values = dict(snapshot.values)
+        for metric, pipeline in self.filterPipelines().items():
+            values[metric] = pipeline.latest(timestamps, columns[metric])
+
+        return SensorSnapshot(self.location, snapshot.timestamp, values)
+
+    def update(self):
+        try:
+            values = self.sample()
+        except RuntimeError as error:
+            if self.snapshot is None:
+                raise error
+
+            logger.error('Sensor read failed, returning last snapshot.', es={
+                'location': self.location,
+                'error': str(error),
+                'exception': error.__class__.__name__,
+                'age': self.snapshot.age(self.clock.time())
+            })
+            return self.snapshot
+
+        snapshot = SensorSnapshot(self.location, self.clock.time(), values)
+        self.buffer.append(snapshot.timestamp, values)
+        # filtered first, whoever sees the new snapshot also sees its filtered values
+        if self.filters:
+            self.filtered = self.filter(snapshot)
+        self.snapshot = snapshot
+
+        # metrics missing from a sample are nan, which json can not carry
+        publisher.publish('sensor', {
+            'location': self.location,
+            'values': {metric: value for metric, value in values.items() if value == value},
+            'filtered': self.filteredValues
+        }, key=self.location)
+        return snapshot
+
+    @property
+    def filteredValues(self):
+        filtered = self.filtered
+        if filtered is None:
+            return {}
+        return {metric: filtered[metric] for metric in self.filters if filtered[metric] == filtered[metric]}
+
+    def latest(self, maxAge=None, filtered=False):
+        '''
+        Latest snapshot, only read from the sensor when the last one is
+        older than maxAge seconds. Defaults to twice the interval the
+        background log samples at. With filtered the filtered snapshot is
+        returned, or the raw one when no filters are configured.
+        '''
+        maxAge = self.interval * 2 if maxAge is None else maxAge
+        snapshot = self.snapshot
+
+        if snapshot is None or not snapshot.isFresh(maxAge, self.clock.time()):
+            snapshot = self.update()
+
+        if filtered and self.filtered is not None:
+            return self.filtered
+        return snapshot
+
+    def window(self, seconds):
+        return self.buffer.window(seconds, self.clock.time())
+
+    def logReadings(self):
+        snapshot = self.update()
+
+        logger.info("Sensor readings", es={**snapshot.values, 'location': self.location})
+        getReadings().add(self.location, snapshot.values, snapshot.timestamp)
+
     @property
     def info(self):
+        return self.describe(self.latest())
+
+    def describe(self, snapshot):
         data = {
             'location': self.location,
-            'temperature': round(self.temp, 2),
+            'age': round(snapshot.age(self.clock.time()), 1),
+            'temperature': round(snapshot.temperature, 2),
             'temperature_unit': "°C"
         }
 
-        if hasattr(self, 'humidity'):
-            data['humidity'] = round(self.humidity, 2)
+        if 'humidity' in self.metrics:
+            data['humidity'] = round(snapshot.humidity, 2)
             data['humidity_unit'] = "%RH"
 
-        if hasattr(self, 'pressure'):
-            data['pressure'] = round(self.pressure, 2)
+        if 'pressure' in self.metrics:
+            data['pressure'] = round(snapshot.pressure, 2)
             data['pressure_unit'] = "bar"
 
+        filtered = self.filteredValues
+        if filtered:
+            data['filtered'] = {metric: round(value, 2) for metric, value in filtered.items()}
+
         return data
 
 class BME680Sensor(BrewSensor):
-    def __init__(self, location, interval):
+    metrics = ('temperature', 'pressure', 'humidity', 'gasResistance', 'stableHeat')
+
+    def __init__(self, location, interval, detailed=True):
         super().__init__(location, interval)
+        self.detailed = detailed
 
         self.setupSensors()
-        self.lastSensorRead = time.time()
 
     def setupSensors(self):
         import bme680
@@ -84,113 +194,55 @@ class BME680Sensor(BrewSensor):
             })
             raise error
 
-    def read(self):
-        self.lastSensorRead = time.time()
-        return self.sensor.get_sensor_data()
-
-    @property
-    def needToUpdateReadings(self):
-        return time.time() - self.lastSensorRead > 1
-
-    @property
-    def temp(self):
-        if self.needToUpdateReadings:
-            self.read()
-        return self.sensor.data.temperature
-
-    @property
-    def pressure(self):
-        if self.needToUpdateReadings:
-            self.read()
-        return self.sensor.data.pressure
-
-    @property
-    def humidity(self):
-        if self.needToUpdateReadings:
-            self.read()
-        return self.sensor.data.humidity
-
-    @property
-    def gasResistance(self):
-        if self.needToUpdateReadings:
-            self.read()
-        return self.sensor.data.gas_resistance
-
-    @property
-    def stableHeat(self):
-        if self.needToUpdateReadings:
-            self.read()
-        return self.sensor.data.heat_stable
-
-    def logReadings(self, detailed=True):
-        if self.needToUpdateReadings:
-            self.read()
+    def sample(self):
+        # one bus read fills sensor.data, every metric is taken from it
+        self.sensor.get_sensor_data()
+        data = self.sensor.data
 
         telemetry = {
-            'temperature': self.temp,
-            'pressure': self.pressure,
-            'humidity': self.humidity,
-            'location': self.location
+            'temperature': data.temperature,
+            'pressure': data.pressure,
+            'humidity': data.humidity
         }
 
-        if detailed:
-            telemetry['gasResistance'] = self.gasResistance
-            telemetry['stableHeat'] = self.stableHeat
-
-        logger.info("Sensor readings", es=telemetry)
-        return
+        if self.detailed:
+            telemetry['gasResistance'] = data.gas_resistance
+            telemetry['stableHeat'] = data.heat_stable
 
-    @staticmethod
-    def fromYaml(loader, node):
-        return BME680Sensor(**loader.construct_mapping(node))
+        return telemetry
 
     def __repr__(self):
-        return "{0:.2f} C,{1:.2f} hPa,{2:.2f} %RH".format(self.temp, self.pressure, self.humidity)
+        snapshot = self.latest()
+        return "{0:.2f} C,{1:.2f} hPa,{2:.2f} %RH".format(snapshot.temperature, snapshot.pressure, snapshot.humidity)
 
 class DHT11Sensor(BrewSensor):
+    metrics = ('temperature', 'humidity')
+
     def __init__(self, pin, location, interval):
         import adafruit_dht
         import board
 
         super().__init__(location, interval)
         self.pin = pin
-        self.temperature = 0
         self.sensor = adafruit_dht.DHT11(board.D17, use_pulseio=False)
 
-    @property
-    def temp(self):
-        try:
-            self.temperature = self.sensor.temperature or self.temperature
-            return self.temperature
-        except RuntimeError as error:
-            telemetry = {
-                'location': self.location,
-                'error': str(error),
-                'exception': error.__class__.__name__,
-                'temp': self.temperature
-            }
-            logger.error('DHT sensor got invalid checksum, returning last value.', es=telemetry)
-            return self.temperature
-
-    @property
-    def humidity(self):
-        return self.sensor.humidity
-
-    def logReadings(self):
-        telemetry = {
-            'temperature': self.temp,
-            'humidity': self.humidity,
-            'location': self.location
+    def sample(self):
+        # the driver measures at most every two seconds, so reading both
+        # right after each other returns values from the same transaction.
+        # Checksum errors raise RuntimeError and update keeps the last snapshot
+        temperature = self.sensor.temperature
+        humidity = self.sensor.humidity
+        if temperature is None or humidity is None:
+            raise RuntimeError('DHT sensor returned no reading')
+
+        return {
+            'temperature': temperature,
+            'humidity': humidity
         }
 
-        logger.info("Sensor readings", es=telemetry)
-        return
-
-    @staticmethod
-    def fromYaml(loader, node):
-        return DHT11Sensor(**loader.construct_mapping(node))
-
 class MockSensor(BrewSensor):
+    metrics = ('temperature', 'humidity')
+
     def __init__(self, pin, location, interval):
         super().__init__(location, interval)
         self.pin = pin
@@ -214,16 +266,27 @@ class MockSensor(BrewSensor):
     def humidity(self):
         return round(uniform(80, 99), 2)
 
-    def logReadings(self):
-        telemetry = {
+    def sample(self):
+        return {
             'temperature': self.temp,
-            'humidity': self.humidity,
-            'location': self.location
+            'humidity': self.humidity
         }
 
-        logger.info("Sensor readings", es=telemetry)
-        return
+class SimulatedSensor(BrewSensor):
+    '''
+    Reads the wort temperature of a simulated fermenter heated and cooled
+    by the relays on heatingPin and coolingPin, for running --mock against
+    something that reacts to the regulator.
+    '''
+    def __init__(self, location, interval, heatingPin, coolingPin, ambient=20, temperature=20, clock=time):
+        super().__init__(location, interval, clock=clock)
+        self.plant = FermenterPlant(clock, heatingPin, coolingPin, ambient, temperature)
 
-    @staticmethod
-    def fromYaml(loader, node):
-        return MockSensor(**loader.construct_mapping(node))
+    @property
+    def temp(self):
+        return round(self.plant.temperature, 2)
+
+    def sample(self):
+        return {
+            'temperature': self.temp
+        }
@@ -0,0 +1,110 @@
+from brewRelay import BrewRelay
+from brewSensor import BrewSensor
+
+'''
+A chamber is one fermenter regulated on its own: the sensor inside it,
+optionally one outside it, and the relays heating and cooling it. In
+brew.yaml chambers refer to sensors by location and relays by what they
+control, so a sensor can be shared between chambers and is only sampled
+once:
+
+    chambers:
+    - !Chamber
+      name: fridge
+      sensor: inside
+      ambient: outside
+      cooling: cooling
+      heating: heating
+
+Without chambers in brew.yaml there is one chamber named default using
+the inside sensor, the outside sensor if there is one, and the cooling
+and heating relays. Without those devices there are no chambers.
+'''
+class BrewChamber():
+    def __init__(self, name, sensor, cooling, heating, ambient=None, goal=None, limit=None):
+        self.name = name
+        self.sensorLocation = sensor
+        self.ambientLocation = ambient
+        self.coolingName = cooling
+        self.heatingName = heating
+        self.goal = goal
+        self.limit = limit
+
+        self.sensor = None
+        self.ambient = None
+        self.cooling = None
+        self.heating = None
+
+    def resolve(self, sensors, relays):
+        self.sensor = BrewSensor.getSensorByItsLocation(sensors, self.sensorLocation)
+        if self.sensor is None:
+            raise Exception('Error! Missing sensor {} for chamber {}!'.format(self.sensorLocation, self.name))
+
+        if self.ambientLocation is not None:
+            self.ambient = BrewSensor.getSensorByItsLocation(sensors, self.ambientLocation)
+            if self.ambient is None:
+                raise Exception('Error! Missing ambient sensor {} for chamber {}!'.format(
+                    self.ambientLocation, self.name))
+
+        self.cooling = BrewRelay.getRelayByName(relays, self.coolingName)
+        self.heating = BrewRelay.getRelayByName(relays, self.heatingName)
+        if self.cooling is None or self.heating is None:
+            raise Exception('Error! Missing {} or {} relay for chamber {}!'.format(
+                self.coolingName, self.heatingName, self.name))
+        return self
+
+    @property
+    def sensors(self):
+        return [sensor for sensor in (self.sensor, self.ambient) if sensor is not None]
+
+    @property
+    def relays(self):
+        return [self.cooling, self.heating]
+
+    @property
+    def state(self):
+        if self.heating.state is True:
+            return 'heating'
+        elif self.cooling.state is True:
+            return 'cooling'
+        return 'idle'
+
+    def oppositeRelay(self, relay):
+        if relay is self.heating:
+            return self.cooling
+        elif relay is self.cooling:
+            return self.heating
+        return None
+
+    @staticmethod
+    def fromPeripherals(peripherals):
+        sensors = peripherals.get('sensors') or []
+        relays = peripherals.get('relays') or []
+        chambers = peripherals.get('chambers')
+        if not chambers:
+            chambers = BrewChamber.defaultChambers(sensors, relays)
+
+        names = [chamber.name for chamber in chambers]
+        if len(set(names)) != len(names):
+            raise Exception('Error! Chamber names must be unique, got {}'.format(', '.join(names)))
+
+        return [chamber.resolve(sensors, relays) for chamber in chambers]
+
+    @staticmethod
+    def defaultChambers(sensors, relays):
+        # without the inside sensor and both relays there is nothing to regulate
+        if (BrewSensor.getSensorByItsLocation(sensors, 'inside') is None
+                or BrewRelay.getRelayByName(relays, 'cooling') is None
+                or BrewRelay.getRelayByName(relays, 'heating') is None):
+            return []
+
+        ambient = 'outside' if BrewSensor.getSensorByItsLocation(sensors, 'outside') else None
+        return [BrewChamber('default', 'inside', 'cooling', 'heating', ambient=ambient)]
+
+    @staticmethod
+    def getChamberByName(chambers, name):
+        return next((chamber for chamber in chambers if chamber.name == name), None)
+
+    @staticmethod
+    def getChamberOfRelay(chambers, relay):
+        return next((chamber for chamber in chambers if relay in chamber.relays), None)
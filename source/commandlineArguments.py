@@ -8,5 +8,9 @@ def parse():
   parser.add_argument('--mock', action='store_true', help="Mock peripheral sensors")
   parser.add_argument('--logfile', nargs='?', type=argparse.FileType('w'), help="Write log record to file")
   parser.add_argument('--debug', action='store_true', help="Console log level set to debug ")
+  parser.add_argument('--controller', choices=['bangbang', 'pid', 'adaptive'], help="Regulator controller, overrides config.yaml")
+  parser.add_argument('--days', type=float, default=14, help="Days to simulate when running simulate.py")
+  parser.add_argument('--port', type=int, default=5000, help="API port when running runtime.py")
+  parser.add_argument('--camera', action='store_true', help="Capture camera images when running runtime.py")
   args = parser.parse_args()
   return args
\ No newline at end of file
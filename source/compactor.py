@@ -0,0 +1,115 @@
+import time
+
+from logger import logger
+from database import BrewDatabase, config
+from scheduler import scheduler
+
+'''
+Rolls raw sensor readings up into 1 minute and 1 hour aggregates and
+deletes data that is older than the configured retention.
+
+Rollups are updated incrementally: each pass only aggregates raw rows
+with an id above the watermark stored from the previous pass and
+merges them into the existing buckets. Raw rows are only deleted once
+they are below the watermark, so nothing is removed before it is rolled up.
+'''
+
+ROLLUPS = {
+    'readings_1m': 60,
+    'readings_1h': 3600
+}
+
+rollupQuery = '''
+insert into {table} (location, metric, bucket, min, max, mean, count)
+select location, metric, cast(timestamp / {seconds} as integer) * {seconds},
+       min(value), max(value), avg(value), count(*)
+from readings where id > ? and id <= ?
+group by 1, 2, 3
+on conflict (location, metric, bucket) do update set
+  min = min({table}.min, excluded.min),
+  max = max({table}.max, excluded.max),
+  mean = ({table}.mean * {table}.count + excluded.mean * excluded.count)
+         / ({table}.count + excluded.count),
+  count = {table}.count + excluded.count
+'''
+
+
+class BrewCompactor():
+    def __init__(self, interval=None, retention=None):
+        retention = retention or config['database'].get('retention', {})
+        self.db = BrewDatabase()
+        self.interval = interval or retention.get('compact_interval', 300)
+        self.retentionDays = {
+            'readings': retention.get('raw_days', 7),
+            'readings_1m': retention.get('minute_days', 90),
+            'readings_1h': retention.get('hour_days', 0)
+        }
+        self.job = None
+
+    def spawnBackgroundCompaction(self):
+        self.job = scheduler.every(self.interval, self.compact, name='telemetry compaction')
+
+    @property
+    def watermark(self):
+        return self.db.get("select last_id from rollup_state where name = 'readings'") or 0
+
+    def rollup(self):
+        start = self.watermark
+        end = self.db.get('select max(id) from readings') or 0
+        if end <= start:
+            return 0
+
+        with self.db.transaction() as conn:
+            for table, seconds in ROLLUPS.items():
+                query = rollupQuery.format(table=table, seconds=seconds)
+                conn.execute(query, (start, end))
+
+            conn.execute('''insert into rollup_state (name, last_id) values ('readings', ?)
+                on conflict (name) do update set last_id = excluded.last_id''', (end,))
+
+        return end - start
+
+    def expireRaw(self, cutoff, chunkSize=5000):
+        # ids follow insertion time, so walk windows up from the oldest id
+        # instead of scanning the whole table for old timestamps
+        deleted = 0
+        watermark = self.watermark
+
+        while True:
+            with self.db.transaction() as conn:
+                cursor = conn.execute('''delete from readings
+                    where id <= ? and id < (select min(id) from readings) + ? and timestamp < ?''',
+                    (watermark, chunkSize, cutoff))
+
+            if cursor.rowcount <= 0:
+                return deleted
+            deleted += cursor.rowcount
+
+    def expire(self):
+        deleted = {}
+        now = time.time()
+
+        for table, days in self.retentionDays.items():
+            if not days:
+                continue
+
+            cutoff = now - days * 86400
+            if table == 'readings':
+                deleted[table] = self.expireRaw(cutoff)
+                continue
+
+            with self.db.transaction() as conn:
+                cursor = conn.execute(
+                    'delete from {} where bucket < ?'.format(table), (cutoff,))
+            deleted[table] = cursor.rowcount
+
+        return deleted
+
+    def compact(self):
+        rolledUp = self.rollup()
+        deleted = self.expire()
+
+        logger.debug('Compacted telemetry', es={
+            'rolledUp': rolledUp,
+            **{'deleted_{}'.format(table): count for table, count in deleted.items()}
+        })
@@ -0,0 +1,386 @@
+from collections import deque
+
+from logger import logger
+
+'''
+Controllers decide what the regulator should do next.
+
+Every controller implements decide(regulator, now), which looks at the
+regulators current temperature, goal and relay state and returns the
+state to switch to, 'heating', 'cooling' or 'idle', together with the
+number of seconds until it wants to decide again. The regulator applies
+the state and waits, waking early on new goals or relay toggles.
+'''
+class BrewController():
+    name = None
+
+    def __init__(self, minimumCycleTime=0):
+        # shortest time a relay is kept off before switching it on again,
+        # protects the compressor from short cycling
+        self.minimumCycleTime = minimumCycleTime
+        self.lastSwitchOff = None
+        self.lastState = 'idle'
+
+    def decide(self, regulator, now):
+        raise NotImplementedError
+
+    def seed(self, regulator, db):
+        # controllers learning from history override this to start from the readings table
+        pass
+
+    def observe(self, state, now):
+        if self.lastState != 'idle' and state == 'idle':
+            self.lastSwitchOff = now
+        self.lastState = state
+
+    def restingFor(self, now):
+        # seconds left before a relay may be switched on again
+        if self.lastSwitchOff is None:
+            return 0
+        return max(self.minimumCycleTime - (now - self.lastSwitchOff), 0)
+
+    @staticmethod
+    def fromConfig(config):
+        controllers = {
+            BangBangController.name: BangBangController,
+            PIDController.name: PIDController,
+            AdaptiveController.name: AdaptiveController
+        }
+
+        name = config.get('controller', BangBangController.name)
+        if name not in controllers:
+            raise Exception('Unknown regulator controller {}, use one of {}'.format(
+                name, ', '.join(controllers)))
+
+        # config.yaml keys are snake_case, constructor arguments camelCase
+        options = {}
+        for key, value in (config.get(name) or {}).items():
+            first, *rest = key.split('_')
+            options[first + ''.join(word.capitalize() for word in rest)] = value
+
+        return controllers[name](minimumCycleTime=config.get('minimum_cycle_seconds', 0), **options)
+
+
+class BangBangController(BrewController):
+    '''
+    Chases the goal with heating or cooling until it is passed, then idles
+    for as long as it takes to drift degreesAllowedToDrift at a fixed rate.
+    '''
+    name = 'bangbang'
+
+    def __init__(self, minimumCycleTime=0, secondsToDriftSingleDegree=300):
+        super().__init__(minimumCycleTime)
+        self.secondsToDriftSingleDegree = secondsToDriftSingleDegree
+
+    def temperatureLossFunction(self, regulator):
+        return regulator.degreesAllowedToDrift * self.secondsToDriftSingleDegree
+
+    def sustain(self, regulator):
+        timeout = self.temperatureLossFunction(regulator)
+
+        logger.info('Sustaining temperature', es={
+            'chamber': regulator.name,
+            'state': 'idle',
+            'temperature': regulator.currentTemp,
+            'goal': regulator.targetTemperature,
+            'timeout': timeout
+        })
+        return ('idle', timeout)
+
+    def decide(self, regulator, now):
+        state = regulator.state
+
+        if state != 'idle':
+            if not regulator.hasMetTemperatureGoal:
+                logger.info("Chasing temperature goal", es={
+                    'chamber': regulator.name,
+                    'state': state,
+                    'temperature': regulator.currentTemp,
+                    'goal': regulator.targetTemperature
+                })
+                return (state, regulator.poolingInterval)
+
+            logger.info("Temperature met, idling", es={
+                'chamber': regulator.name,
+                'temperature': regulator.currentTemp,
+                'goal': regulator.targetTemperature
+            })
+            return self.sustain(regulator)
+
+        if regulator.withinDeviationLimit:
+            return self.sustain(regulator)
+
+        resting = self.restingFor(now)
+        if resting > 0:
+            return ('idle', resting)
+
+        if regulator.shouldCool:
+            return ('cooling', regulator.poolingInterval)
+        elif regulator.shouldHeat:
+            return ('heating', regulator.poolingInterval)
+        return ('idle', regulator.poolingInterval)
+
+
+class PIDController(BrewController):
+    '''
+    PID on the temperature error with time proportional relay output. Each
+    cycle the output, clamped to [-1, 1], sets how large a part of
+    cycleSeconds heating (positive) or cooling (negative) runs before the
+    relay idles for the rest of the cycle. Outputs too small to run for
+    minimumCycleTime seconds are skipped, avoiding short relay pulses, and
+    no relay is started while the temperature is within deadBand degrees
+    of the goal or the last run has not rested minimumCycleTime seconds.
+    '''
+    name = 'pid'
+
+    def __init__(self, minimumCycleTime=0, kp=4, ki=0.00002, kd=4000, cycleSeconds=900, deadBand=0):
+        super().__init__(minimumCycleTime)
+        self.kp = kp
+        self.ki = ki
+        self.kd = kd
+        self.cycleSeconds = cycleSeconds
+        self.deadBand = deadBand
+
+        self.integral = 0
+        self.lastError = None
+        self.lastTime = None
+        self.cycleEnds = None
+        self.onUntil = None
+        self.cycleState = 'idle'
+        self.output = 0
+
+    def update(self, error, now):
+        dt = 0 if self.lastTime is None else now - self.lastTime
+        derivative = 0
+        if self.lastError is not None and dt > 0:
+            derivative = (error - self.lastError) / dt
+
+        # only integrate while the output is not saturated, prevents windup
+        unclamped = self.kp * error + self.ki * (self.integral + error * dt) + self.kd * derivative
+        if abs(unclamped) < 1:
+            self.integral += error * dt
+
+        self.lastError = error
+        self.lastTime = now
+        self.output = max(-1, min(1, self.kp * error + self.ki * self.integral + self.kd * derivative))
+        return self.output
+
+    def startCycle(self, regulator, now):
+        error = regulator.targetTemperature - regulator.currentTemp
+        output = self.update(error, now)
+        onTime = abs(output) * self.cycleSeconds
+
+        self.cycleEnds = now + self.cycleSeconds
+        self.cycleState = 'idle'
+        if (onTime >= max(self.minimumCycleTime, regulator.poolingInterval)
+                and abs(error) >= self.deadBand and self.restingFor(now) == 0):
+            self.cycleState = 'heating' if output > 0 else 'cooling'
+        self.onUntil = now + onTime
+
+        logger.info('Started regulator cycle', es={
+            'chamber': regulator.name,
+            'controller': self.name,
+            'output': round(output, 3),
+            'state': self.cycleState,
+            'onTime': round(onTime),
+            'temperature': regulator.currentTemp,
+            'goal': regulator.targetTemperature
+        })
+
+    def decide(self, regulator, now):
+        if self.cycleEnds is None or now >= self.cycleEnds:
+            self.startCycle(regulator, now)
+
+        if self.cycleState != 'idle' and now < self.onUntil:
+            return (self.cycleState, min(self.onUntil - now, regulator.poolingInterval))
+
+        return ('idle', min(self.cycleEnds - now, regulator.poolingInterval))
+
+
+class AdaptiveController(BrewController):
+    '''
+    Bang-bang with learned rates. Temperatures seen while heating, cooling
+    and idle are kept per run of a state, and when a run ends its slope is
+    folded into a moving average of that states rate. The overshoot after
+    switching a relay off is measured the same way.
+
+    Heating and cooling stop early by the learned overshoot so the
+    temperature coasts onto the goal. The learned heating and cooling rates
+    predict when that point is reached, a run expected to get there before
+    the next sensor pool is stopped at the predicted time instead. While
+    idle the controller sleeps until the learned drift rate would take it
+    out of the allowed band.
+
+    A new controller is seeded by replaying the temperatures and relay
+    switches recorded in the readings table over the last seedHours, so
+    rates and overshoot are not relearned after a restart or reload.
+    '''
+    name = 'adaptive'
+    seedQuery = '''select timestamp, location, metric, value from readings
+        where timestamp >= ? and ((location = ? and metric = 'temperature')
+            or (location = 'relay' and metric in (?, ?)))
+        order by timestamp, id'''
+
+    def __init__(self, minimumCycleTime=0, smoothing=0.3, maximumIdleSeconds=3600, seedHours=48):
+        super().__init__(minimumCycleTime)
+        self.smoothing = smoothing
+        self.maximumIdleSeconds = maximumIdleSeconds
+        self.seedHours = seedHours
+
+        self.rates = {'heating': None, 'cooling': None, 'idle': None}
+        self.overshoot = {'heating': 0, 'cooling': 0}
+        self.samples = deque(maxlen=512)
+        self.runState = None
+        self.runUntil = None
+        self.coasting = None
+
+    def average(self, previous, value):
+        if previous is None:
+            return value
+        return previous + self.smoothing * (value - previous)
+
+    @staticmethod
+    def slope(samples):
+        # least squares slope in degrees per second
+        if len(samples) < 2:
+            return None
+
+        meanTime = sum(t for t, _ in samples) / len(samples)
+        meanTemp = sum(temp for _, temp in samples) / len(samples)
+        variance = sum((t - meanTime) ** 2 for t, _ in samples)
+        if variance == 0:
+            return None
+
+        return sum((t - meanTime) * (temp - meanTemp) for t, temp in samples) / variance
+
+    def foldRun(self):
+        rate = self.slope(self.samples)
+        if self.runState is not None and rate is not None:
+            self.rates[self.runState] = self.average(self.rates[self.runState], rate)
+
+    def learn(self, state, temperature, now):
+        if state != self.runState:
+            self.foldRun()
+
+            # track how far the temperature keeps moving after a relay goes off
+            if self.runState in self.overshoot and state == 'idle':
+                self.coasting = (self.runState, temperature, temperature)
+
+            self.samples.clear()
+            self.runState = state
+            if state == 'idle':
+                self.runUntil = None
+
+        self.samples.append((now, temperature))
+
+        if self.coasting is not None:
+            relay, start, peak = self.coasting
+            moving = temperature > peak if relay == 'heating' else temperature < peak
+            if moving:
+                self.coasting = (relay, start, temperature)
+            elif state != 'idle' or abs(temperature - peak) > 0.1:
+                self.overshoot[relay] = self.average(self.overshoot[relay], abs(peak - start))
+                self.coasting = None
+
+    def seed(self, regulator, db):
+        heating, cooling = regulator.heating.controls, regulator.cooling.controls
+        start = regulator.clock.time() - self.seedHours * 3600
+        params = (start, regulator.temperatureSensor.location, heating, cooling)
+        relays = {heating: False, cooling: False}
+        samples = 0
+
+        try:
+            for timestamp, location, metric, value in db.iterate(self.seedQuery, params):
+                if location == 'relay':
+                    relays[metric] = value == 1
+                    continue
+
+                state = 'heating' if relays[heating] else 'cooling' if relays[cooling] else 'idle'
+                self.learn(state, value, timestamp)
+                samples += 1
+        except Exception as error:
+            logger.error('Unable to seed controller from readings', es={
+                'chamber': regulator.name,
+                'error': str(error),
+                'exception': error.__class__.__name__
+            })
+
+        # the run recorded last counts too, live samples start a run of their own
+        self.foldRun()
+        self.samples.clear()
+        self.runState = None
+        self.runUntil = None
+        self.coasting = None
+
+        logger.info('Seeded controller from readings', es={
+            'chamber': regulator.name,
+            'controller': self.name,
+            'samples': samples,
+            'rates': {key: rate for key, rate in self.rates.items() if rate is not None},
+            'overshoot': self.overshoot
+        })
+
+    def timeToReach(self, state, temperature, temperatureGoal):
+        # seconds heating or cooling at the learned rate takes to get there,
+        # None while the rate is unknown or moves the wrong way
+        rate = self.rates[state]
+        if rate is None:
+            return None
+
+        distance = temperatureGoal - temperature
+        if rate * distance <= 0:
+            return None
+        return distance / rate
+
+    def run(self, state, regulator, now):
+        if self.runUntil is not None and now >= self.runUntil:
+            return None
+
+        stopAt = regulator.targetTemperature
+        stopAt += -self.overshoot['heating'] if state == 'heating' else self.overshoot['cooling']
+        remaining = self.timeToReach(state, regulator.currentTemp, stopAt)
+        if remaining is not None and remaining < regulator.poolingInterval:
+            self.runUntil = now + remaining
+            return (state, remaining)
+
+        return (state, regulator.poolingInterval)
+
+    def idleTimeout(self, regulator):
+        margin = regulator.degreesAllowedToDrift - abs(regulator.targetTemperature - regulator.currentTemp)
+        drift = abs(self.rates['idle'] or 0)
+        if drift == 0:
+            return regulator.poolingInterval
+
+        return max(regulator.poolingInterval, min(margin / drift, self.maximumIdleSeconds))
+
+    def decide(self, regulator, now):
+        state = regulator.state
+        temperature = regulator.currentTemp
+        target = regulator.targetTemperature
+        self.learn(state, temperature, now)
+
+        decision = None
+        if state == 'heating':
+            if temperature + self.overshoot['heating'] < target:
+                decision = self.run('heating', regulator, now)
+        elif state == 'cooling':
+            if temperature - self.overshoot['cooling'] > target:
+                decision = self.run('cooling', regulator, now)
+        elif not regulator.withinDeviationLimit and self.restingFor(now) == 0:
+            return self.run('cooling' if temperature > target else 'heating', regulator, now)
+
+        if decision is not None:
+            return decision
+
+        timeout = self.idleTimeout(regulator)
+        logger.info('Sustaining temperature', es={
+            'chamber': regulator.name,
+            'controller': self.name,
+            'state': 'idle',
+            'temperature': temperature,
+            'goal': target,
+            'timeout': timeout,
+            'rates': {key: rate for key, rate in self.rates.items() if rate is not None},
+            'overshoot': self.overshoot
+        })
+        return ('idle', timeout)
@@ -2,20 +2,164 @@ from utils import getConfig
 from logger import logger
 import sqlite3
 import threading
+import atexit
+import queue
+import time
+from contextlib import contextmanager
+
+config = getConfig()
+readings = None
+readingsLock = threading.Lock()
 
 
 class BrewDatabase():
-    def __init__(self):
-        config = getConfig()
-        self.conn = sqlite3.connect(
-            config['database']['name'], check_same_thread=False)
-        self.cur = self.conn.cursor()
+    '''
+    Hands out sqlite connections from a small pool so the flask threads,
+    sensor daemons and regulator never share a connection or cursor.
+    Queries take parameters, which lets sqlite reuse each connection's
+    cached prepared statements instead of parsing formatted sql.
+    '''
+    def __init__(self, poolSize=4):
+        self.name = config['database']['name']
+        self.busyTimeout = config['database'].get('busy_timeout', 5)
+        self.poolSize = poolSize
+        self.pool = queue.LifoQueue()
+
+        # separate connection whose data_version sees commits from every other one
+        self.watchConn = self.connect()
+        self.watchLock = threading.Lock()
+
+        with self.transaction() as conn:
+            # WAL lets readers run alongside the writer and batches fsyncs
+            conn.execute('pragma journal_mode = WAL')
+            self.createReadingsTable(conn)
+            self.createChamberTable(conn)
+
+    def connect(self):
+        conn = sqlite3.connect(self.name, timeout=self.busyTimeout,
+                               check_same_thread=False, cached_statements=128)
+        # synchronous normal is durable enough for telemetry in WAL mode
+        conn.execute('pragma synchronous = NORMAL')
+        return conn
+
+    @contextmanager
+    def connection(self):
+        try:
+            conn = self.pool.get_nowait()
+        except queue.Empty:
+            conn = self.connect()
+
+        try:
+            yield conn
+        finally:
+            if conn.in_transaction:
+                conn.rollback()
+
+            if self.pool.qsize() < self.poolSize:
+                self.pool.put(conn)
+            else:
+                conn.close()
+
+    @contextmanager
+    def transaction(self):
+        '''
+        Yields a connection inside a transaction, committed when the block
+        exits or rolled back if it raises.
+        '''
+        with self.connection() as conn:
+            with conn:
+                yield conn
+
+    def createReadingsTable(self, conn):
+        self.migrateReadingsTable(conn)
 
-    def get(self, query):
+        # autoincrement keeps ids increasing after old rows are deleted,
+        # the compactor uses them as its rollup watermark
+        conn.execute('''create table if not exists readings (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            timestamp REAL, location TEXT, metric TEXT, value REAL)''')
+        conn.execute('''create index if not exists readings_location_timestamp
+            on readings (location, timestamp)''')
+
+        for table in ['readings_1m', 'readings_1h']:
+            conn.execute('''create table if not exists {} (
+                location TEXT, metric TEXT, bucket INTEGER,
+                min REAL, max REAL, mean REAL, count INTEGER,
+                primary key (location, metric, bucket)) without rowid'''.format(table))
+            conn.execute('''create index if not exists {0}_bucket
+                on {0} (bucket)'''.format(table))
+
+        conn.execute('''create table if not exists rollup_state (
+            name TEXT PRIMARY KEY, last_id INTEGER)''')
+
+    def migrateReadingsTable(self, conn):
+        '''
+        Readings tables created before rollups have no id column, copy
+        them into one that has, keeping timestamp order for the ids. Runs
+        in one immediate transaction, a crash leaves the old table as it
+        was and a process starting alongside waits and finds it migrated.
+        '''
+        if not self.readingsNeedMigration(conn):
+            return
+
+        conn.execute('begin immediate')
         try:
-            cur = self.conn.cursor()
-            cur.execute(query)
-            value = cur.fetchone()
+            if self.readingsNeedMigration(conn):
+                self.copyReadingsWithId(conn)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
+    def readingsNeedMigration(self, conn):
+        columns = [row[1] for row in conn.execute('pragma table_info(readings)')]
+        # left by a migration interrupted before it ran in a transaction
+        leftover = conn.execute(
+            "select 1 from sqlite_master where type = 'table' and name = 'readings_without_id'").fetchone()
+        return leftover is not None or (len(columns) > 0 and 'id' not in columns)
+
+    def copyReadingsWithId(self, conn):
+        columns = [row[1] for row in conn.execute('pragma table_info(readings)')]
+        if len(columns) > 0 and 'id' not in columns:
+            conn.execute('alter table readings rename to readings_without_id')
+            conn.execute('drop index if exists readings_location_timestamp')
+
+        conn.execute('''create table if not exists readings (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            timestamp REAL, location TEXT, metric TEXT, value REAL)''')
+        conn.execute('''insert into readings (timestamp, location, metric, value)
+            select timestamp, location, metric, value from readings_without_id
+            order by timestamp''')
+        conn.execute('drop table readings_without_id')
+        logger.info('Migrated readings table, added id column')
+
+    def createChamberTable(self, conn):
+        # target temperature of every chamber regulated, see chamber.py
+        conn.execute('''create table if not exists chamber (
+            name TEXT PRIMARY KEY, target_temperature REAL)''')
+
+    def getChamberGoal(self, name):
+        goal = self.get('select target_temperature from chamber where name = ?', (name,))
+        if goal is None:
+            # databases from before chambers keep the goal in the regulator table
+            goal = self.get('select target_temperature from regulator')
+        return goal
+
+    def setChamberGoal(self, name, goal):
+        query = '''insert into chamber (name, target_temperature) values (?, ?)
+            on conflict (name) do update set target_temperature = excluded.target_temperature'''
+        return self.write(query, (name, goal))
+
+    @property
+    def dataVersion(self):
+        # changes whenever another connection commits to the database
+        with self.watchLock:
+            return self.watchConn.execute('pragma data_version').fetchone()[0]
+
+    def get(self, query, params=()):
+        try:
+            with self.connection() as conn:
+                value = conn.execute(query, params).fetchone()
             if value is None or len(value) < 1:
                 return None
 
@@ -25,24 +169,102 @@ class BrewDatabase():
             logger.error(str(err))
             return None
 
-    def getAll(self, query):
+    def getAll(self, query, params=()):
         try:
-            self.cur.execute(query)
-            value = self.cur.fetchall()
-            return value
+            with self.connection() as conn:
+                return conn.execute(query, params).fetchall()
         except Exception as err:
             logger.error("Error while fetching query from database")
             logger.error(str(err))
             return False
 
-    def write(self, query):
+    def iterate(self, query, params=(), size=500):
+        with self.connection() as conn:
+            cur = conn.execute(query, params)
+            try:
+                rows = cur.fetchmany(size)
+                while rows:
+                    yield from rows
+                    rows = cur.fetchmany(size)
+            finally:
+                cur.close()
+
+    def write(self, query, params=()):
         try:
-            cur = self.conn.cursor()
-            cur.execute(query)
-            self.conn.commit()
+            with self.transaction() as conn:
+                conn.execute(query, params)
             return True
         except Exception as err:
             logger.error(str(err))
             logger.error("Error while writing query to database")
 
             return False
+
+    def writeMany(self, query, rows):
+        try:
+            with self.transaction() as conn:
+                conn.executemany(query, rows)
+            return True
+        except Exception as err:
+            logger.error(str(err))
+            logger.error("Error while writing batch to database")
+
+            return False
+
+
+class BrewReadings():
+    '''
+    Buffers sensor readings in memory and writes them to the readings
+    table in one transaction every flushInterval seconds, or sooner when
+    maxBuffered rows are waiting.
+    '''
+    insertQuery = 'insert into readings (timestamp, location, metric, value) values (?, ?, ?, ?)'
+
+    def __init__(self, database, flushInterval=None, maxBuffered=500):
+        self.db = database
+        self.flushInterval = flushInterval or config['database'].get('readings_flush_interval', 30)
+        self.maxBuffered = maxBuffered
+        self.buffer = []
+        self.lock = threading.Lock()
+        self.flushRequested = threading.Event()
+
+        self.thread = threading.Thread(target=self.flushOnIntervalForever, args=())
+        self.thread.daemon = True
+        self.thread.start()
+        atexit.register(self.flush)
+
+    def add(self, location, telemetry, timestamp=None):
+        timestamp = timestamp or time.time()
+        rows = [(timestamp, location, metric, float(value))
+                for metric, value in telemetry.items()
+                if isinstance(value, (int, float)) and metric != 'location']
+
+        with self.lock:
+            self.buffer.extend(rows)
+            if len(self.buffer) >= self.maxBuffered:
+                self.flushRequested.set()
+
+    def flush(self):
+        with self.lock:
+            rows, self.buffer = self.buffer, []
+
+        if len(rows) > 0:
+            self.db.writeMany(self.insertQuery, rows)
+
+    def flushOnIntervalForever(self):
+        while True:
+            self.flushRequested.wait(self.flushInterval)
+            self.flushRequested.clear()
+            self.flush()
+
+
+def getReadings():
+    '''
+    The readings writer shared by every sensor and the camera in this
+    process, started on first use so they group commit together.
+    '''
+    global readings
+    with readingsLock:
+        if readings is None:
+            readings = BrewReadings(BrewDatabase())
+        return readings
@@ -0,0 +1,128 @@
+import numpy as np
+
+'''
+Filters smoothing sensor readings before the regulator acts on them.
+
+A pipeline runs its stages in order over the recent samples of a metric
+from the sensors ring buffer, each stage taking and returning a whole
+series as numpy arrays, and the last value is the filtered reading.
+Stages are configured per metric in config.yaml:
+
+    filters:
+      window: 30
+      temperature:
+        - median: 5
+        - rate_limit: 0.02
+        - ema: 0.3
+'''
+
+class MedianFilter():
+    '''
+    Median of the last size samples, removes single sample spikes.
+    '''
+    def __init__(self, size=5):
+        self.size = size
+        self.indices = {}
+
+    def windowIndices(self, length):
+        # row i indexes the window ending at sample i, the first samples
+        # repeat the oldest value for the part of the window before them
+        if length not in self.indices:
+            offsets = np.arange(length)[:, None] + np.arange(1 - self.size, 1)
+            self.indices[length] = np.maximum(offsets, 0)
+        return self.indices[length]
+
+    def apply(self, timestamps, values):
+        if len(values) < 2 or self.size < 2:
+            return values
+
+        windows = np.sort(values[self.windowIndices(len(values))], axis=1)
+        middle = self.size // 2
+        if self.size % 2:
+            return windows[:, middle]
+        return (windows[:, middle - 1] + windows[:, middle]) / 2
+
+
+class RateLimitFilter():
+    '''
+    Clamps each sample to within maxRate per second of the filtered sample
+    before it, a sensor glitch can not move the reading faster than the
+    wort can and a real step is followed at maxRate.
+    '''
+    def __init__(self, maxRate=0.02):
+        self.maxRate = maxRate
+
+    def apply(self, timestamps, values):
+        if len(values) < 2:
+            return values
+
+        # every sample depends on the clamped one before it, a sequential pass
+        limits = (self.maxRate * np.diff(timestamps)).tolist()
+        clamped = values.tolist()
+        for index, limit in enumerate(limits, 1):
+            previous = clamped[index - 1]
+            clamped[index] = min(max(clamped[index], previous - limit), previous + limit)
+        return np.array(clamped)
+
+
+class EMAFilter():
+    '''
+    Exponential moving average with weight alpha on the newest sample.
+    '''
+    def __init__(self, alpha=0.3):
+        self.alpha = alpha
+        self.weights = {}
+
+    def weightMatrix(self, size):
+        # row i holds the weight of every sample in the average at sample i
+        if size not in self.weights:
+            decay = 1 - self.alpha
+            exponents = np.subtract.outer(np.arange(size), np.arange(size))
+            matrix = np.tril(self.alpha * decay ** np.maximum(exponents, 0))
+            matrix[:, 0] = decay ** np.arange(size)
+            self.weights[size] = matrix
+        return self.weights[size]
+
+    def apply(self, timestamps, values):
+        if len(values) < 2:
+            return values
+        return self.weightMatrix(len(values)) @ values
+
+
+STAGES = {
+    'median': MedianFilter,
+    'rate_limit': RateLimitFilter,
+    'ema': EMAFilter
+}
+
+
+class FilterPipeline():
+    def __init__(self, stages):
+        self.stages = stages
+
+    def apply(self, timestamps, values):
+        timestamps = np.asarray(timestamps, dtype=np.float64)
+        values = np.asarray(values, dtype=np.float64)
+
+        # metrics missing from a sample are buffered as nan
+        present = ~np.isnan(values)
+        timestamps, values = timestamps[present], values[present]
+
+        for stage in self.stages:
+            values = stage.apply(timestamps, values)
+        return values
+
+    def latest(self, timestamps, values):
+        filtered = self.apply(timestamps, values)
+        return float(filtered[-1]) if len(filtered) else float('nan')
+
+    @staticmethod
+    def fromConfig(stages):
+        pipeline = []
+        for stage in stages:
+            (name, argument), = stage.items()
+            if name not in STAGES:
+                raise Exception('Unknown filter {}, use one of {}'.format(name, ', '.join(STAGES)))
+            pipeline.append(STAGES[name](argument))
+
+        return FilterPipeline(pipeline)
@@ -0,0 +1,215 @@
+import http.client
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+from logger import logger
+from scheduler import scheduler
+
+'''
+Hub polling many brewLogger nodes, each running server.py, and merging
+their sensors, relays, regulator and chambers into one fleet state.
+
+Every node is polled on its own thread with its own kept-alive
+connection, so a slow or dead node only holds up itself. A node still
+busy with the previous poll is skipped instead of piling up requests.
+Responses are revalidated with the etag the node sent last, and a node
+that stops answering keeps being served from its last good state until
+it is older than ttl seconds. A node regulating no chambers answers
+404 on /api/regulator, that is reported as no regulator, not as down.
+'''
+
+ENDPOINTS = {
+    'sensors': '/api/sensors',
+    'relays': '/api/relays',
+    'regulator': '/api/regulator',
+    'chambers': '/api/chambers'
+}
+
+# endpoints a node answers 404 on when it has nothing to report
+OPTIONAL_ENDPOINTS = ('regulator',)
+
+# errors a kept-alive connection gives when the node closed it since last poll
+STALE_CONNECTION = (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError)
+
+
+class NotFound(http.client.HTTPException):
+    pass
+
+
+class BrewNode():
+    def __init__(self, name, url, timeout=3):
+        address = urlsplit(url)
+        self.name = name
+        self.url = url
+        self.host = address.hostname
+        self.port = address.port
+        self.ssl = address.scheme == 'https'
+        self.timeout = timeout
+
+        self.connection = None
+        self.etags = {}
+        self.bodies = {}
+        self.state = None
+        self.updated = None
+        self.error = None
+        self.failures = 0
+
+    def connect(self):
+        if self.connection is None:
+            connectionClass = http.client.HTTPSConnection if self.ssl else http.client.HTTPConnection
+            self.connection = connectionClass(self.host, self.port, timeout=self.timeout)
+
+        return self.connection
+
+    def disconnect(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+    def get(self, path):
+        headers = {
+            'Accept': 'application/json',
+            'User-Agent': 'brewlogger-hub',
+            'Connection': 'keep-alive'
+        }
+
+        if path in self.etags:
+            headers['If-None-Match'] = self.etags[path]
+
+        connection = self.connect()
+        connection.request('GET', path, headers=headers)
+        response = connection.getresponse()
+        body = response.read()
+
+        if response.status == 304 and path in self.bodies:
+            return self.bodies[path]
+
+        if response.status == 404:
+            raise NotFound('{} responded with status 404'.format(path))
+
+        if response.status >= 300:
+            raise http.client.HTTPException('{} responded with status {}'.format(path, response.status))
+
+        data = json.loads(body.decode('utf8'))
+        etag = response.getheader('ETag')
+        if etag:
+            self.etags[path] = etag
+            self.bodies[path] = data
+
+        return data
+
+    def fetch(self, path):
+        # retry once on a fresh connection only when the kept-alive one was
+        # closed, a timeout or refused connection fails the poll right away
+        try:
+            return self.get(path)
+        except STALE_CONNECTION:
+            self.disconnect()
+            return self.get(path)
+
+    def unwrap(self, key, data):
+        # sensors, relays and chambers are listed under their own key, {'sensors': [...]}
+        if isinstance(data, dict) and key in data:
+            return data[key]
+        return data
+
+    def fetchEndpoint(self, key, path):
+        try:
+            return self.unwrap(key, self.fetch(path))
+        except NotFound:
+            if key in OPTIONAL_ENDPOINTS:
+                return None
+            raise
+
+    def poll(self):
+        try:
+            state = {key: self.fetchEndpoint(key, path) for key, path in ENDPOINTS.items()}
+        except (OSError, http.client.HTTPException, ValueError) as error:
+            self.disconnect()
+            self.failures += 1
+            if self.error is None:
+                logger.warning('Lost contact with node', es={
+                    'node': self.name,
+                    'url': self.url,
+                    'error': str(error),
+                    'exception': error.__class__.__name__
+                })
+            self.error = str(error)
+            return False
+
+        if self.error is not None:
+            logger.info('Node is back', es={'node': self.name, 'failures': self.failures})
+
+        self.state = state
+        self.updated = time.time()
+        self.error = None
+        self.failures = 0
+        return True
+
+    def info(self, ttl, now=None):
+        now = time.time() if now is None else now
+        age = None if self.updated is None else now - self.updated
+        fresh = age is not None and age <= ttl
+
+        return {
+            'name': self.name,
+            'url': self.url,
+            'online': self.error is None and fresh,
+            'age': None if age is None else round(age, 1),
+            'error': self.error,
+            **(self.state if fresh else {key: None for key in ENDPOINTS})
+        }
+
+    @staticmethod
+    def fromConfig(config, timeout=3):
+        url = config.get('url')
+        return BrewNode(config.get('name') or urlsplit(url).netloc, url, config.get('timeout', timeout))
+
+
+class BrewHub():
+    def __init__(self, nodes, interval=10, ttl=60):
+        self.nodes = nodes
+        self.interval = interval
+        self.ttl = ttl
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=max(len(nodes), 1), thread_name_prefix='hub')
+        self.job = None
+
+    def poll(self):
+        with self.lock:
+            for node in self.nodes:
+                future = self.pending.get(node.name)
+                if future is None or future.done():
+                    self.pending[node.name] = self.executor.submit(node.poll)
+
+    def spawnBackgroundPolling(self):
+        self.job = scheduler.every(self.interval, self.poll, name='hub node polling')
+
+    def getNodeByName(self, name):
+        return next((node for node in self.nodes if node.name == name), None)
+
+    @property
+    def fleet(self):
+        now = time.time()
+        nodes = [node.info(self.ttl, now) for node in self.nodes]
+
+        return {
+            'online': sum(1 for node in nodes if node['online']),
+            'total': len(nodes),
+            'nodes': nodes
+        }
+
+    @staticmethod
+    def fromConfig(config):
+        timeout = config.get('timeout', 3)
+        nodes = [BrewNode.fromConfig(node, timeout) for node in config.get('nodes') or []]
+
+        names = [node.name for node in nodes]
+        if len(set(names)) != len(names):
+            raise Exception('Error! Hub node names must be unique, got {}'.format(', '.join(names)))
+
+        return BrewHub(nodes, config.get('interval', 10), config.get('ttl', 60))
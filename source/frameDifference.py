@@ -0,0 +1,48 @@
+import numpy as np
+
+'''
+Compares camera frames on a small grayscale version, the Y plane of a
+yuv capture resized by the camera, so there is no JPEG to decode.
+
+Each frame has its mean brightness subtracted, which keeps exposure
+changes from counting as movement, and the score is the part of pixels
+that differ by more than threshold from the other frame. Activity is
+scored against the previous frame, while duplicates are judged against
+the last frame that was kept, so slow changes still add up to a new frame.
+'''
+
+class FrameDifference():
+    def __init__(self, size=(64, 48), threshold=12, minimumChange=0.01):
+        self.size = size
+        self.threshold = threshold
+        self.minimumChange = minimumChange
+        self.previous = None
+        self.reference = None
+
+    def luma(self, yuv):
+        # the camera pads yuv captures to a width of 32 and height of 16
+        width, height = self.size
+        paddedWidth = (width + 31) // 32 * 32
+        paddedHeight = (height + 15) // 16 * 16
+        plane = np.frombuffer(yuv, dtype=np.uint8, count=paddedWidth * paddedHeight)
+        return plane.reshape(paddedHeight, paddedWidth)[:height, :width]
+
+    def difference(self, frame, other):
+        changed = np.count_nonzero(np.abs(frame - other) > self.threshold)
+        return float(changed / frame.size)
+
+    def update(self, yuv):
+        '''
+        Returns the activity score against the previous frame and whether
+        the frame is a duplicate of the last kept one.
+        '''
+        luma = self.luma(yuv)
+        frame = luma.astype(np.int16) - int(luma.mean())
+
+        activity = 0.0 if self.previous is None else self.difference(frame, self.previous)
+        duplicate = self.reference is not None and self.difference(frame, self.reference) < self.minimumChange
+        self.previous = frame
+        return (activity, duplicate)
+
+    def keep(self):
+        self.reference = self.previous
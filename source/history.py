@@ -0,0 +1,105 @@
+import json
+import time
+
+from database import config
+
+'''
+Range queries over stored sensor readings.
+
+Readings exist in three tiers, raw samples and the 1 minute and 1 hour
+rollups kept by the compactor. selectResolution picks the coarsest
+amount of work that still gives the caller the number of points asked
+for, and the query functions yield rows from a cursor in chunks so a
+long range is never held in memory at once.
+'''
+
+RESOLUTIONS = {
+    'raw': ('readings', None),
+    '1m': ('readings_1m', 60),
+    '1h': ('readings_1h', 3600)
+}
+
+retention = config['database'].get('retention', {})
+RETENTION_DAYS = {
+    'raw': retention.get('raw_days', 7),
+    '1m': retention.get('minute_days', 90),
+    '1h': retention.get('hour_days', 0)
+}
+
+
+def isRetained(resolution, start, now=None):
+    days = RETENTION_DAYS.get(resolution)
+    if not days:
+        return True
+
+    now = now or time.time()
+    return start >= now - days * 86400
+
+
+def selectResolution(start, end, points, sampleInterval):
+    '''
+    Returns the finest resolution with no more than `points` samples per
+    metric in the range, falling back to the coarsest tier still holding
+    data for `start` when every tier would return too many.
+    '''
+    span = max(end - start, 0)
+    retained = [name for name in RESOLUTIONS if isRetained(name, start)] or ['1h']
+
+    for name in retained:
+        _, seconds = RESOLUTIONS[name]
+        expectedPoints = span / (seconds or sampleInterval or 1)
+        if expectedPoints <= points:
+            return name
+
+    return retained[-1]
+
+
+def queryReadings(db, location, start, end, resolution, metric=None):
+    table, seconds = RESOLUTIONS[resolution]
+    params = [location, start, end]
+
+    if seconds is None:
+        query = 'select timestamp, metric, value from {} where location = ? and timestamp >= ? and timestamp <= ?'
+        order = ' order by timestamp'
+    else:
+        query = 'select bucket, metric, min, max, mean, count from {} where location = ? and bucket >= ? and bucket <= ?'
+        # follows the primary key, so rollups are read without a sort
+        order = ' order by metric, bucket'
+        # include the bucket the range starts inside of
+        params[1] = start - start % seconds
+
+    query = query.format(table)
+    if metric is not None:
+        query += ' and metric = ?'
+        params.append(metric)
+    query += order
+
+    for row in db.iterate(query, params):
+        if seconds is None:
+            yield {'timestamp': row[0], 'metric': row[1], 'value': row[2]}
+        else:
+            yield {
+                'timestamp': row[0],
+                'metric': row[1],
+                'min': row[2],
+                'max': row[3],
+                'mean': row[4],
+                'count': row[5]
+            }
+
+
+def streamNDJSON(rows):
+    for row in rows:
+        yield json.dumps(row) + '\n'
+
+
+def streamJSON(rows, **fields):
+    header = json.dumps(fields)[:-1]
+    yield header + (', ' if fields else '') + '"readings": ['
+
+    separator = ''
+    for row in rows:
+        yield separator + json.dumps(row)
+        separator = ', '
+
+    yield ']}'
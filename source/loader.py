@@ -1,13 +1,76 @@
+import importlib
 import yaml
 
-from brewSensor import BME680Sensor, DHT11Sensor, MockSensor
-from brewRelay import BrewRelay
+from utils import SafeLoader
 
-def load(filePath):
-  loader = yaml.SafeLoader
-  loader.add_constructor('!Relay', BrewRelay.fromYaml)
-  loader.add_constructor('!bme680', BME680Sensor.fromYaml)
-  loader.add_constructor('!dht11', DHT11Sensor.fromYaml)
-  loader.add_constructor('!mockSensor', MockSensor.fromYaml)
-  return yaml.load(open(filePath, "rb"), Loader=loader)
+'''
+Sensors, relays and chambers are built from the tags in brew.yaml. The
+module behind a tag is only imported once the tag is used, so a file
+without relays never loads the GPIO library and so on.
+
+loadSpecs reads brew.yaml without building anything, every tag becomes a
+DeviceSpec of its tag and fields. Specs compare equal when the yaml does,
+which lets a reload find the devices that changed before touching any
+hardware, and build turns them into devices.
+'''
+
+TAGS = {
+  '!Relay': ('brewRelay', 'BrewRelay'),
+  '!Chamber': ('chamber', 'BrewChamber'),
+  '!bme680': ('brewSensor', 'BME680Sensor'),
+  '!dht11': ('brewSensor', 'DHT11Sensor'),
+  '!mockSensor': ('brewSensor', 'MockSensor'),
+  '!simulatedSensor': ('brewSensor', 'SimulatedSensor')
+}
+
+class DeviceSpec():
+  def __init__(self, tag, fields):
+    self.tag = tag
+    self.fields = fields
+
+  def __getattr__(self, field):
+    # fields read as attributes, a spec stands in for its device when
+    # checking that chambers resolve before anything is built
+    try:
+      return self.__dict__['fields'][field]
+    except KeyError:
+      raise AttributeError(field)
+
+  def __eq__(self, other):
+    return isinstance(other, DeviceSpec) and self.tag == other.tag and self.fields == other.fields
+
+  def __repr__(self):
+    return 'DeviceSpec({}, {})'.format(self.tag, self.fields)
+
+  def build(self):
+    moduleName, className = TAGS[self.tag]
+    cls = getattr(importlib.import_module(moduleName), className)
+    return cls(**self.fields)
 
+class SpecLoader(SafeLoader):
+  pass
+
+def specConstructor(tag):
+  def construct(loader, node):
+    return DeviceSpec(tag, loader.construct_mapping(node, deep=True))
+
+  return construct
+
+for tag in TAGS:
+  SpecLoader.add_constructor(tag, specConstructor(tag))
+
+def loadSpecs(filePath):
+  with open(filePath, "rb") as stream:
+    return yaml.load(stream, Loader=SpecLoader)
+
+def build(document):
+  if isinstance(document, DeviceSpec):
+    return document.build()
+  elif isinstance(document, dict):
+    return {key: build(value) for key, value in document.items()}
+  elif isinstance(document, list):
+    return [build(value) for value in document]
+  return document
+
+def load(filePath):
+  return build(loadSpecs(filePath))
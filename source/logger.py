@@ -4,59 +4,313 @@ import logging
 import os
 import json
 import uuid
+import time
+import queue
 import argparse
-from datetime import datetime, date
-import urllib.request
+import threading
+import http.client
+from datetime import datetime
 
 from utils import getConfig, timezoneOffset
+from spool import DiskSpool
 
 config = getConfig()
 LOGGER_NAME = config['logger']['name']
 systemTimezone = timezoneOffset()
 
+class BulkRejected(http.client.HTTPException):
+  '''
+  Elastic refused the batch itself, sending it again gets the same answer.
+  '''
+
 class ESHandler(logging.Handler):
+  '''
+  Ships log records to elasticsearch without blocking the caller. emit only
+  builds the document and puts it on a bounded queue, a background shipper
+  thread drains the queue and sends it through the _bulk api when either
+  batchSize documents are collected or flushInterval seconds have passed.
+
+  Given a spool, batches that fail to ship are written to disk instead of
+  dropped. Shipping is then paused for retryInterval seconds, and once a
+  batch gets through again the spool is replayed in bulk batches. Batches
+  elastic rejects outright, a 4xx other than 429, are counted as failed and
+  never spooled, so one bad batch can not hold up the spool.
+  '''
   def __init__(self, *args, **kwargs):
     self.host = kwargs.get('host')
     self.port = kwargs.get('port') or 9200
-    self.ssl = kwargs.get('ssl') or True
+    self.ssl = kwargs.get('ssl', True)
     self.apiKey = kwargs.get('apiKey')
-    self.date = date.today()
+    self.batchSize = kwargs.get('batchSize') or 500
+    self.flushInterval = kwargs.get('flushInterval') or 5
+    self.timeout = kwargs.get('timeout') or 10
+    self.spool = kwargs.get('spool')
+    self.retryInterval = kwargs.get('retryInterval') or 30
+    self.offlineUntil = 0
     self.sessionID = uuid.uuid4()
 
-    logging.StreamHandler.__init__(self)
+    self.queue = queue.Queue(maxsize=kwargs.get('queueSize') or 10000)
+    self.connection = None
+    self.stopped = threading.Event()
+    self.counterLock = threading.Lock()
+    self.counters = {
+      'queued': 0,
+      'shipped': 0,
+      'dropped': 0,
+      'failed': 0,
+      'batches': 0,
+      'spooled': 0,
+      'replayed': 0,
+      'undecodable': 0,
+      'errors': 0
+    }
+
+    logging.Handler.__init__(self)
+
+    self.shipper = threading.Thread(target=self.shipOnIntervalForever, args=())
+    self.shipper.daemon = True
+    self.shipper.start()
+
+  @property
+  def stats(self):
+    with self.counterLock:
+      stats = dict(self.counters)
+    stats['pending'] = self.queue.qsize()
+    return stats
+
+  def count(self, counter, amount=1):
+    with self.counterLock:
+      self.counters[counter] += amount
 
   def emit(self, record):
-    self.format(record)
-    datetimeTemplate = '%Y-%m-%dT%H:%M:%S.%f{}'.format(systemTimezone)
-    timestamp = datetime.fromtimestamp(record.created).strftime(datetimeTemplate)
+    try:
+      doc = self.buildDocument(record)
+    except Exception:
+      self.handleError(record)
+      return
 
-    protocol = 'https' if self.ssl else 'http'
-    indexURL = '{}://{}:{}/{}-{}/_doc'.format(protocol, self.host, self.port, LOGGER_NAME, self.date.strftime('%Y.%m'))
-    headers = { 'Content-Type': 'application/json', 'User-Agent': 'brewpi-server' }
+    try:
+      self.queue.put_nowait(doc)
+      self.count('queued')
+    except queue.Full:
+      self.count('dropped')
 
-    if self.apiKey:
-      headers['Authorization'] = 'ApiKey {}'.format(self.apiKey)
+  def buildDocument(self, record):
+    self.format(record)
+    datetimeTemplate = '%Y-%m-%dT%H:%M:%S.%f{}'.format(systemTimezone)
+    created = datetime.fromtimestamp(record.created)
 
     doc = {
       'severity': record.levelname,
       'message': record.message,
-      '@timestamp': timestamp,
+      '@timestamp': created.strftime(datetimeTemplate),
       'sessionID': str(self.sessionID)
     }
 
-    if hasattr(record, 'es'):
+    if hasattr(record, 'es') and isinstance(record.es, dict):
       for param in record.es.values():
         if ': {}'.format(param) in record.message:
           doc['message'] = record.message.replace(': {}'.format(str(param)), '')
 
       doc = {**record.es, **doc}
 
-    payload = json.dumps(doc).encode('utf8')
-    req = urllib.request.Request(indexURL, data=payload, headers=headers)
-    response = None
-    response = urllib.request.urlopen(req)
-    response = response.read().decode('utf8')
-    return response
+    # explicit ids make replaying a spooled batch twice harmless
+    index = '{}-{}'.format(LOGGER_NAME, created.strftime('%Y.%m'))
+    return (index, uuid.uuid4().hex, doc)
+
+  def shipOnIntervalForever(self):
+    while not self.stopped.is_set() or not self.queue.empty():
+      batch = self.collectBatch()
+      # nothing may end this thread, or shipping stops for good
+      try:
+        if len(batch) > 0:
+          self.ship(batch)
+      except Exception:
+        self.count('errors')
+        self.count('failed', len(batch))
+      finally:
+        for _ in batch:
+          self.queue.task_done()
+
+      try:
+        if self.spool is not None:
+          self.replaySpool()
+      except Exception:
+        self.count('errors')
+
+  def collectBatch(self):
+    batch = []
+    deadline = time.monotonic() + self.flushInterval
+
+    while len(batch) < self.batchSize:
+      remaining = 0 if self.stopped.is_set() else deadline - time.monotonic()
+      try:
+        item = self.queue.get(timeout=max(remaining, 0))
+      except queue.Empty:
+        break
+
+      # None is put on queue by flush and close to wake the shipper
+      if item is None:
+        self.queue.task_done()
+        break
+      batch.append(item)
+
+    return batch
+
+  def bulkPayload(self, batch):
+    lines = []
+    for index, docID, doc in batch:
+      lines.append(json.dumps({ 'index': { '_index': index, '_id': docID } }))
+      lines.append(json.dumps(doc))
+
+    return ('\n'.join(lines) + '\n').encode('utf8')
+
+  def connect(self):
+    if self.connection is None:
+      connectionClass = http.client.HTTPSConnection if self.ssl else http.client.HTTPConnection
+      self.connection = connectionClass(self.host, self.port, timeout=self.timeout)
+
+    return self.connection
+
+  def disconnect(self):
+    if self.connection is not None:
+      self.connection.close()
+      self.connection = None
+
+  def post(self, path, payload):
+    headers = {
+      'Content-Type': 'application/x-ndjson',
+      'User-Agent': 'brewpi-server',
+      'Connection': 'keep-alive'
+    }
+
+    if self.apiKey:
+      headers['Authorization'] = 'ApiKey {}'.format(self.apiKey)
+
+    connection = self.connect()
+    connection.request('POST', path, body=payload, headers=headers)
+    response = connection.getresponse()
+    body = response.read()
+
+    # only overload and server errors are worth retrying, elastic rejects
+    # a malformed batch or a bad api key the same way every time
+    if response.status >= 500 or response.status == 429:
+      raise http.client.HTTPException('elastic responded with status {}'.format(response.status))
+    elif response.status >= 300:
+      raise BulkRejected('elastic rejected batch with status {}'.format(response.status))
+
+    return json.loads(body.decode('utf8'))
+
+  @property
+  def online(self):
+    return time.monotonic() >= self.offlineUntil
+
+  def sendBulk(self, batch):
+    payload = self.bulkPayload(batch)
+
+    # retry once on a fresh connection, the server may have
+    # closed our kept-alive connection since last batch
+    for attempt in range(2):
+      try:
+        response = self.post('/_bulk', payload)
+        break
+      except BulkRejected:
+        self.count('batches')
+        self.count('failed', len(batch))
+        return 0
+      except (OSError, http.client.HTTPException, ValueError):
+        self.disconnect()
+    else:
+      self.offlineUntil = time.monotonic() + self.retryInterval
+      return None
+
+    failed = 0
+    if response.get('errors'):
+      failed = sum(1 for item in response.get('items', [])
+                   if item.get('index', {}).get('status', 200) >= 300)
+
+    self.count('batches')
+    self.count('failed', failed)
+    return len(batch) - failed
+
+  def ship(self, batch):
+    shipped = self.sendBulk(batch) if self.online else None
+
+    if shipped is not None:
+      self.count('shipped', shipped)
+      return True
+
+    self.spoolBatch(batch)
+    return False
+
+  def spoolBatch(self, batch):
+    if self.spool is None:
+      self.count('failed', len(batch))
+      return
+
+    payload = ''.join(json.dumps(item) + '\n' for item in batch)
+    try:
+      self.spool.append(payload.encode('utf8'))
+      self.count('spooled', len(batch))
+    except OSError:
+      self.count('failed', len(batch))
+
+  def replaySpool(self):
+    # drain spooled batches while endpoint is reachable and live records are not piling up
+    while self.online and self.queue.qsize() < self.batchSize and not self.stopped.is_set():
+      payload, lineCount = self.spool.read(self.batchSize)
+      if lineCount == 0:
+        return
+
+      batch = self.decodeSpooled(payload)
+      if len(batch) == 0:
+        # nothing but undecodable lines, move past them
+        self.spool.commit()
+        continue
+
+      shipped = self.sendBulk(batch)
+      if shipped is None:
+        return
+
+      self.spool.commit()
+      self.count('replayed', shipped)
+
+  def decodeSpooled(self, payload):
+    # lines torn by a crash can not be decoded, they are counted and skipped
+    batch = []
+    for line in payload.splitlines():
+      try:
+        item = json.loads(line.decode('utf8'))
+      except ValueError:
+        item = None
+
+      if not isinstance(item, list) or len(item) != 3:
+        self.count('undecodable')
+        continue
+      batch.append(tuple(item))
+
+    return batch
+
+  def wakeShipper(self):
+    try:
+      self.queue.put_nowait(None)
+    except queue.Full:
+      pass
+
+  def flush(self, timeout=None):
+    timeout = self.timeout if timeout is None else timeout
+    deadline = time.monotonic() + timeout
+    self.wakeShipper()
+
+    while self.queue.unfinished_tasks > 0 and time.monotonic() < deadline:
+      time.sleep(0.01)
+
+  def close(self):
+    self.stopped.set()
+    self.wakeShipper()
+    self.shipper.join(self.timeout)
+    self.disconnect()
+    logging.Handler.close(self)
 
 class ElasticFieldParameterAdapter(logging.LoggerAdapter):
   def __init__(self, logger: logging.LogRecord, extra={}):
@@ -109,7 +363,19 @@ if config['elastic']['enabled']:
   esApiKey = config['elastic']['api_key']
   esSsl = config['elastic']['ssl']
 
-  eh = ESHandler(host=esHost, port=esPort, apiKey=esApiKey, ssl=esSsl)
+  esBatchSize = config['elastic'].get('batch_size')
+  esFlushInterval = config['elastic'].get('flush_interval')
+  esQueueSize = config['elastic'].get('queue_size')
+
+  esSpool = None
+  if config['elastic'].get('spool_directory'):
+    esSpool = DiskSpool(config['elastic']['spool_directory'],
+                        maxBytes=config['elastic'].get('spool_max_mb', 50) * 1024 * 1024,
+                        segmentSeconds=config['elastic'].get('spool_segment_minutes', 60) * 60)
+
+  eh = ESHandler(host=esHost, port=esPort, apiKey=esApiKey, ssl=esSsl,
+                 batchSize=esBatchSize, flushInterval=esFlushInterval, queueSize=esQueueSize,
+                 spool=esSpool)
 
   logger.addHandler(eh)
 
@@ -0,0 +1,77 @@
+import os
+import random
+import struct
+import time
+
+'''
+Stand in for the picamera module when running with --mock, providing
+the parts BrewCamera uses. Captures return the bundled sample image with
+the annotate text and a frame counter in a JPEG comment, so every frame
+is a valid and distinct JPEG. yuv captures are a still scene with
+sensor noise where now and then a bubble moves.
+'''
+
+SAMPLE_IMAGE = os.path.join(os.path.dirname(__file__), '..', 'assets', 'capture.jpg')
+
+
+class exc():
+  class PiCameraMMALError(Exception):
+    pass
+
+
+class Color():
+  def __init__(self, name):
+    self.name = name
+
+
+class PiCamera():
+  def __init__(self):
+    with open(SAMPLE_IMAGE, 'rb') as file:
+      self.sample = file.read()
+
+    self.resolution = (1297, 972)
+    self.rotation = 0
+    self.annotate_background = None
+    self.annotate_text_size = 32
+    self.annotate_text = ''
+    self.frame = 0
+    self.closed = False
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
+
+  def capture(self, output, format='jpeg', use_video_port=False, **kwargs):
+    if self.closed:
+      raise exc.PiCameraMMALError('Camera is closed')
+
+    self.frame += 1
+    if format == 'yuv':
+      output.write(self.yuv(*(kwargs.get('resize') or self.resolution)))
+      return
+
+    comment = '{} frame {} {}'.format(self.annotate_text, self.frame, time.time()).encode('utf8')
+
+    # COM segment right after the start of image marker
+    segment = b'\xff\xfe' + struct.pack('>H', len(comment) + 2) + comment
+    output.write(self.sample[:2] + segment + self.sample[2:])
+
+  def yuv(self, width, height):
+    import numpy as np
+
+    paddedWidth = (width + 31) // 32 * 32
+    paddedHeight = (height + 15) // 16 * 16
+    y = np.tile(np.linspace(60, 180, paddedWidth, dtype=np.int16), (paddedHeight, 1))
+    y += np.random.randint(-3, 4, y.shape, dtype=np.int16)
+
+    if random.random() < 0.3:
+      row, column = random.randrange(paddedHeight), random.randrange(paddedWidth)
+      y[row:row + height // 8, column:column + width // 8] += 60
+
+    chroma = np.full(paddedWidth * paddedHeight // 2, 128, dtype=np.uint8)
+    return np.clip(y, 0, 255).astype(np.uint8).tobytes() + chroma.tobytes()
+
+  def close(self):
+    self.closed = True
@@ -1,5 +1,8 @@
 
 class MockGPIO():
+  # last level written to each pin, read by simulated peripherals
+  pins = {}
+
   def __init__(self):
     return
 
@@ -22,4 +25,7 @@ class MockGPIO():
     return
 
   def output(pin, state):
-    return
+    MockGPIO.pins[pin] = state
+
+  def input(pin):
+    return MockGPIO.pins.get(pin, True)
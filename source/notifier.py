@@ -0,0 +1,81 @@
+import json
+import os
+import socket
+import threading
+
+from logger import logger
+from utils import getConfig
+
+'''
+Local IPC between server and regulator over a UNIX datagram socket.
+
+The regulator binds a BrewNotifier and registers a callback per event,
+the server calls notify after changing the setpoint or a relay. Sending
+never blocks and is a no-op when no regulator is listening.
+'''
+
+config = getConfig()
+SOCKET_PATH = config.get('ipc', {}).get('socket', '/tmp/brewlogger.sock')
+
+
+def notify(event, path=SOCKET_PATH, **payload):
+    message = json.dumps({'event': event, **payload}).encode('utf8')
+
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+            sock.setblocking(False)
+            sock.sendto(message, path)
+        return True
+    except OSError:
+        # nobody listening or their buffer is full, the regulator
+        # falls back to reading the database next time it wakes up
+        return False
+
+
+class BrewNotifier():
+    def __init__(self, path=SOCKET_PATH):
+        self.path = path
+        self.callbacks = {}
+        self.thread = None
+
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sock.bind(self.path)
+
+    def on(self, event, callback):
+        self.callbacks.setdefault(event, []).append(callback)
+
+    def off(self, event, callback):
+        if callback in self.callbacks.get(event, []):
+            self.callbacks[event].remove(callback)
+
+    def spawnBackgroundListener(self):
+        self.thread = threading.Thread(target=self.listenForever, args=())
+        self.thread.daemon = True
+        self.thread.start()
+        logger.info("spawned notification listener on socket: {}".format(self.path))
+
+    def listenForever(self):
+        while True:
+            try:
+                datagram = self.sock.recv(4096)
+            except OSError:
+                # socket was closed
+                return
+
+            try:
+                message = json.loads(datagram.decode('utf8'))
+                for callback in list(self.callbacks.get(message.get('event'), [])):
+                    callback(message)
+            except Exception as error:
+                logger.error('Unable to handle notification', es={
+                    'error': str(error),
+                    'exception': error.__class__.__name__
+                })
+
+    def close(self):
+        self.sock.close()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
@@ -0,0 +1,82 @@
+import itertools
+import json
+import threading
+import time
+from collections import deque
+
+'''
+In process publisher fanning out live events to server-sent event streams.
+
+Sensors publish every sample, relays every toggle and the server every
+setpoint change. An event is serialized once when published and the same
+message is appended to every subscribers queue, so an extra client costs
+a deque append. Queues are bounded, a client that falls behind loses its
+oldest messages instead of growing memory. The last event per key is kept
+and replayed to new subscribers so they start with the current state.
+'''
+
+class Subscription():
+    def __init__(self, size):
+        self.messages = deque(maxlen=size)
+        self.condition = threading.Condition()
+        self.dropped = 0
+
+    def put(self, message):
+        with self.condition:
+            if len(self.messages) == self.messages.maxlen:
+                self.dropped += 1
+            self.messages.append(message)
+            self.condition.notify()
+
+    def get(self, timeout=None):
+        with self.condition:
+            if not self.messages:
+                self.condition.wait(timeout)
+            if not self.messages:
+                return None
+            return self.messages.popleft()
+
+
+class BrewPublisher():
+    def __init__(self):
+        self.subscriptions = []
+        self.latest = {}
+        self.sequence = itertools.count(1)
+        self.lock = threading.Lock()
+
+    @property
+    def subscribers(self):
+        return len(self.subscriptions)
+
+    def subscribe(self, size=100):
+        subscription = Subscription(size)
+        with self.lock:
+            for message, _ in self.latest.values():
+                subscription.put(message)
+            self.subscriptions.append(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            if subscription in self.subscriptions:
+                self.subscriptions.remove(subscription)
+
+    def last(self, event, key=None):
+        message = self.latest.get((event, key))
+        return None if message is None else message[1]
+
+    def publish(self, event, data, key=None):
+        data = {'event': event, 'timestamp': time.time(), **data}
+
+        with self.lock:
+            message = 'id: {}\nevent: {}\ndata: {}\n\n'.format(
+                next(self.sequence), event, json.dumps(data))
+            if key is not None:
+                self.latest[(event, key)] = (message, data)
+            subscriptions = list(self.subscriptions)
+
+        for subscription in subscriptions:
+            subscription.put(message)
+
+
+publisher = BrewPublisher()
@@ -0,0 +1,285 @@
+import os
+import threading
+
+import loader as loader
+from chamber import BrewChamber
+from logger import logger
+from scheduler import scheduler
+from utils import configPath, getConfig
+
+'''
+Applies edits to brew.yaml and config.yaml to a running regulator.
+
+A scheduler job watches the modification time of both files and parses
+a changed file right away, an edit that does not parse or whose chambers
+do not resolve is logged and nothing changes. Parsed changes are applied
+by the regulator loop between steps, so relays are never switched while
+a regulator is deciding on them.
+
+brew.yaml is diffed against the running devices by sensor location,
+relay controls and chamber name:
+
+    - unchanged devices are kept, a sensor whose interval changed is
+      rescheduled
+    - other changes rebuild only that device, removed relays and relays
+      left without a chamber are turned off
+    - regulators of changed chambers are pointed at the new devices and
+      keep their controller, new chambers get a regulator
+
+From config.yaml the filters and regulator controller are reloaded,
+other sections need a restart.
+'''
+
+KEYS = {
+    'sensors': 'location',
+    'relays': 'controls'
+}
+
+RELOADABLE = ('filters', 'regulator')
+
+
+def indexSpecs(specs, kind):
+    key = KEYS[kind]
+    return {getattr(spec, key): spec for spec in specs.get(kind) or []}
+
+
+class BrewReloader():
+    def __init__(self, path, specs, peripherals, chambers, regulators, relays,
+                 makeRegulator, makeController, commitGoal, interval=2):
+        self.path = path
+        self.interval = interval
+        self.specs = specs or {}
+        self.sensors = {sensor.location: sensor for sensor in peripherals.get('sensors') or []}
+        self.relays = {relay.controls: relay for relay in peripherals.get('relays') or []}
+        self.chambers = chambers
+        self.regulators = regulators
+        self.chamberRelays = relays
+
+        self.makeRegulator = makeRegulator
+        self.makeController = makeController
+        self.commitGoal = commitGoal
+
+        self.config = getConfig()
+        self.watched = {path: self.modified(path) for path in (self.path, configPath())}
+        self.pendingSpecs = None
+        self.pendingConfig = None
+        self.lock = threading.Lock()
+        self.wakeup = None
+        self.job = None
+
+    def modified(self, path):
+        try:
+            stat = os.stat(path)
+            return (stat.st_mtime_ns, stat.st_size)
+        except OSError:
+            return None
+
+    def spawnBackgroundWatch(self, wakeup=None):
+        self.wakeup = wakeup
+        self.job = scheduler.every(self.interval, self.checkForChanges, name='reload file watch')
+
+    def checkForChanges(self):
+        for path, previous in self.watched.items():
+            modified = self.modified(path)
+            if modified is None or modified == previous:
+                continue
+
+            self.watched[path] = modified
+            if path == self.path:
+                specs = self.readSpecs()
+                with self.lock:
+                    self.pendingSpecs = specs or self.pendingSpecs
+            else:
+                config = getConfig(reload=True)
+                with self.lock:
+                    self.pendingConfig = config
+
+            if self.wakeup is not None:
+                self.wakeup.set()
+
+    def readSpecs(self):
+        try:
+            specs = loader.loadSpecs(self.path) or {}
+            for location, spec in indexSpecs(specs, 'sensors').items():
+                scheduler.checkInterval(spec.fields.get('interval'), 'sensor {}'.format(location))
+            # resolve chambers against the specs, nothing is built yet
+            BrewChamber.fromPeripherals({
+                'sensors': list(indexSpecs(specs, 'sensors').values()),
+                'relays': list(indexSpecs(specs, 'relays').values()),
+                'chambers': loader.build(specs.get('chambers'))
+            })
+        except Exception as error:
+            logger.error('Unable to reload {}, keeping running devices'.format(self.path), es={
+                'error': str(error),
+                'exception': error.__class__.__name__
+            })
+            return None
+
+        return specs
+
+    def apply(self):
+        '''
+        Applies changes found since the last call, called by the regulator
+        loop between steps.
+        '''
+        with self.lock:
+            specs, self.pendingSpecs = self.pendingSpecs, None
+            config, self.pendingConfig = self.pendingConfig, None
+
+        if config is not None:
+            self.applyConfig(config)
+        if specs is not None:
+            self.applySpecs(specs)
+
+    def applyConfig(self, config):
+        previous, self.config = self.config, config
+        changed = [section for section in set(previous) | set(config)
+                   if previous.get(section) != config.get(section)]
+        if len(changed) == 0:
+            return
+
+        if 'filters' in changed:
+            for sensor in self.sensors.values():
+                sensor.configureFilters(config.get('filters') or {})
+
+        if 'regulator' in changed:
+            for regulator in self.regulators:
+                regulator.useController(self.makeController())
+
+        restart = sorted(section for section in changed if section not in RELOADABLE)
+        logger.info('Reloaded config.yaml', es={'changed': sorted(changed)})
+        if restart:
+            logger.warning('Changes to {} take effect after a restart'.format(', '.join(restart)))
+
+    def applySpecs(self, specs):
+        previousSensors, sensors = indexSpecs(self.specs, 'sensors'), indexSpecs(specs, 'sensors')
+        previousRelays, relays = indexSpecs(self.specs, 'relays'), indexSpecs(specs, 'relays')
+
+        # build every new device before replacing any, a device that fails
+        # to build leaves the running ones as they are
+        try:
+            builtSensors = {location: spec.build() for location, spec in sensors.items()
+                            if self.needsBuild(previousSensors.get(location), spec)}
+            builtRelays = {controls: spec.build() for controls, spec in relays.items()
+                           if previousRelays.get(controls) != spec}
+        except Exception as error:
+            logger.error('Unable to reload {}, keeping running devices'.format(self.path), es={
+                'error': str(error),
+                'exception': error.__class__.__name__
+            })
+            return
+
+        changes = {'added': [], 'removed': [], 'rebuilt': [], 'rescheduled': []}
+        self.applySensors(previousSensors, sensors, builtSensors, changes)
+        self.applyRelays(previousRelays, relays, builtRelays, changes)
+        self.applyChambers(specs, changes)
+        self.specs = specs
+
+        logger.info('Reloaded {}'.format(self.path), es={
+            kind: ', '.join(names) for kind, names in changes.items() if names
+        })
+
+    def needsBuild(self, previous, current):
+        return previous != current and not self.onlyIntervalChanged(previous, current)
+
+    def applySensors(self, previous, current, built, changes):
+        for location in previous.keys() - current.keys():
+            sensor = self.sensors.pop(location)
+            self.stopSensorLog(sensor)
+            changes['removed'].append(location)
+
+        for location, spec in current.items():
+            if previous.get(location) == spec:
+                continue
+
+            sensor = self.sensors.get(location)
+            if location not in built:
+                sensor.interval = spec.interval
+                if sensor.job is not None:
+                    scheduler.reschedule(sensor.job, sensor.interval)
+                changes['rescheduled'].append(location)
+                continue
+
+            if sensor is not None:
+                self.stopSensorLog(sensor)
+            self.sensors[location] = built[location]
+            changes['rebuilt' if sensor is not None else 'added'].append(location)
+
+    def onlyIntervalChanged(self, previous, current):
+        if previous is None or previous.tag != current.tag:
+            return False
+
+        ignored = ('interval',)
+        return ({key: value for key, value in previous.fields.items() if key not in ignored} ==
+                {key: value for key, value in current.fields.items() if key not in ignored})
+
+    def stopSensorLog(self, sensor):
+        if sensor.job is not None:
+            scheduler.cancel(sensor.job)
+            sensor.job = None
+
+    def applyRelays(self, previous, current, built, changes):
+        for controls in previous.keys() - current.keys():
+            relay = self.relays.pop(controls)
+            self.turnOff(relay)
+            changes['removed'].append(controls)
+
+        for controls, spec in current.items():
+            if previous.get(controls) == spec:
+                continue
+
+            relay = self.relays.get(controls)
+            if relay is not None:
+                self.turnOff(relay)
+            self.relays[controls] = built[controls]
+            changes['rebuilt' if relay is not None else 'added'].append(controls)
+
+    def turnOff(self, relay):
+        if relay.state is True:
+            relay.set(False)
+
+    def applyChambers(self, specs, changes):
+        chambers = BrewChamber.fromPeripherals({
+            'sensors': list(self.sensors.values()),
+            'relays': list(self.relays.values()),
+            'chambers': loader.build(specs.get('chambers'))
+        })
+        previousGoals = {chamber.name: chamber.goal for chamber in self.chambers}
+        regulators = {regulator.name: regulator for regulator in self.regulators}
+        names = [chamber.name for chamber in chambers]
+
+        for regulator in [regulator for regulator in self.regulators if regulator.name not in names]:
+            regulator.stop()
+            self.regulators.remove(regulator)
+            changes['removed'].append('chamber {}'.format(regulator.name))
+
+        for chamber in chambers:
+            regulator = regulators.get(chamber.name)
+            if regulator is None:
+                regulator = self.makeRegulator(chamber)
+                regulator.poolTemperatureSensor()
+                regulator.spawnBackgroundPooling()
+                self.regulators.append(regulator)
+                changes['added'].append('chamber {}'.format(chamber.name))
+                continue
+
+            if chamber.goal is not None and chamber.goal != previousGoals.get(chamber.name):
+                self.commitGoal(chamber.goal, chamber.name)
+            if regulator.useChamber(chamber):
+                changes['rebuilt'].append('chamber {}'.format(chamber.name))
+
+        # relays no chamber regulates any more are left off
+        relays = [relay for chamber in chambers for relay in chamber.relays]
+        for relay in self.chamberRelays:
+            if relay not in relays:
+                self.turnOff(relay)
+        self.chamberRelays[:] = list(dict.fromkeys(relays))
+        self.chambers[:] = chambers
+
+        # sensors are logged while a chamber uses them
+        sensors = [sensor for chamber in chambers for sensor in chamber.sensors]
+        for sensor in self.sensors.values():
+            if sensor in sensors and sensor.job is None:
+                sensor.spawnBackgroundSensorLog()
+            elif sensor not in sensors:
+                self.stopSensorLog(sensor)
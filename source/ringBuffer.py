@@ -0,0 +1,76 @@
+import threading
+from array import array
+
+'''
+Fixed size ring buffer of timestamped sensor readings.
+
+Every metric is stored in its own preallocated array of doubles next to
+an array of timestamps, so appending never allocates and the buffer
+takes the same memory however long the sensor runs. Metrics missing
+from a reading are stored as nan.
+'''
+class RingBuffer():
+    def __init__(self, fields, size=300):
+        self.fields = tuple(fields)
+        self.size = size
+        self.timestamps = array('d', bytes(8 * size))
+        self.columns = {field: array('d', bytes(8 * size)) for field in self.fields}
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return min(self.count, self.size)
+
+    def append(self, timestamp, values):
+        with self.lock:
+            index = self.count % self.size
+            self.timestamps[index] = timestamp
+            for field, column in self.columns.items():
+                value = values.get(field)
+                column[index] = float('nan') if value is None else float(value)
+
+            self.count += 1
+
+    def row(self, index):
+        return (self.timestamps[index], {field: column[index] for field, column in self.columns.items()})
+
+    def latest(self):
+        with self.lock:
+            if self.count == 0:
+                return None
+
+            return self.row((self.count - 1) % self.size)
+
+    def recent(self, count):
+        '''
+        Last `count` timestamps and metric columns, oldest first, copied
+        out as arrays for vectorized use.
+        '''
+        with self.lock:
+            count = min(count, len(self))
+            start = (self.count - count) % self.size
+            end = start + count
+
+            def ordered(column):
+                if end <= self.size:
+                    return column[start:end]
+                return column[start:] + column[:end - self.size]
+
+            return (ordered(self.timestamps), {field: ordered(column) for field, column in self.columns.items()})
+
+    def window(self, seconds, now):
+        '''
+        Readings from the last `seconds` before `now`, oldest first.
+        '''
+        since = now - seconds
+        rows = []
+
+        with self.lock:
+            for offset in range(1, len(self) + 1):
+                index = (self.count - offset) % self.size
+                if self.timestamps[index] < since:
+                    break
+                rows.append(self.row(index))
+
+        rows.reverse()
+        return rows
@@ -0,0 +1,191 @@
+import heapq
+import itertools
+import queue
+import threading
+import time
+
+from logger import logger
+
+'''
+Central scheduler running periodic jobs on a small pool of worker threads.
+
+Jobs are kept in a heap ordered by their next deadline. One dispatcher
+thread sleeps until the earliest deadline and hands the job to a worker.
+Deadlines are fixed-rate, the next one is the previous deadline plus the
+interval, so jobs do not drift by their own run time. A job that is
+still running when its next deadline comes up skips that run instead of
+piling up.
+'''
+class Job():
+    def __init__(self, name, interval, func):
+        self.name = name
+        self.interval = interval
+        self.func = func
+        self.deadline = None
+        self.cancelled = False
+        self.running = False
+
+        self.runs = 0
+        self.skipped = 0
+        self.failures = 0
+        self.lastLateness = 0
+        self.maxLateness = 0
+        self.lastRuntime = 0
+        self.maxRuntime = 0
+
+    @property
+    def info(self):
+        return {
+            'name': self.name,
+            'interval': self.interval,
+            'runs': self.runs,
+            'skipped': self.skipped,
+            'failures': self.failures,
+            'lastLateness': round(self.lastLateness, 4),
+            'maxLateness': round(self.maxLateness, 4),
+            'lastRuntime': round(self.lastRuntime, 4),
+            'maxRuntime': round(self.maxRuntime, 4)
+        }
+
+
+class BrewScheduler():
+    def __init__(self, workers=3):
+        self.workerCount = workers
+        self.jobs = []
+        self.heap = []
+        self.sequence = itertools.count()
+        self.condition = threading.Condition()
+        self.ready = queue.Queue()
+        self.threads = []
+        self.stopped = False
+
+    def every(self, interval, func, name=None, delay=0):
+        self.checkInterval(interval, name or func.__name__)
+        job = Job(name or func.__name__, interval, func)
+        job.deadline = time.monotonic() + delay
+
+        with self.condition:
+            self.jobs.append(job)
+            heapq.heappush(self.heap, (job.deadline, next(self.sequence), job))
+            self.condition.notify()
+
+            if len(self.threads) == 0:
+                self.start()
+
+        logger.info('Scheduled job {} at interval: {}'.format(job.name, interval))
+        return job
+
+    def cancel(self, job):
+        with self.condition:
+            job.cancelled = True
+            if job in self.jobs:
+                self.jobs.remove(job)
+            self.condition.notify()
+
+    def reschedule(self, job, interval):
+        # takes effect from the job's next deadline, or sooner when the
+        # new interval ends before it
+        self.checkInterval(interval, job.name)
+        with self.condition:
+            job.interval = interval
+            soonest = time.monotonic() + interval
+            if not job.cancelled and job.deadline is not None and soonest < job.deadline:
+                job.deadline = soonest
+                heapq.heappush(self.heap, (job.deadline, next(self.sequence), job))
+                self.condition.notify()
+
+    @staticmethod
+    def checkInterval(interval, name):
+        # the dispatcher steps deadlines forward by the interval, which
+        # would never pass the current time when it is not positive
+        if not isinstance(interval, (int, float)) or interval <= 0:
+            raise ValueError('Interval of job {} must be positive, got {}'.format(name, interval))
+
+    @property
+    def stats(self):
+        return [job.info for job in list(self.jobs)]
+
+    def start(self):
+        self.stopped = False
+        dispatcher = threading.Thread(target=self.dispatchForever, args=(), name='scheduler')
+        self.threads = [dispatcher]
+
+        for index in range(self.workerCount):
+            worker = threading.Thread(target=self.workForever, args=(), name='scheduler-worker-{}'.format(index))
+            self.threads.append(worker)
+
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+    def dispatchForever(self):
+        while True:
+            with self.condition:
+                while not self.stopped and (len(self.heap) == 0 or self.heap[0][0] > time.monotonic()):
+                    timeout = self.heap[0][0] - time.monotonic() if self.heap else None
+                    self.condition.wait(timeout)
+
+                if self.stopped:
+                    return
+
+                deadline, _, job = heapq.heappop(self.heap)
+                # entries left behind when reschedule moved the deadline are stale
+                if job.cancelled or deadline != job.deadline:
+                    continue
+
+                if job.running:
+                    job.skipped += 1
+                else:
+                    job.running = True
+                    self.ready.put((deadline, job))
+
+                # next fixed-rate deadline, skipping any already missed
+                now = time.monotonic()
+                job.deadline = deadline + job.interval
+                while job.deadline <= now:
+                    job.deadline += job.interval
+                    job.skipped += 1
+                heapq.heappush(self.heap, (job.deadline, next(self.sequence), job))
+
+    def workForever(self):
+        while True:
+            item = self.ready.get()
+            if item is None:
+                return
+
+            deadline, job = item
+            started = time.monotonic()
+            job.lastLateness = started - deadline
+            job.maxLateness = max(job.maxLateness, job.lastLateness)
+
+            try:
+                job.func()
+            except Exception as error:
+                job.failures += 1
+                logger.error('Scheduled job failed, retrying next interval', es={
+                    'job': job.name,
+                    'error': str(error),
+                    'exception': error.__class__.__name__
+                })
+            finally:
+                job.lastRuntime = time.monotonic() - started
+                job.maxRuntime = max(job.maxRuntime, job.lastRuntime)
+                job.runs += 1
+                job.running = False
+
+    def shutdown(self, wait=True, timeout=5):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+
+        for _ in range(self.workerCount):
+            self.ready.put(None)
+
+        if wait:
+            for thread in self.threads:
+                thread.join(timeout)
+
+        self.threads = []
+
+
+scheduler = BrewScheduler()
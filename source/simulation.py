@@ -0,0 +1,193 @@
+import math
+
+from mockGPIO import MockGPIO
+
+'''
+Thermal simulation of a fermenter for testing regulators without hardware.
+
+FermenterPlant models the fridge air and the wort as two thermal masses.
+The air exchanges heat with the room and the wort, and the heating and
+cooling relays, read from the mock GPIO pins, add or remove heat from the
+air. The wort also gets heat from the fermentation itself. Time comes
+from a clock, either the `time` module or a VirtualClock, which lets
+FermentationSimulation run weeks of regulation in seconds.
+'''
+
+class VirtualClock():
+    def __init__(self, start=0):
+        self.now = start
+
+    def time(self):
+        return self.now
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.advance(seconds)
+
+    def advance(self, seconds):
+        self.now += max(seconds, 0)
+
+
+class SimulatedRelay():
+    '''
+    Relay that only drives its mock GPIO pin, keeping simulated runs off
+    the real GPIO, out of the relay table and out of the logs.
+    '''
+    def __init__(self, pin, controls):
+        self.pin = pin
+        self.controls = controls
+        self.set(False)
+
+    @property
+    def state(self):
+        return self.cachedState
+
+    def set(self, state, setup=False):
+        MockGPIO.output(self.pin, not state)
+        self.cachedState = bool(state)
+
+
+class FermenterPlant():
+    def __init__(self, clock, heatingPin, coolingPin, ambient=20, temperature=20,
+                 wortCapacity=105000, airCapacity=20000, wortCoupling=10, ambientCoupling=1.5,
+                 heatingPower=40, coolingPower=80, fermentationPower=8, fermentationPeak=172800):
+        '''
+        Capacities are in J/K, couplings in W/K and powers in W. ambient is a
+        temperature or a function returning one, like a sensor's temp.
+        '''
+        self.clock = clock
+        self.heatingPin = heatingPin
+        self.coolingPin = coolingPin
+        self.ambient = ambient if callable(ambient) else (lambda: ambient)
+
+        self.wortCapacity = wortCapacity
+        self.airCapacity = airCapacity
+        self.wortCoupling = wortCoupling
+        self.ambientCoupling = ambientCoupling
+        self.heatingPower = heatingPower
+        self.coolingPower = coolingPower
+        self.fermentationPower = fermentationPower
+        self.fermentationPeak = fermentationPeak
+
+        self.wortTemperature = temperature
+        self.airTemperature = temperature
+        self.start = clock.time()
+        self.lastUpdate = self.start
+
+    @staticmethod
+    def relayOn(pin):
+        # relays are active low, see BrewRelay.set
+        return MockGPIO.input(pin) is False
+
+    def fermentationHeat(self, elapsed):
+        # yeast activity rising to a peak and tailing off over the following days
+        if self.fermentationPeak <= 0:
+            return 0
+        x = elapsed / self.fermentationPeak
+        return self.fermentationPower * x * math.exp(1 - x)
+
+    def update(self, maxStep=5):
+        now = self.clock.time()
+        heating = self.heatingPower if self.relayOn(self.heatingPin) else 0
+        cooling = self.coolingPower if self.relayOn(self.coolingPin) else 0
+        ambient = self.ambient()
+
+        while self.lastUpdate < now:
+            dt = min(maxStep, now - self.lastUpdate)
+            toWort = self.wortCoupling * (self.airTemperature - self.wortTemperature)
+            toAir = self.ambientCoupling * (ambient - self.airTemperature) + heating - cooling - toWort
+            fermentation = self.fermentationHeat(self.lastUpdate - self.start)
+
+            self.airTemperature += toAir * dt / self.airCapacity
+            self.wortTemperature += (toWort + fermentation) * dt / self.wortCapacity
+            self.lastUpdate += dt
+
+        return self.wortTemperature
+
+    @property
+    def temperature(self):
+        return self.update()
+
+
+class FermentationSimulation():
+    '''
+    Runs a regulator against a plant on a virtual clock and collects
+    how well it kept the goal.
+    '''
+    def __init__(self, regulator, plant, clock, step=5):
+        self.regulator = regulator
+        self.plant = plant
+        self.clock = clock
+        self.step = step
+
+    def run(self, seconds):
+        regulator = self.regulator
+        end = self.clock.time() + seconds
+        nextSample = self.clock.time()
+        nextPool = self.clock.time()
+        nextStep = self.clock.time()
+        sensor = regulator.temperatureSensor
+
+        relays = {'heating': regulator.heating, 'cooling': regulator.cooling}
+        cycles = {name: 0 for name in relays}
+        onTime = {name: 0 for name in relays}
+        previous = {name: False for name in relays}
+
+        inBand = 0
+        settled = None
+        overshoot = 0
+        approachFromBelow = None
+        samples = 0
+
+        while self.clock.time() < end:
+            now = self.clock.time()
+            temperature = self.plant.update()
+
+            # stands in for the background sensor log, feeding the filters
+            if now >= nextSample:
+                sensor.update()
+                nextSample += sensor.interval
+
+            if now >= nextPool:
+                regulator.poolTemperatureSensor()
+                nextPool += regulator.poolingInterval
+
+            if now >= nextStep:
+                nextStep = now + max(regulator.control(), 1)
+
+            target = regulator.targetTemperature
+            if approachFromBelow is None:
+                approachFromBelow = temperature < target
+
+            # overshoot counts once the goal has been reached the first time
+            error = temperature - target
+            if settled is None and (error >= 0) == approachFromBelow:
+                settled = now
+            if settled is not None:
+                overshoot = max(overshoot, error if approachFromBelow else -error)
+                samples += 1
+                if abs(error) <= regulator.degreesAllowedToDrift:
+                    inBand += 1
+
+            for name, relay in relays.items():
+                state = relay.state
+                if state and not previous[name]:
+                    cycles[name] += 1
+                if state:
+                    onTime[name] += self.step
+                previous[name] = state
+
+            self.clock.advance(self.step)
+
+        return {
+            'controller': regulator.controller.name,
+            'simulatedSeconds': seconds,
+            'secondsToGoal': None if settled is None else round(settled - (end - seconds)),
+            'overshoot': round(overshoot, 3),
+            'timeInBand': round(inBand / samples, 4) if samples else 0,
+            'relayCycles': cycles,
+            'relayOnSeconds': onTime,
+            'finalTemperature': round(self.plant.wortTemperature, 3)
+        }
@@ -0,0 +1,53 @@
+import time
+from types import MappingProxyType
+
+'''
+Immutable reading of every metric a sensor measured in one bus
+transaction, stamped with the time it was taken.
+
+Sensors swap in a new snapshot per read instead of updating values in
+place, so a snapshot handed out never mixes values from two reads and
+can be shared between threads without locking. Metrics read as
+attributes or items, snapshot.temperature or snapshot['temperature'].
+'''
+class SensorSnapshot():
+    __slots__ = ('location', 'timestamp', 'values')
+
+    def __init__(self, location, timestamp, values):
+        object.__setattr__(self, 'location', location)
+        object.__setattr__(self, 'timestamp', timestamp)
+        object.__setattr__(self, 'values', MappingProxyType(dict(values)))
+
+    def __setattr__(self, name, value):
+        raise AttributeError('SensorSnapshot is immutable')
+
+    def __delattr__(self, name):
+        raise AttributeError('SensorSnapshot is immutable')
+
+    def __getattr__(self, metric):
+        # only called for names that are not slots
+        if metric in SensorSnapshot.__slots__:
+            raise AttributeError(metric)
+        try:
+            return self.values[metric]
+        except KeyError:
+            raise AttributeError('{} has no metric {}'.format(self.location, metric))
+
+    def __getitem__(self, metric):
+        return self.values[metric]
+
+    def __contains__(self, metric):
+        return metric in self.values
+
+    def __repr__(self):
+        return 'SensorSnapshot({}, {}, {})'.format(self.location, self.timestamp, dict(self.values))
+
+    def age(self, now=None):
+        return (time.time() if now is None else now) - self.timestamp
+
+    def isFresh(self, maxAge, now=None):
+        return self.age(now) <= maxAge
+
+    @property
+    def info(self):
+        return {'location': self.location, 'timestamp': self.timestamp, **self.values}
@@ -0,0 +1,143 @@
+import os
+import time
+import threading
+
+'''
+Append-only on-disk spool for elastic bulk lines that could not be shipped.
+
+Lines are appended to segment files named by the time window they were
+written in. A reader drains the oldest segment from a byte offset, so
+memory stays flat regardless of how much is spooled, and the oldest
+segments are evicted when the spool grows past maxBytes. A time window is
+split into several parts if needed, so no segment outgrows an eighth of
+the cap and eviction can keep the spool close to it.
+'''
+class DiskSpool():
+  def __init__(self, directory, maxBytes=50 * 1024 * 1024, segmentSeconds=3600):
+    self.directory = directory
+    self.maxBytes = maxBytes
+    self.segmentSeconds = segmentSeconds
+    self.segmentBytes = max(maxBytes // 8, 1)
+    self.lock = threading.Lock()
+
+    self.readSegment = None
+    self.readOffset = 0
+    self.pendingOffset = 0
+    self.evicted = 0
+
+    os.makedirs(self.directory, exist_ok=True)
+
+  def segmentPath(self, name):
+    return os.path.join(self.directory, name)
+
+  @property
+  def segments(self):
+    names = [name for name in os.listdir(self.directory) if name.endswith('.ndjson')]
+    return sorted(names)
+
+  @property
+  def size(self):
+    return sum(os.path.getsize(self.segmentPath(name)) for name in self.segments)
+
+  @property
+  def pending(self):
+    with self.lock:
+      return len(self.segments) > 0
+
+  def writeSegment(self):
+    window = '{:012d}'.format(int(time.time() // self.segmentSeconds))
+    segments = self.segments
+    part = 0
+
+    if len(segments) > 0 and segments[-1].startswith(window):
+      latest = segments[-1]
+      if os.path.getsize(self.segmentPath(latest)) < self.segmentBytes and self.endsWithNewline(latest):
+        return latest
+      part = int(latest[len(window) + 1:-len('.ndjson')]) + 1
+
+    return '{}-{:04d}.ndjson'.format(window, part)
+
+  def endsWithNewline(self, name):
+    # a segment torn by a crash mid-write is left as is, appending to it
+    # would glue the next line onto the torn one
+    with open(self.segmentPath(name), 'rb') as segment:
+      segment.seek(0, os.SEEK_END)
+      if segment.tell() == 0:
+        return True
+      segment.seek(-1, os.SEEK_END)
+      return segment.read(1) == b'\n'
+
+  def append(self, payload):
+    with self.lock:
+      name = self.writeSegment()
+      with open(self.segmentPath(name), 'ab') as segment:
+        segment.write(payload)
+        segment.flush()
+        os.fsync(segment.fileno())
+
+      self.evict()
+
+  def evict(self):
+    segments = self.segments
+    size = sum(os.path.getsize(self.segmentPath(name)) for name in segments)
+
+    # always keep the segment currently written to
+    while size > self.maxBytes and len(segments) > 1:
+      oldest = segments.pop(0)
+      size -= os.path.getsize(self.segmentPath(oldest))
+      os.remove(self.segmentPath(oldest))
+      self.evicted += 1
+
+      if oldest == self.readSegment:
+        self.readSegment = None
+        self.readOffset = 0
+
+  def read(self, maxLines):
+    '''
+    Read up to maxLines complete lines from the oldest segment, starting
+    where the last commit left off. Returns the raw bytes and line count,
+    call commit once they are shipped to advance past them.
+    '''
+    with self.lock:
+      for name in self.segments:
+        if self.readSegment != name:
+          self.readSegment = name
+          self.readOffset = 0
+
+        lines = []
+        with open(self.segmentPath(name), 'rb') as segment:
+          segment.seek(self.readOffset)
+          while len(lines) < maxLines:
+            line = segment.readline()
+            # stops at end of file and at lines torn by a crash mid-write
+            if not line.endswith(b'\n'):
+              break
+            lines.append(line)
+
+        if len(lines) > 0:
+          self.pendingOffset = self.readOffset + sum(len(line) for line in lines)
+          return (b''.join(lines), len(lines))
+
+        # nothing complete left in this segment, drop it and move on
+        os.remove(self.segmentPath(name))
+        self.readSegment = None
+        self.readOffset = 0
+
+      return (b'', 0)
+
+  def commit(self):
+    with self.lock:
+      if self.readSegment is None:
+        return
+
+      path = self.segmentPath(self.readSegment)
+      if not os.path.isfile(path):
+        self.readSegment = None
+        self.readOffset = 0
+        return
+
+      self.readOffset = self.pendingOffset
+      if self.readOffset >= os.path.getsize(path):
+        os.remove(path)
+        self.readSegment = None
+        self.readOffset = 0
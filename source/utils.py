@@ -1,42 +1,45 @@
 #!/bin/usr/python3
 import os
-import subprocess
+import time
 import yaml
 
+# libyaml parses config and brew.yaml several times faster when installed
+SafeLoader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+config = None
+
 def loadYaml(filePath):
   with open(filePath, "r") as stream:
     try:
-        return yaml.safe_load(stream)
+        return yaml.load(stream, Loader=SafeLoader)
     except yaml.YAMLError as exception:
         print('Error: {} is unparsable'.format(filePath))
         print(exception)
 
-def getConfig():
+def configPath():
   pwd = os.path.dirname(os.path.abspath(__file__))
-  path = os.path.join(pwd,'../', 'config.yaml')
-
+  return os.path.join(pwd,'../', 'config.yaml')
+
+def getConfig(reload=False):
+  '''
+  Parses config.yaml once and hands every caller the same dict, pass
+  reload to read changes made to the file since.
+  '''
+  global config
+  if config is not None and not reload:
+    return config
+
+  path = configPath()
   if not os.path.isfile(path):
     print('Please fill out and rename config file. Check README for more info.')
     exit(0)
 
-  return loadYaml(path)
+  parsed = loadYaml(path)
+  # keep running on the config we have when an edit does not parse
+  if parsed is not None or config is None:
+    config = parsed
+  return config
 
 def timezoneOffset():
-  localTimezoneCommand = 'date +%z'
-  process = subprocess.Popen(localTimezoneCommand.split(), stdout=subprocess.PIPE)
-  output, error = process.communicate()
-
   fallbackTimezone = '+0100'
-  if error:
-    print('Error when trying to fetch timezone: {}. Returning fallbacktimezone: {}.'.format(error, fallbackTimezone))
-    return fallbackTimezone
-
-  try:
-    output = output.decode("utf-8")
-    if '\n' in output:
-      output = output.replace('\n', '')
-    return output or fallbackTimezone
-  except Error as error:
-    print('Error occured while decoding output from system timezone: {}'.format(error))
-    return fallbackTimezone
-
+  return time.strftime('%z', time.localtime()) or fallbackTimezone
@@ -0,0 +1,38 @@
+import os
+import sys
+import tempfile
+
+'''
+Tests run against mock hardware from a scratch directory, the database
+in config.yaml and any brew.yaml are created there instead of in the repo.
+'''
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root)
+if '--mock' not in sys.argv:
+    sys.argv.append('--mock')
+
+os.chdir(tempfile.mkdtemp(prefix='brewlogger-tests-'))
+
+BREW_YAML = '''relays:
+- !Relay
+  controls: cooling
+  pin: 14
+- !Relay
+  controls: heating
+  pin: 23
+sensors:
+- !mockSensor
+  pin: 15
+  location: inside
+  interval: 2
+- !mockSensor
+  pin: 16
+  location: outside
+  interval: 2
+'''
+
+with open('brew.yaml', 'w') as file:
+    file.write(BREW_YAML)
+
+import source  # take a look in source/__init__.py
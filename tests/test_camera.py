@@ -0,0 +1,39 @@
+import pytest
+
+from archive import FrameArchive
+from brewCamera import BrewCamera
+import server
+
+
+@pytest.fixture
+def camera(tmp_path):
+    camera = BrewCamera(archive=FrameArchive(str(tmp_path / 'timelapse')))
+    camera.warmupTime = 0
+    yield camera
+    camera.close()
+
+
+def test_thumbnail_comes_from_the_same_capture(camera):
+    captures = []
+    camera.open()
+    capture = camera.camera.capture
+    camera.camera.capture = lambda output, **kwargs: (captures.append(kwargs), capture(output, **kwargs))
+
+    frame = camera.capture()
+
+    ports = {kwargs['splitter_port']: kwargs for kwargs in captures}
+    assert sorted(ports) == [0, 1]
+    assert ports[1]['resize'] == camera.thumbnailSize
+    timestamp = camera.archive.timestamps[-1]
+    assert camera.archive.sizesOf(timestamp)[0] == len(frame)
+    assert camera.archive.sizesOf(timestamp)[1] > 0
+
+
+def test_frame_without_thumbnail(camera, monkeypatch):
+    camera.archive.add(1000.0, b'frame')
+    monkeypatch.setattr(server, 'camera', camera)
+    client = server.app.test_client()
+
+    assert client.get('/api/camera/frames/1000000').data == b'frame'
+    assert client.get('/api/camera/frames/1000000?thumbnail=true').status_code == 404
+    assert client.get('/api/camera/frames/2000000').status_code == 404
@@ -0,0 +1,30 @@
+from types import SimpleNamespace
+
+from chamber import BrewChamber
+
+
+def relay(controls):
+    return SimpleNamespace(controls=controls)
+
+
+def sensor(location):
+    return SimpleNamespace(location=location)
+
+
+def test_default_chamber_uses_inside_sensor_and_relays():
+    chambers = BrewChamber.fromPeripherals({
+        'sensors': [sensor('inside'), sensor('outside')],
+        'relays': [relay('cooling'), relay('heating')]
+    })
+
+    assert [chamber.name for chamber in chambers] == ['default']
+    assert chambers[0].ambient.location == 'outside'
+
+
+def test_no_default_chamber_without_its_devices():
+    assert BrewChamber.fromPeripherals({'sensors': [sensor('outside')]}) == []
+    assert BrewChamber.fromPeripherals({
+        'sensors': [sensor('inside')],
+        'relays': [relay('cooling')]
+    }) == []
+    assert BrewChamber.fromPeripherals({}) == []
@@ -0,0 +1,82 @@
+from types import SimpleNamespace
+
+from controllers import AdaptiveController, PIDController
+from database import BrewDatabase, config
+
+
+def regulator(state, temperature, goal=18, limit=0.5, interval=60):
+    return SimpleNamespace(name='test', state=state, currentTemp=temperature,
+                           targetTemperature=goal, degreesAllowedToDrift=limit,
+                           poolingInterval=interval,
+                           withinDeviationLimit=abs(goal - temperature) <= limit)
+
+
+def test_heating_stops_when_rate_predicts_goal():
+    controller = AdaptiveController()
+    controller.rates['heating'] = 0.01
+    controller.overshoot['heating'] = 0.2
+
+    # 17.5 to 17.8 at 0.01 degrees a second takes 30 seconds
+    state, timeout = controller.decide(regulator('heating', 17.5), 1000)
+    assert state == 'heating'
+    assert round(timeout, 6) == 30
+
+    # the sensor has not been pooled again, the prediction stops heating
+    state, _ = controller.decide(regulator('heating', 17.5), 1030)
+    assert state == 'idle'
+
+
+def test_run_longer_than_interval_waits_for_sensor():
+    controller = AdaptiveController()
+    controller.rates['cooling'] = -0.001
+
+    assert controller.decide(regulator('idle', 19), 0) == ('cooling', 60)
+    assert controller.decide(regulator('cooling', 18.9), 60) == ('cooling', 60)
+
+
+def test_unknown_rate_keeps_pooling_interval():
+    controller = AdaptiveController()
+    assert controller.decide(regulator('idle', 17), 0) == ('heating', 60)
+    assert controller.decide(regulator('heating', 17.2), 60) == ('heating', 60)
+
+
+def test_adaptive_seeds_from_recorded_readings(tmp_path, monkeypatch):
+    monkeypatch.setitem(config['database'], 'name', str(tmp_path / 'brew.db'))
+    db = BrewDatabase()
+    rows = [(0, 'relay', 'heating', 1)]
+    # heating 0.01 degrees a second for ten minutes, then drifting back while idle
+    rows += [(t, 'inside', 'temperature', 17 + 0.01 * t) for t in range(0, 600, 30)]
+    rows += [(600, 'relay', 'heating', 0)]
+    rows += [(t, 'inside', 'temperature', 23 - 0.001 * (t - 600)) for t in range(600, 3000, 30)]
+    rows += [(3000, 'relay', 'cooling', 1)]
+    rows += [(t, 'inside', 'temperature', 20.6 - 0.005 * (t - 3000)) for t in range(3000, 3600, 30)]
+    rows += [(3600, 'relay', 'cooling', 0), (3600, 'inside', 'temperature', 17.6)]
+    # another chamber and metric are left out
+    rows += [(t, 'outside', 'temperature', 0) for t in range(0, 3600, 30)]
+    db.writeMany('insert into readings (timestamp, location, metric, value) values (?, ?, ?, ?)', rows)
+
+    controller = AdaptiveController()
+    controller.seed(SimpleNamespace(
+        name='test', clock=SimpleNamespace(time=lambda: 3600),
+        temperatureSensor=SimpleNamespace(location='inside'),
+        heating=SimpleNamespace(controls='heating'),
+        cooling=SimpleNamespace(controls='cooling')), db)
+
+    assert round(controller.rates['heating'], 6) == 0.01
+    assert round(controller.rates['idle'], 6) == -0.001
+    assert round(controller.rates['cooling'], 6) == -0.005
+    assert controller.runState is None and len(controller.samples) == 0
+
+
+def test_pid_starts_no_relay_within_dead_band():
+    controller = PIDController(deadBand=0.3)
+    assert controller.decide(regulator('idle', 18.2), 0)[0] == 'idle'
+    controller.cycleEnds = None
+    assert controller.decide(regulator('idle', 18.4), 900)[0] == 'cooling'
+
+
+def test_pid_rests_between_runs():
+    controller = PIDController(minimumCycleTime=600)
+    controller.observe('cooling', 0)
+    controller.observe('idle', 100)
+    assert controller.decide(regulator('idle', 19), 200)[0] == 'idle'
@@ -0,0 +1,105 @@
+import sqlite3
+import threading
+
+import pytest
+
+from compactor import BrewCompactor
+from database import BrewDatabase, config
+
+
+def test_readings_table_without_id_is_migrated(tmp_path, monkeypatch):
+    path = str(tmp_path / 'old.db')
+    conn = sqlite3.connect(path)
+    conn.execute('create table readings (timestamp REAL, location TEXT, metric TEXT, value REAL)')
+    conn.execute('create index readings_location_timestamp on readings (location, timestamp)')
+    conn.executemany('insert into readings values (?, ?, ?, ?)', [
+        (20.0, 'inside', 'temperature', 18.5),
+        (10.0, 'inside', 'temperature', 18.0)
+    ])
+    conn.commit()
+    conn.close()
+
+    monkeypatch.setitem(config['database'], 'name', path)
+    db = BrewDatabase()
+
+    rows = db.getAll('select id, timestamp, value from readings order by id')
+    assert rows == [(1, 10.0, 18.0), (2, 20.0, 18.5)]
+    # the compactor rolls up by id against the migrated table
+    compactor = BrewCompactor()
+    assert compactor.rollup() == 2
+    assert compactor.watermark == 2
+    assert db.get("select count from readings_1h where location = 'inside'") == 2
+    assert db.get("select count(*) from sqlite_master where name = 'readings_location_timestamp'") == 1
+
+
+def oldDatabase(path, columns='timestamp REAL, location TEXT, metric TEXT, value REAL'):
+    conn = sqlite3.connect(path)
+    conn.execute('create table readings ({})'.format(columns))
+    conn.execute("insert into readings (timestamp, location, metric) values (10.0, 'inside', 'temperature')")
+    conn.commit()
+    conn.close()
+
+
+def tables(path):
+    conn = sqlite3.connect(path)
+    names = [row[0] for row in conn.execute("select name from sqlite_master where type = 'table'")]
+    conn.close()
+    return names
+
+
+def test_failed_migration_keeps_old_table(tmp_path, monkeypatch):
+    path = str(tmp_path / 'old.db')
+    # without a value column the copy fails after the rename
+    oldDatabase(path, 'timestamp REAL, location TEXT, metric TEXT')
+    monkeypatch.setitem(config['database'], 'name', path)
+
+    with pytest.raises(sqlite3.OperationalError):
+        BrewDatabase()
+
+    assert 'readings' in tables(path)
+    assert 'readings_without_id' not in tables(path)
+
+
+def test_interrupted_migration_is_recovered(tmp_path, monkeypatch):
+    path = str(tmp_path / 'old.db')
+    oldDatabase(path)
+    conn = sqlite3.connect(path)
+    conn.execute('alter table readings rename to readings_without_id')
+    conn.commit()
+    conn.close()
+    monkeypatch.setitem(config['database'], 'name', path)
+
+    db = BrewDatabase()
+
+    assert db.get('select count(*) from readings') == 1
+    assert 'readings_without_id' not in tables(path)
+
+
+def test_concurrent_migrations(tmp_path, monkeypatch):
+    path = str(tmp_path / 'old.db')
+    oldDatabase(path)
+    monkeypatch.setitem(config['database'], 'name', path)
+
+    errors = []
+    def start():
+        try:
+            BrewDatabase()
+        except Exception as error:
+            errors.append(error)
+
+    threads = [threading.Thread(target=start) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    assert BrewDatabase().getAll('select id, timestamp from readings') == [(1, 10.0)]
+
+
+def test_readings_writer_is_shared():
+    import brewCamera
+    import brewSensor
+
+    assert brewSensor.getReadings() is brewCamera.getReadings()
+    assert not hasattr(brewSensor, 'readings') and not hasattr(brewCamera, 'readings')
@@ -0,0 +1,24 @@
+import numpy as np
+
+from filters import FilterPipeline, RateLimitFilter
+
+
+def test_rate_limit_ramps_held_step():
+    timestamps = np.arange(8) * 2.0
+    values = np.array([20, 20, 20, 25, 25, 25, 25, 25], dtype=np.float64)
+
+    filtered = RateLimitFilter(0.05).apply(timestamps, values)
+
+    assert np.allclose(filtered, [20, 20, 20, 20.1, 20.2, 20.3, 20.4, 20.5])
+
+
+def test_rate_limit_passes_slow_changes():
+    timestamps = np.arange(4) * 2.0
+    values = np.array([20, 20.05, 20.1, 20.0])
+
+    assert np.allclose(RateLimitFilter(0.05).apply(timestamps, values), values)
+
+
+def test_pipeline_skips_missing_samples():
+    pipeline = FilterPipeline.fromConfig([{'rate_limit': 0.05}])
+    assert pipeline.latest([0, 2, 4], [20, float('nan'), 25]) == 20.2
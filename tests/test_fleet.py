@@ -0,0 +1,127 @@
+import threading
+import time
+
+import pytest
+from flask import Flask, jsonify, request
+from werkzeug.serving import make_server
+
+from fleet import BrewHub, BrewNode
+import hub as hubServer
+
+
+def standInNode(delay=0, regulated=True):
+    '''
+    Flask app answering the node endpoints the hub polls, after delay
+    seconds, and counting the requests answered with 304. Without
+    regulated it has no chambers and answers 404 on /api/regulator.
+    '''
+    app = Flask(__name__)
+    app.notModified = 0
+
+    def respond(body, etag):
+        time.sleep(delay)
+        if request.headers.get('If-None-Match') == '"{}"'.format(etag):
+            app.notModified += 1
+            return '', 304
+
+        response = jsonify(body)
+        response.set_etag(etag)
+        return response
+
+    app.add_url_rule('/api/sensors', 'sensors', lambda: respond(
+        {'sensors': [{'location': 'inside', 'temperature': 18.0}]}, 'sensors'))
+    app.add_url_rule('/api/relays', 'relays', lambda: respond(
+        {'relays': [{'controls': 'cooling', 'state': False}]}, 'relays'))
+    if regulated:
+        app.add_url_rule('/api/regulator', 'regulator', lambda: respond(
+            {'state': 'idle', 'goal': 18.0}, 'regulator'))
+        app.add_url_rule('/api/chambers', 'chambers', lambda: respond(
+            {'chambers': [{'name': 'default', 'state': 'idle', 'goal': 18.0}]}, 'chambers'))
+    else:
+        app.add_url_rule('/api/regulator', 'regulator', lambda: (
+            {'success': False, 'message': 'no chambers regulated'}, 404))
+        app.add_url_rule('/api/chambers', 'chambers', lambda: respond({'chambers': []}, 'chambers'))
+    return app
+
+
+@pytest.fixture
+def nodes():
+    servers = [make_server('127.0.0.1', 0, standInNode(delay), threaded=True) for delay in (0, 2)]
+    for server in servers:
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    yield servers
+    for server in servers:
+        server.shutdown()
+
+
+@pytest.fixture
+def hub(nodes, monkeypatch):
+    hub = BrewHub([BrewNode(name, 'http://127.0.0.1:{}'.format(server.server_port), timeout=0.5)
+                   for name, server in zip(('normal', 'slow'), nodes)], ttl=60)
+    monkeypatch.setattr(hubServer, 'hub', hub)
+    return hub
+
+
+def waitForPolls(hub):
+    for future in hub.pending.values():
+        future.result(timeout=5)
+
+
+def test_fleet_does_not_wait_on_slow_node(hub):
+    client = hubServer.app.test_client()
+
+    started = time.monotonic()
+    hub.poll()
+    fleet = client.get('/api/fleet').get_json()
+    assert time.monotonic() - started < 0.5
+    assert fleet['online'] == 0
+
+    waitForPolls(hub)
+    fleet = client.get('/api/fleet').get_json()
+    normal, slow = fleet['nodes']
+    assert fleet['online'] == 1
+    assert normal['online'] is True
+    assert normal['sensors'] == [{'location': 'inside', 'temperature': 18.0}]
+    assert normal['regulator'] == {'state': 'idle', 'goal': 18.0}
+    assert normal['chambers'] == [{'name': 'default', 'state': 'idle', 'goal': 18.0}]
+    assert slow['online'] is False
+    assert slow['error'] is not None
+
+
+def test_not_modified_reuses_cached_body(hub, nodes):
+    normal = hub.getNodeByName('normal')
+    assert normal.poll() is True
+    first = normal.state
+
+    assert normal.poll() is True
+    assert nodes[0].app.notModified == len(first)
+    assert normal.state == first
+
+
+def test_state_expires_after_ttl(hub):
+    normal = hub.getNodeByName('normal')
+    assert normal.poll() is True
+
+    fresh = normal.info(hub.ttl, normal.updated + hub.ttl)
+    assert fresh['online'] is True
+    assert fresh['relays'] == [{'controls': 'cooling', 'state': False}]
+
+    expired = normal.info(hub.ttl, normal.updated + hub.ttl + 1)
+    assert expired['online'] is False
+    assert expired['sensors'] is None and expired['relays'] is None and expired['regulator'] is None
+
+
+def test_node_without_chambers_is_online():
+    server = make_server('127.0.0.1', 0, standInNode(regulated=False), threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    try:
+        node = BrewNode('sensors only', 'http://127.0.0.1:{}'.format(server.server_port))
+        assert node.poll() is True
+        info = node.info(60)
+        assert info['online'] is True
+        assert info['regulator'] is None
+        assert info['chambers'] == []
+    finally:
+        server.shutdown()
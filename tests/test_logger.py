@@ -0,0 +1,150 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from logger import ESHandler
+from spool import DiskSpool
+
+
+class ElasticStub(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        payload = self.rfile.read(int(self.headers['Content-Length']))
+        self.server.received.append(payload)
+        status = self.server.statuses.pop(0) if self.server.statuses else 200
+
+        body = b'{"errors": false, "items": []}'
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        return
+
+
+@pytest.fixture
+def elastic():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), ElasticStub)
+    server.received = []
+    server.statuses = []
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+
+
+def batch(count, start=0):
+    return [('brewlogger-test', str(start + number), {'message': 'record {}'.format(start + number)})
+            for number in range(count)]
+
+
+def handler(elastic, spool):
+    return ESHandler(host='127.0.0.1', port=elastic.server_port, ssl=False, spool=spool)
+
+
+def test_rejected_batch_is_failed_not_spooled(elastic, tmp_path):
+    spool = DiskSpool(str(tmp_path / 'spool'))
+    esHandler = handler(elastic, spool)
+    elastic.statuses = [400]
+
+    assert esHandler.ship(batch(3)) is True
+    assert esHandler.online
+    assert spool.pending is False
+    assert esHandler.stats['failed'] == 3
+    esHandler.close()
+
+
+def test_server_error_is_spooled(elastic, tmp_path):
+    spool = DiskSpool(str(tmp_path / 'spool'))
+    esHandler = handler(elastic, spool)
+    elastic.statuses = [503, 503]
+
+    assert esHandler.ship(batch(3)) is False
+    assert esHandler.online is False
+    assert esHandler.stats['spooled'] == 3
+    esHandler.close()
+
+
+def test_rejected_batch_does_not_block_spool(elastic, tmp_path):
+    spool = DiskSpool(str(tmp_path / 'spool'))
+    esHandler = handler(elastic, spool)
+    esHandler.batchSize = 2
+    esHandler.spoolBatch(batch(2))
+    esHandler.spoolBatch(batch(2, start=2))
+
+    # the head of the spool is rejected, the batch after it still ships
+    elastic.statuses = [400, 200]
+    esHandler.replaySpool()
+
+    assert len(elastic.received) == 2
+    assert spool.read(10) == (b'', 0)
+    assert esHandler.stats['failed'] == 2
+    assert esHandler.stats['replayed'] == 2
+
+    shipped = [json.loads(line) for line in elastic.received[1].decode('utf8').splitlines()]
+    assert shipped[1]['message'] == 'record 2'
+    esHandler.close()
+
+
+def test_undecodable_spool_lines_are_skipped(elastic, tmp_path):
+    spool = DiskSpool(str(tmp_path / 'spool'))
+    esHandler = handler(elastic, spool)
+    esHandler.spoolBatch(batch(1))
+    # a line torn by a crash, then the next start appends to the same segment
+    with open(spool.segmentPath(spool.segments[-1]), 'ab') as segment:
+        segment.write(b'["brewlogger-test", "torn", {"mess')
+    esHandler.spoolBatch(batch(2, start=1))
+
+    esHandler.replaySpool()
+
+    assert spool.read(10) == (b'', 0)
+    assert esHandler.stats['replayed'] == 3
+    assert esHandler.stats['undecodable'] == 0
+    esHandler.close()
+
+
+def test_glued_spool_line_is_counted_and_skipped(elastic, tmp_path):
+    spool = DiskSpool(str(tmp_path / 'spool'))
+    esHandler = handler(elastic, spool)
+    spool.append(b'["brewlogger-test", "torn", {"mess["brewlogger-test", "1", {}]\n')
+    esHandler.spoolBatch(batch(1, start=2))
+
+    esHandler.replaySpool()
+
+    assert spool.read(10) == (b'', 0)
+    assert esHandler.stats['undecodable'] == 1
+    assert esHandler.stats['replayed'] == 1
+    esHandler.close()
+
+
+def test_torn_segment_is_not_appended_to(tmp_path):
+    spool = DiskSpool(str(tmp_path / 'spool'))
+    spool.append(b'["torn')
+    spool.append(b'[]\n')
+
+    assert len(spool.segments) == 2
+
+
+def test_shipper_survives_errors(elastic, tmp_path, monkeypatch):
+    esHandler = handler(elastic, None)
+    esHandler.flushInterval = 0.05
+    shipments = []
+
+    def ship(batch):
+        shipments.append(batch)
+        if len(shipments) == 1:
+            raise RuntimeError('unexpected')
+
+    monkeypatch.setattr(esHandler, 'ship', ship)
+    esHandler.queue.put(batch(1)[0])
+    esHandler.flush(timeout=2)
+    esHandler.queue.put(batch(1, start=1)[0])
+    esHandler.flush(timeout=2)
+
+    assert esHandler.shipper.is_alive()
+    assert len(shipments) == 2
+    assert esHandler.stats['errors'] == 1
+    esHandler.close()
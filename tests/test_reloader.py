@@ -0,0 +1,166 @@
+import os
+
+import pytest
+
+import loader
+from chamber import BrewChamber
+from reloader import BrewReloader
+
+# pins apart from the ones in conftest.py, relay state is stored per pin
+RELAYS = '''relays:
+- !Relay
+  controls: cooling
+  pin: {cooling}
+- !Relay
+  controls: heating
+  pin: 6
+'''
+
+SENSORS = '''sensors:
+- !mockSensor
+  pin: 15
+  location: inside
+  interval: {interval}
+- !mockSensor
+  pin: 16
+  location: outside
+  interval: 2
+'''
+
+CHAMBER = '''- !Chamber
+  name: {name}
+  sensor: {sensor}
+  cooling: cooling
+  heating: heating
+'''
+
+
+def brewYaml(cooling=5, interval=2, chambers=()):
+    document = RELAYS.format(cooling=cooling) + SENSORS.format(interval=interval)
+    if chambers:
+        document += 'chambers:\n' + ''.join(
+            CHAMBER.format(name=name, sensor=sensor) for name, sensor in chambers)
+    return document
+
+
+class StandInRegulator():
+    def __init__(self, chamber):
+        self.name = chamber.name
+        self.chamber = chamber
+        self.controller = None
+        self.woken = False
+        self.stopped = False
+
+    def stop(self):
+        self.stopped = True
+
+    def useChamber(self, chamber):
+        changed = chamber.relays != self.chamber.relays or chamber.sensor is not self.chamber.sensor
+        self.chamber = chamber
+        return changed
+
+    def poolTemperatureSensor(self):
+        pass
+
+    def spawnBackgroundPooling(self):
+        pass
+
+
+@pytest.fixture
+def reloader(tmp_path):
+    path = str(tmp_path / 'brew.yaml')
+    with open(path, 'w') as file:
+        file.write(brewYaml())
+
+    specs = loader.loadSpecs(path)
+    peripherals = loader.build(specs)
+    chambers = BrewChamber.fromPeripherals(peripherals)
+    regulators = [StandInRegulator(chamber) for chamber in chambers]
+    relays = [relay for chamber in chambers for relay in chamber.relays]
+    for sensor in chambers[0].sensors:
+        sensor.spawnBackgroundSensorLog()
+
+    reloader = BrewReloader(path, specs, peripherals, chambers, regulators, relays,
+                            StandInRegulator, lambda: None, lambda goal, name: None)
+    yield reloader
+
+    for sensor in reloader.sensors.values():
+        reloader.stopSensorLog(sensor)
+
+
+def edit(reloader, document):
+    with open(reloader.path, 'w') as file:
+        file.write(document)
+
+    # a later modification time than the one seen, however fast the test runs
+    stat = os.stat(reloader.path)
+    os.utime(reloader.path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000000000))
+
+    reloader.checkForChanges()
+    reloader.apply()
+
+
+def test_interval_change_only_reschedules(reloader):
+    sensor = reloader.sensors['inside']
+    job = sensor.job
+
+    edit(reloader, brewYaml(interval=5))
+
+    assert reloader.sensors['inside'] is sensor
+    assert sensor.job is job
+    assert sensor.interval == 5 and job.interval == 5
+    assert reloader.regulators[0].chamber.sensor is sensor
+
+
+def test_relay_pin_change_turns_old_relay_off(reloader):
+    cooling = reloader.relays['cooling']
+    heating = reloader.relays['heating']
+    cooling.set(True)
+
+    edit(reloader, brewYaml(cooling=7))
+
+    assert cooling.state is False
+    assert reloader.relays['cooling'] is not cooling
+    assert reloader.relays['cooling'].pin == 7
+    assert reloader.relays['heating'] is heating
+    assert reloader.regulators[0].chamber.cooling is reloader.relays['cooling']
+    assert reloader.chamberRelays == [reloader.relays['cooling'], heating]
+
+
+def test_chambers_added_and_removed(reloader):
+    default = reloader.regulators[0]
+
+    edit(reloader, brewYaml(chambers=[('lager', 'inside'), ('ale', 'outside')]))
+
+    assert default.stopped is True
+    assert [regulator.name for regulator in reloader.regulators] == ['lager', 'ale']
+    assert [chamber.name for chamber in reloader.chambers] == ['lager', 'ale']
+    ale = reloader.regulators[1]
+
+    edit(reloader, brewYaml(chambers=[('lager', 'inside')]))
+
+    assert ale.stopped is True
+    assert [regulator.name for regulator in reloader.regulators] == ['lager']
+    # the outside sensor is no longer used by a chamber, so not logged
+    assert reloader.sensors['outside'].job is None
+
+
+def test_unresolvable_chamber_is_ignored(reloader):
+    regulators = list(reloader.regulators)
+    chambers = list(reloader.chambers)
+
+    edit(reloader, brewYaml(chambers=[('lager', 'missing')]))
+
+    assert reloader.pendingSpecs is None
+    assert reloader.regulators == regulators
+    assert reloader.chambers == chambers
+    assert reloader.regulators[0].stopped is False
+
+
+def test_zero_interval_is_ignored(reloader):
+    sensor = reloader.sensors['inside']
+
+    edit(reloader, brewYaml(interval=0))
+
+    assert reloader.pendingSpecs is None
+    assert sensor.interval == 2 and sensor.job.interval == 2
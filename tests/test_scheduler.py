@@ -0,0 +1,29 @@
+import threading
+
+import pytest
+
+from scheduler import BrewScheduler
+
+
+@pytest.fixture
+def scheduler():
+    scheduler = BrewScheduler(workers=1)
+    yield scheduler
+    scheduler.shutdown()
+
+
+@pytest.mark.parametrize('interval', [0, -1, None])
+def test_non_positive_interval_is_rejected(scheduler, interval):
+    with pytest.raises(ValueError):
+        scheduler.every(interval, lambda: None, name='zero')
+
+    job = scheduler.every(1, lambda: None, name='job')
+    with pytest.raises(ValueError):
+        scheduler.reschedule(job, interval)
+    assert job.interval == 1
+
+
+def test_jobs_keep_running(scheduler):
+    ran = threading.Event()
+    scheduler.every(0.01, ran.set, name='quick')
+    assert ran.wait(2)
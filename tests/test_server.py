@@ -0,0 +1,54 @@
+import pytest
+
+from scheduler import scheduler
+from snapshot import SensorSnapshot
+import server
+
+
+@pytest.fixture
+def client():
+    return server.app.test_client()
+
+
+@pytest.fixture
+def stoppedSamplers():
+    # requests must not sample, count every read once the samplers are stopped
+    reads = []
+    for sensor in server.sensors:
+        scheduler.cancel(sensor.job)
+        sensor.sample = lambda sensor=sensor: reads.append(sensor.location)
+    yield reads
+    for sensor in server.sensors:
+        del sensor.sample
+        sensor.spawnBackgroundSampling()
+
+
+def test_sensors_are_served_from_buffer(client, stoppedSamplers):
+    for sensor in server.sensors:
+        # older than twice the interval, latest() would read the sensor again
+        sensor.snapshot = SensorSnapshot(sensor.location, 1000.0, {'temperature': 18.0, 'humidity': 80.0})
+
+    response = client.get('/api/sensors')
+    assert response.status_code == 200
+    assert [sensor['temperature'] for sensor in response.json['sensors']] == [18.0, 18.0]
+    assert all(sensor['age'] > 1000 for sensor in response.json['sensors'])
+
+    assert client.get('/api/sensor/inside').status_code == 200
+    assert stoppedSamplers == []
+
+
+def test_unsampled_sensor_is_unavailable(client, stoppedSamplers):
+    for sensor in server.sensors:
+        sensor.snapshot = None
+
+    assert client.get('/api/sensors').json['sensors'] == []
+    assert client.get('/api/sensor/inside').status_code == 503
+    assert stoppedSamplers == []
+
+
+def test_without_chambers(client, monkeypatch):
+    monkeypatch.setattr(server, 'chambers', [])
+
+    assert client.get('/api/chambers').get_json() == {'chambers': []}
+    assert client.get('/api/regulator').status_code == 404
+    assert client.post('/api/regulator/18').status_code == 404